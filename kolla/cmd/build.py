@@ -25,6 +25,7 @@ PROJECT_ROOT = os.path.abspath(os.path.join(
 if PROJECT_ROOT not in sys.path:
     sys.path.insert(0, PROJECT_ROOT)
 
+from kolla import exception  # noqa
 from kolla.image import build  # noqa
 
 
@@ -41,6 +42,9 @@ def main():
         build.LOG.error("Syntax error in template: %s" % e.name)
         build.LOG.error(e.message)
         return 1
+    except exception.KollaTemplateRenderException as e:
+        build.LOG.error('%s', e)
+        return 1
 
 
 if __name__ == '__main__':
@@ -161,6 +161,16 @@ _CLI_OPTS = [
                 help='Do not rebuild parents of matched images'),
     cfg.BoolOpt('skip-existing', default=False,
                 help='Do not rebuild images present in the docker cache'),
+    cfg.StrOpt('existing-images-source', default='docker',
+               choices=['docker', 'registry'],
+               help=('Where --skip-existing looks for existing images: in'
+                     ' the local Docker images, or in the registry the'
+                     ' images are pushed to')),
+    cfg.BoolOpt('skip-unchanged', default=False,
+                help=('Do not rebuild images whose rendered Dockerfile,'
+                      ' build context, sources, build arguments and parent'
+                      ' image are identical to those of the image present'
+                      ' in the docker cache or in the registry')),
     cfg.DictOpt('build-args',
                 help='Set docker build time variables'),
     cfg.BoolOpt('keep', default=False,
@@ -175,6 +185,17 @@ _CLI_OPTS = [
                help='The network mode for Docker build. Example: host'),
     cfg.BoolOpt('cache', default=True,
                 help='Use the Docker cache when building'),
+    cfg.StrOpt('changed-since',
+               help=('Build only the images changed since a git revision,'
+                     ' or in a git revision range such as'
+                     ' origin/master..HEAD, and their descendants. When a'
+                     ' regex or profile is also given, only the changed'
+                     ' images matching it are built')),
+    cfg.ListOpt('changed-files', default=[],
+                help=('Build only the images changed by these files, and'
+                      ' their descendants. Relative paths are relative to'
+                      ' the top of the git checkout of the images. Ignored'
+                      ' if --changed-since is set')),
     cfg.MultiOpt('profile', types.String(), short='p',
                  help=('Build a pre-defined set of images, see [profiles]'
                        ' section in config. The default profiles are:'
@@ -186,6 +207,12 @@ _CLI_OPTS = [
     cfg.IntOpt('push-threads', default=1, min=1,
                help=('The number of threads to use while pushing images.'
                      ' Note: Docker cannot handle threaded pushing properly')),
+    cfg.StrOpt('push-engine', default='docker',
+               choices=['docker', 'pipelined'],
+               help=('How to push images: as soon as they are built, or'
+                     ' pipelined along the image graph, pushing parents'
+                     ' first and mounting the layers of a parent into the'
+                     ' repositories of its children in the registry')),
     cfg.IntOpt('retries', short='r', default=3, min=0,
                help='The number of times to retry while building'),
     cfg.MultiOpt('regex', types.String(), positional=True, required=False,
@@ -202,6 +229,23 @@ _CLI_OPTS = [
                help='Format to write the final results in'),
     cfg.StrOpt('tarballs-base', default=TARBALLS_BASE,
                help='Base url to OpenStack tarballs'),
+    cfg.StrOpt('source-cache-dir',
+               help=('Path to a directory where sources are cached across'
+                     ' runs. Cached archives are revalidated with the'
+                     ' server before being used. By default, sources are'
+                     ' downloaded on every run')),
+    cfg.IntOpt('source-cache-size', default=10240, min=0,
+               help=('Maximum size in MiB of the downloaded archives kept'
+                     ' in the source cache directory')),
+    cfg.IntOpt('prefetch-threads', default=0, min=0,
+               help=('The number of threads downloading the sources of all'
+                     ' the images to build ahead of their build. By default,'
+                     ' sources are downloaded only when building each'
+                     ' image')),
+    cfg.IntOpt('download-memory-limit', default=64, min=1,
+               help=('Maximum amount of memory in MiB used by all the source'
+                     ' downloads in flight. Downloads are streamed to disk'
+                     ' in chunks of at most 1 MiB')),
     cfg.StrOpt('type', short='t', default='source',
                choices=INSTALL_TYPE_CHOICES,
                dest='install_type',
@@ -214,6 +258,20 @@ _CLI_OPTS = [
                help='The Docker tag'),
     cfg.BoolOpt('template-only', default=False,
                 help="Don't build images. Generate Dockerfile only"),
+    cfg.IntOpt('render-processes', default=1, min=1,
+               help=('The number of processes rendering Dockerfiles. With'
+                     ' more than one, all the rendering errors are reported'
+                     ' together')),
+    cfg.StrOpt('template-cache-dir',
+               help=('Directory to cache compiled Dockerfile templates in,'
+                     ' shared across runs. Templates are not cached if not'
+                     ' set')),
+    cfg.BoolOpt('selective-render', default=False,
+                help=('Resolve the images matching the regex or profiles'
+                      ' from the parents named in their templates, and only'
+                      ' copy and render those images and their ancestors'
+                      ' into the working directory. Other images are not'
+                      ' reported as unmatched')),
     cfg.IntOpt('timeout', default=120,
                help='Time in seconds after which any operation times out'),
     cfg.MultiOpt('template-override', types.String(),
@@ -223,14 +281,16 @@ _CLI_OPTS = [
                        ' can be specified multiple times'),
                  short='D', default=[]),
     cfg.StrOpt('logs-dir', help='Path to logs directory'),
+    cfg.BoolOpt('logs-compress', default=False,
+                help='Compress the logs of the images in --logs-dir'),
     cfg.BoolOpt('pull', default=True,
                 help='Attempt to pull a newer version of the base image'),
     cfg.StrOpt('work-dir', help=('Path to be used as working directory.'
                                  ' By default, a temporary dir is created')),
     cfg.BoolOpt('squash', default=False,
-                help=('Squash the image layers. WARNING: it will consume lots'
-                      ' of disk IO. "docker-squash" tool is required, install'
-                      ' it by "pip install docker-squash"')),
+                help=('Squash the layers each image adds to its parent into'
+                      ' a single layer. Only the layers to squash are written'
+                      ' to disk, in --squash-tmp-dir')),
     cfg.StrOpt('openstack-release', default=OPENSTACK_RELEASE,
                help='OpenStack release for building kolla source images and '
                     'kolla-toolbox image'),
@@ -248,8 +308,30 @@ _CLI_OPTS = [
                 help='Enable images marked as unbuildable'),
     cfg.BoolOpt('summary', default=True,
                 help='Show summary at the end of build'),
+    cfg.StrOpt('timings-file',
+               help=('Path of a JSON file to save the time spent by each'
+                     ' image waiting in the queues, fetching sources,'
+                     ' archiving, building, squashing and pushing')),
+    cfg.StrOpt('trace-file',
+               help=('Path of a file to save the timeline of the build in'
+                     ' the Chrome trace format, to be opened with'
+                     ' chrome://tracing or https://ui.perfetto.dev')),
+    cfg.StrOpt('metrics-file',
+               help=('Path of a file to save the metrics of the build to, in'
+                     ' the Prometheus text format, such as a file read by'
+                     ' the textfile collector of the node exporter')),
+    cfg.PortOpt('metrics-port',
+                help=('Port to serve the metrics of the build on while it'
+                      ' runs, in the Prometheus text format')),
+    cfg.StrOpt('metrics-host', default='127.0.0.1',
+               help='Address to serve the metrics of the build on'),
     cfg.BoolOpt('infra-rename', default=False,
-                help='Rename infrastructure images to infra')
+                help='Rename infrastructure images to infra'),
+    cfg.StrOpt('history-file',
+               help=('Path to a file recording the build and push times of'
+                     ' images. When set, the times of previous runs are used'
+                     ' to schedule builds and to estimate the remaining'
+                     ' time of the build'))
 ]
 
 _BASE_OPTS = [
@@ -29,6 +29,10 @@ class Task(object, metaclass=abc.ABCMeta):
     def followups(self):
         return []
 
+    @property
+    def priority(self):
+        return 0
+
     @abc.abstractmethod
     def run(self):
         pass
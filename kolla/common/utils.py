@@ -10,10 +10,183 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import gzip
 import logging
 import os
-import subprocess  # nosec
+import queue
 import sys
+import threading
+import weakref
+
+# Records written by the log writer between two flushes, at most.
+LOG_BATCH_SIZE = 512
+
+# The writer of the per-image logs, see start_log_writer().
+_LOG_WRITER = None
+
+# The handlers of the per-image log files, see close_log_files().
+_FILE_HANDLERS = weakref.WeakSet()
+
+
+def log_filename(image_name, compress=False):
+    """Name of the log file of an image in the logs directory."""
+    return '%s.log%s' % (image_name, '.gz' if compress else '')
+
+
+class _BatchedFileHandler(logging.StreamHandler):
+    """File handler leaving flushes to its caller.
+
+    The file is opened on first use, and gzipped if asked to. A gzipped
+    file is only complete once closed; records written after that are
+    appended as a new gzip member.
+    """
+
+    def __init__(self, filename, compress=False):
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.compress = compress
+        self.stream = None
+        _FILE_HANDLERS.add(self)
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                if self.compress:
+                    self.stream = gzip.open(self.filename, 'at',
+                                            encoding='utf-8')
+                else:
+                    self.stream = open(self.filename, 'a', encoding='utf-8')
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        if self.stream is not None:
+            super(_BatchedFileHandler, self).flush()
+
+    def close_stream(self):
+        with self.lock:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+
+    def close(self):
+        self.close_stream()
+        logging.Handler.close(self)
+
+
+class _QueuedHandler(logging.Handler):
+    """Hands the records of an image logger over to the log writer.
+
+    Records are written synchronously when no log writer is running.
+    """
+
+    def __init__(self, target):
+        super(_QueuedHandler, self).__init__()
+        self.target = target
+
+    def prepare(self, record):
+        # NOTE: arguments and tracebacks may not outlive the call, render
+        # them now.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.target.formatter.formatException(
+                record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        writer = _LOG_WRITER
+        if writer is not None and writer.put(self.target,
+                                             self.prepare(record)):
+            return
+        self.target.handle(record)
+        self.target.flush()
+
+    def close(self):
+        if isinstance(self.target, _BatchedFileHandler):
+            self.target.close()
+        super(_QueuedHandler, self).close()
+
+
+class LogWriter(threading.Thread):
+    """Writes the logs of the images from a dedicated thread.
+
+    Build threads only queue their records. The writer takes them in
+    batches of whatever is queued and flushes each log once per batch,
+    so that chatty builds do not wait on disk or terminal I/O.
+    """
+
+    def __init__(self, batch_size=LOG_BATCH_SIZE):
+        super(LogWriter, self).__init__(name='log-writer', daemon=True)
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.stopping = False
+        self._lock = threading.Lock()
+
+    def put(self, handler, record):
+        """Queue a record, returning False if the writer is stopping."""
+        with self._lock:
+            if self.stopping:
+                return False
+            self.queue.put((handler, record))
+        return True
+
+    def run(self):
+        stop = False
+        while not stop:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            written = set()
+            for item in batch:
+                if item is None:
+                    stop = True
+                    continue
+                handler, record = item
+                handler.handle(record)
+                written.add(handler)
+            for handler in written:
+                handler.flush()
+
+    def stop(self):
+        """Write the queued records."""
+        with self._lock:
+            self.stopping = True
+            self.queue.put(None)
+        self.join()
+
+
+def start_log_writer():
+    """Write the logs of the images from a dedicated thread."""
+    global _LOG_WRITER
+    _LOG_WRITER = LogWriter()
+    _LOG_WRITER.start()
+    return _LOG_WRITER
+
+
+def close_log_files():
+    """Close the log files of the images, completing gzipped ones."""
+    for handler in list(_FILE_HANDLERS):
+        handler.close_stream()
+
+
+def stop_log_writer():
+    """Write the queued logs and go back to writing them synchronously.
+
+    The log files are closed, whether they were written by the writer or
+    synchronously.
+    """
+    global _LOG_WRITER
+    writer, _LOG_WRITER = _LOG_WRITER, None
+    if writer is not None:
+        writer.stop()
+    close_log_files()
 
 
 def make_a_logger(conf=None, image_name=None):
@@ -26,9 +199,17 @@ def make_a_logger(conf=None, image_name=None):
             handler = logging.StreamHandler(sys.stderr)
             log.propagate = False
         else:
-            filename = os.path.join(conf.logs_dir, "%s.log" % image_name)
-            handler = logging.FileHandler(filename, delay=True)
+            filename = os.path.join(
+                conf.logs_dir, log_filename(image_name, conf.logs_compress))
+            handler = _BatchedFileHandler(filename, conf.logs_compress)
         handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        if image_name:
+            handler = _QueuedHandler(handler)
+            if log.propagate:
+                # NOTE: the records are still shown on the console, through
+                # the log writer too.
+                log.propagate = False
+                log.addHandler(_QueuedHandler(make_a_logger().handlers[0]))
         log.addHandler(handler)
     if conf is not None and conf.debug:
         log.setLevel(logging.DEBUG)
@@ -41,35 +222,24 @@ def make_a_logger(conf=None, image_name=None):
 
 LOG = make_a_logger()
 
+# Functions memoized for the duration of a run, see run_cached().
+_RUN_CACHES = list()
+
+
+def run_cached(func):
+    """Memoize a function for the duration of a run.
+
+    Meant for template helpers and values computed from the configuration,
+    which do not change during a run. Results are keyed by the arguments of
+    the function, which must be hashable, and are dropped by
+    clear_run_caches().
+    """
+    cached = functools.lru_cache(maxsize=None)(func)
+    _RUN_CACHES.append(cached)
+    return cached
+
 
-def get_docker_squash_version():
-
-    try:
-        stdout = subprocess.check_output(  # nosec
-            ['docker-squash', '--version'], stderr=subprocess.STDOUT)
-        return stdout.split()[0]
-    except OSError as ex:
-        if ex.errno == 2:
-            LOG.error(('"docker-squash" command is not found.'
-                       ' try to install it by "pip install docker-squash"'))
-        raise
-
-
-def squash(old_image, new_image,
-           from_layer=None,
-           cleanup=False,
-           tmp_dir=None):
-
-    cmds = ['docker-squash', '--tag', new_image, old_image]
-    if cleanup:
-        cmds += ['--cleanup']
-    if from_layer:
-        cmds += ['--from-layer', from_layer]
-    if tmp_dir:
-        cmds += ['--tmp-dir', tmp_dir]
-    try:
-        subprocess.check_output(cmds, stderr=subprocess.STDOUT)  # nosec
-    except subprocess.CalledProcessError as ex:
-        LOG.exception('Get error during squashing image: %s',
-                      ex.output)
-        raise
+def clear_run_caches():
+    """Drop the results memoized by run_cached() functions."""
+    for cached in _RUN_CACHES:
+        cached.cache_clear()
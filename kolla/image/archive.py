@@ -0,0 +1,186 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import posixpath
+import tarfile
+
+from docker.utils import build as docker_build
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _member_path(prefix, name):
+    """Return the name of a member under prefix, or None if it escapes."""
+    name = posixpath.normpath(name.lstrip('/'))
+    if name == '.':
+        return prefix
+    if name == '..' or name.startswith('../'):
+        return None
+    return posixpath.join(prefix, name)
+
+
+def normalize(info):
+    """Strip the metadata of an archive member which depends on the host.
+
+    Ownership is reset to root and modification times to the epoch. Modes,
+    including the setuid, setgid and sticky bits, are part of the content
+    of the files and are kept.
+    """
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mtime = 0
+    info.mode &= 0o7777
+    info.pax_headers = dict()
+    return info
+
+
+class ArchiveWriter(object):
+    """Writes reproducible tar archives.
+
+    The same input always produces the same archive bytes: members are
+    normalized, and trees are added in sorted order. This keeps the layer
+    cache of Docker valid across runs and build hosts.
+    """
+
+    def __init__(self, name=None, fileobj=None):
+        self.tar = tarfile.open(name, 'w', fileobj=fileobj,
+                                format=tarfile.PAX_FORMAT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.tar.close()
+
+    def add_member(self, info, fileobj=None):
+        self.tar.addfile(normalize(info), fileobj)
+
+    def add_directory(self, name):
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.DIRTYPE
+        self.add_member(info)
+
+    def add(self, path, arcname, include=None):
+        """Add a file or directory tree, in sorted order.
+
+        :param include: the names of the members of the tree to add, None to
+                        add all of them
+        """
+        if include is not None and arcname not in include:
+            return
+        info = self.tar.gettarinfo(path, arcname)
+        if info is None:
+            LOG.debug('Not archiving unsupported file %s', path)
+            return
+        if info.isreg():
+            with open(path, 'rb') as f:
+                self.add_member(info, f)
+        else:
+            self.add_member(info)
+        if info.isdir():
+            self.add_contents(path, arcname, include)
+
+    def add_contents(self, path, arcname='', include=None):
+        """Add the contents of a directory, without the directory itself."""
+        for name in sorted(os.listdir(path)):
+            self.add(os.path.join(path, name), posixpath.join(arcname, name),
+                     include)
+
+
+def context_members(path):
+    """List the members of a build context which .dockerignore keeps.
+
+    Docker applies the .dockerignore file of a context only when it builds
+    the archive of the context itself, which it does not for contexts sent
+    as archives.
+
+    :return: the names of the members to archive, None if the context has
+             no .dockerignore file
+    """
+    dockerignore = os.path.join(path, '.dockerignore')
+    if not os.path.exists(dockerignore):
+        return None
+    with open(dockerignore) as f:
+        patterns = [line.strip() for line in f.read().splitlines()
+                    if line.strip() and not line.strip().startswith('#')]
+    members = set()
+    for name in docker_build.exclude_paths(path, patterns):
+        name = name.replace(os.sep, '/')
+        # NOTE: parents of files excepted from an excluded directory are
+        # kept, as Docker would create them.
+        while name and name not in members:
+            members.add(name)
+            name = posixpath.dirname(name)
+    return members
+
+
+def merge_archives(archives, dest, prefix):
+    """Merge the members of archives into a single archive under prefix.
+
+    Members are streamed from the source archives into dest, without
+    extracting them to disk, in the order of the source archives and
+    normalized like any other archive written by an ArchiveWriter. Parent
+    directories which are not part of the source archives are added, as
+    extracting them would have created them.
+
+    :return: the number of distinct top-level entries under prefix
+    """
+    top_level = set()
+    directories = {prefix}
+    with ArchiveWriter(dest) as out:
+        out.add_directory(prefix)
+        for archive in archives:
+            with tarfile.open(archive, 'r') as tar:
+                for member in tar:
+                    name = _member_path(prefix, member.name)
+                    if name is None:
+                        raise ArchiveError('Member %s of %s is outside of the'
+                                           ' archive' % (member.name,
+                                                         archive))
+                    if name == prefix:
+                        continue
+                    parent = posixpath.dirname(name)
+                    missing = list()
+                    while parent not in directories:
+                        missing.append(parent)
+                        parent = posixpath.dirname(parent)
+                    for directory in reversed(missing):
+                        out.add_directory(directory)
+                        directories.add(directory)
+                    top_level.add(name[len(prefix) + 1:].split('/', 1)[0])
+
+                    member.name = name
+                    if member.islnk():
+                        linkname = _member_path(prefix, member.linkname)
+                        if linkname is None:
+                            raise ArchiveError('Hard link %s of %s is outside'
+                                               ' of the archive' %
+                                               (member.linkname, archive))
+                        member.linkname = linkname
+                    if member.isdir():
+                        directories.add(name)
+                    if member.isreg():
+                        out.add_member(member, tar.extractfile(member))
+                    else:
+                        out.add_member(member)
+    return len(top_level)
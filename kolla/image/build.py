@@ -12,15 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import concurrent.futures
 import contextlib
 import datetime
-import errno
+import hashlib
+import itertools
 import json
 import logging
 import os
 import queue
 import re
-import requests
 import shutil
 import sys
 import tarfile
@@ -31,7 +33,6 @@ import time
 from distutils.version import StrictVersion
 import docker
 from enum import Enum
-import git
 import jinja2
 from oslo_config import cfg
 from requests import exceptions as requests_exc
@@ -49,6 +50,19 @@ from kolla.common import config as common_config  # noqa
 from kolla.common import task  # noqa
 from kolla.common import utils  # noqa
 from kolla import exception  # noqa
+from kolla.image import archive  # noqa
+from kolla.image import docker_client  # noqa
+from kolla.image import graph as image_graph  # noqa
+from kolla.image import history  # noqa
+from kolla.image import impact  # noqa
+from kolla.image import metrics  # noqa
+from kolla.image import push  # noqa
+from kolla.image import registry as docker_registry  # noqa
+from kolla.image import sources  # noqa
+from kolla.image import squash  # noqa
+from kolla.image import steps as build_steps  # noqa
+from kolla.image import trace  # noqa
+from kolla.template import cache as jinja_cache  # noqa
 from kolla.template import filters as jinja_filters  # noqa
 from kolla.template import methods as jinja_methods  # noqa
 from kolla import version  # noqa
@@ -152,6 +166,18 @@ UNBUILDABLE_IMAGES = {
     },
 }
 
+# Label holding the hash of all the inputs an image was built from.
+CONTENT_HASH_LABEL = 'kolla_content_hash'
+
+# Interval in seconds between two estimations of the remaining build time.
+ETA_INTERVAL = 60
+
+# Parent image named in the FROM line of a Dockerfile.j2 template.
+TEMPLATE_PARENT_RE = re.compile(
+    r'^FROM\s+{{\s*namespace\s*}}/{{\s*(?:infra_)?image_prefix\s*}}'
+    r'([\w.-]+):{{\s*tag\s*}}\s*$', re.MULTILINE)
+TEMPLATE_FROM_RE = re.compile(r'^FROM\s+(.*)$', re.MULTILINE)
+
 # NOTE(hrw): all non-infra images and their children
 BINARY_SOURCE_IMAGES = [
     'kolla-toolbox',
@@ -189,6 +215,9 @@ class DockerTask(task.Task):
 
     docker_kwargs = docker.utils.kwargs_from_env()
 
+    #: Pool of Docker clients shared by the tasks of a run, if any.
+    client_pool = None
+
     def __init__(self):
         super(DockerTask, self).__init__()
         self._dc = None
@@ -197,10 +226,20 @@ class DockerTask(task.Task):
     def dc(self):
         if self._dc is not None:
             return self._dc
+        if self.client_pool is not None:
+            self._dc = self.client_pool.get()
+            return self._dc
         docker_kwargs = self.docker_kwargs.copy()
         self._dc = docker.APIClient(version='auto', **docker_kwargs)
         return self._dc
 
+    def reset(self):
+        super(DockerTask, self).reset()
+        # NOTE: check the connection to Docker before retrying
+        if self._dc is not None and self.client_pool is not None:
+            self.client_pool.report_failure()
+        self._dc = None
+
 
 class Image(object):
     def __init__(self, name, canonical_name, path, parent_name='',
@@ -220,6 +259,15 @@ class Image(object):
         self.plugins = []
         self.additions = []
         self.dc = docker_client
+        self.priority = 0
+        self.start = None
+        # Seconds spent in each phase of the build and push of the image.
+        self.timings = dict()
+        # Retries, build steps and downloaded bytes of the image.
+        self.counters = dict()
+        self._counters_lock = threading.Lock()
+        # Steps of the Dockerfile, as reported by the last build.
+        self.build_steps = []
 
     def copy(self):
         c = Image(self.name, self.canonical_name, self.path,
@@ -235,8 +283,27 @@ class Image(object):
             c.additions = list(self.additions)
         return c
 
-    def in_docker_cache(self):
-        return len(self.dc.images(name=self.canonical_name, quiet=True)) == 1
+    def count(self, counter, value=1):
+        with self._counters_lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_timing(self, phase, duration):
+        self.timings[phase] = self.timings.get(phase, 0) + duration
+
+    def end_phase(self, phase, start):
+        """Account for a phase of the image, started at a monotonic time."""
+        end = time.monotonic()
+        self.add_timing(phase, end - start)
+        trace.complete(phase, 'phase', start, end, image=self.name)
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Add the time spent in the block to a phase of the image."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.end_phase(phase, start)
 
     def __repr__(self):
         return ("Image(%s, %s, %s, parent_name=%s,"
@@ -257,7 +324,14 @@ class PushIntoQueueTask(task.Task):
     def name(self):
         return 'PushIntoQueueTask(%s)' % (self.push_task.name)
 
+    @property
+    def priority(self):
+        # NOTE: handing the image over to the push workers is instantaneous,
+        # so never keep it waiting behind a build.
+        return float('inf')
+
     def run(self):
+        self.push_task.flow_id = trace.flow_start('pushes')
         self.push_queue.put(self.push_task)
         self.success = True
 
@@ -270,11 +344,17 @@ class PushError(Exception):
 class PushTask(DockerTask):
     """Task that pushes an image to a docker repository."""
 
-    def __init__(self, conf, image):
+    kind = 'push'
+
+    def __init__(self, conf, image, history=None, pipeline=None):
         super(PushTask, self).__init__()
         self.conf = conf
         self.image = image
         self.logger = image.logger
+        self.history = history
+        self.pipeline = pipeline
+        if pipeline is not None:
+            pipeline.register(image)
 
     @property
     def name(self):
@@ -283,8 +363,16 @@ class PushTask(DockerTask):
     def run(self):
         image = self.image
         self.logger.info('Trying to push the image')
+        start = time.time()
         try:
-            self.push_image(image)
+            if self.pipeline is not None:
+                with image.timed('push_queue'):
+                    self.pipeline.wait_for_parent(image)
+                start = time.time()
+            with image.timed('push'):
+                if self.pipeline is not None:
+                    self.pipeline.mount_parent_layers(image)
+                self.push_image(image)
         except requests_exc.ConnectionError:
             self.logger.exception('Make sure Docker is running and that you'
                                   ' have the correct privileges to run Docker'
@@ -301,8 +389,12 @@ class PushTask(DockerTask):
                     image.status != Status.UNPROCESSED):
                 self.logger.info('Pushed successfully')
                 self.success = True
+                if self.history is not None:
+                    self.history.record_push(image.name, time.time() - start)
             else:
                 self.success = False
+            if self.pipeline is not None:
+                self.pipeline.done(image)
 
     def push_image(self, image):
         kwargs = dict(stream=True, decode=True)
@@ -313,11 +405,15 @@ class PushTask(DockerTask):
         if dc_running_ver < StrictVersion('3.0.0'):
             kwargs['insecure_registry'] = True
 
+        progress = push.PushProgress()
         for response in self.dc.push(image.canonical_name, **kwargs):
             if 'stream' in response:
                 self.logger.info(response['stream'])
             elif 'errorDetail' in response:
                 raise PushError(response['errorDetail']['message'])
+            else:
+                progress.update(response)
+        self.logger.info('Pushed %s', progress)
 
         # Reset any previous errors.
         image.status = Status.BUILT
@@ -326,18 +422,32 @@ class PushTask(DockerTask):
 class BuildTask(DockerTask):
     """Task that builds out an image."""
 
-    def __init__(self, conf, image, push_queue):
+    kind = 'build'
+
+    def __init__(self, conf, image, push_queue, history=None,
+                 prefetcher=None, push_pipeline=None):
         super(BuildTask, self).__init__()
         self.conf = conf
         self.image = image
         self.push_queue = push_queue
         self.forcerm = not conf.keep
         self.logger = image.logger
+        self.history = history
+        self.prefetcher = prefetcher
+        self.push_pipeline = push_pipeline
+        self.download_cache = None
+        if conf.source_cache_dir:
+            self.download_cache = sources.DownloadCache(
+                conf.source_cache_dir, conf.source_cache_size * 1024 * 1024)
 
     @property
     def name(self):
         return 'BuildTask(%s)' % self.image.name
 
+    @property
+    def priority(self):
+        return self.image.priority
+
     def run(self):
         self.builder(self.image)
         if self.image.status in (Status.BUILT, Status.SKIPPED):
@@ -351,7 +461,8 @@ class BuildTask(DockerTask):
                 # If we are supposed to push the image into a docker
                 # repository, then make sure we do that...
                 PushIntoQueueTask(
-                    PushTask(self.conf, self.image),
+                    PushTask(self.conf, self.image, history=self.history,
+                             pipeline=self.push_pipeline),
                     self.push_queue),
             ])
         if self.image.children and self.success:
@@ -359,16 +470,46 @@ class BuildTask(DockerTask):
                 if image.status in (Status.UNMATCHED, Status.SKIPPED,
                                     Status.UNBUILDABLE):
                     continue
-                followups.append(BuildTask(self.conf, image, self.push_queue))
+                followups.append(BuildTask(
+                    self.conf, image, self.push_queue, history=self.history,
+                    prefetcher=self.prefetcher,
+                    push_pipeline=self.push_pipeline))
         return followups
 
     def process_source(self, image, source):
+        with image.timed('fetch'):
+            return self._process_source(image, source)
+
+    def _process_source(self, image, source):
+        if self.prefetcher is not None:
+            dest_archive = self.prefetcher.wait(image, source)
+            if dest_archive is not None:
+                return dest_archive
+
         dest_archive = os.path.join(image.path, source['name'] + '-archive')
 
-        if source.get('type') == 'url':
+        if source.get('type') == 'url' and self.download_cache is not None:
             self.logger.debug("Getting archive from %s", source['source'])
             try:
-                r = requests.get(source['source'], timeout=self.conf.timeout)
+                image.count('download_bytes', self.download_cache.fetch(
+                    source['source'], dest_archive, self.conf.timeout,
+                    self.logger))
+            except requests_exc.RequestException:
+                self.logger.exception(
+                    'Request failed while getting archive from %s',
+                    source['source'])
+                image.status = Status.ERROR
+                return
+            except sources.DownloadError as e:
+                self.logger.error(e)
+                image.status = Status.ERROR
+                return
+
+        elif source.get('type') == 'url':
+            self.logger.debug("Getting archive from %s", source['source'])
+            try:
+                r, digest = sources.download(source['source'], dest_archive,
+                                             self.conf.timeout)
             except requests_exc.Timeout:
                 self.logger.exception(
                     'Request timed out while getting archive from %s',
@@ -377,8 +518,9 @@ class BuildTask(DockerTask):
                 return
 
             if r.status_code == 200:
-                with open(dest_archive, 'wb') as f:
-                    f.write(r.content)
+                self.logger.debug("Downloaded %s (sha256 %s)",
+                                  source['source'], digest)
+                image.count('download_bytes', os.path.getsize(dest_archive))
             else:
                 self.logger.error(
                     'Failed to download archive: status_code %s',
@@ -387,38 +529,42 @@ class BuildTask(DockerTask):
                 return
 
         elif source.get('type') == 'git':
-            clone_dir = '{}-{}'.format(dest_archive,
-                                       source['reference'].replace('/', '-'))
-            if os.path.exists(clone_dir):
-                self.logger.info("Clone dir %s exists. Removing it.",
-                                 clone_dir)
-                shutil.rmtree(clone_dir)
+            arcname = '{}-{}'.format(os.path.basename(dest_archive),
+                                     source['reference'].replace('/', '-'))
+            if self.conf.source_cache_dir:
+                mirror = sources.GitMirror(self.conf.source_cache_dir,
+                                           source['source'])
+            else:
+                # NOTE: without a cache, the mirror only lives for this build
+                mirror = sources.GitMirror(
+                    dest_archive + '-mirror', source['source'])
 
             try:
-                self.logger.debug("Cloning from %s", source['source'])
-                git.Git().clone(source['source'], clone_dir)
-                git.Git(clone_dir).checkout(source['reference'])
-                reference_sha = git.Git(clone_dir).rev_parse('HEAD')
-                self.logger.debug("Git checkout by reference %s (%s)",
+                self.logger.debug("Getting %s from %s", source['reference'],
+                                  source['source'])
+                reference_sha = mirror.update(source['reference'],
+                                              self.logger)
+                self.logger.debug("Git archive by reference %s (%s)",
                                   source['reference'], reference_sha)
+                mirror.archive(reference_sha, dest_archive, arcname)
             except Exception as e:
-                self.logger.error("Failed to get source from git", image.name)
+                self.logger.error("Failed to get source from git for %s",
+                                  image.name)
                 self.logger.error("Error: %s", e)
-                # clean-up clone folder to retry
-                shutil.rmtree(clone_dir)
                 image.status = Status.ERROR
                 return
-
-            with tarfile.open(dest_archive, 'w') as tar:
-                tar.add(clone_dir, arcname=os.path.basename(clone_dir))
+            finally:
+                if not self.conf.source_cache_dir:
+                    shutil.rmtree(dest_archive + '-mirror',
+                                  ignore_errors=True)
 
         elif source.get('type') == 'local':
             self.logger.debug("Getting local archive from %s",
                               source['source'])
             if os.path.isdir(source['source']):
-                with tarfile.open(dest_archive, 'w') as tar:
-                    tar.add(source['source'],
-                            arcname=os.path.basename(source['source']))
+                with archive.ArchiveWriter(dest_archive) as writer:
+                    writer.add(source['source'],
+                               os.path.basename(source['source']))
             else:
                 shutil.copyfile(source['source'], dest_archive)
 
@@ -449,39 +595,117 @@ class BuildTask(DockerTask):
             return None
         return buildargs
 
+    def _parent_id(self, image):
+        if image.parent is not None:
+            return self.dc.inspect_image(image.parent.canonical_name)['Id']
+        # NOTE: the distro image of the base image is referenced directly;
+        # use the copy available locally, if any.
+        try:
+            return self.dc.inspect_image(image.parent_name)['Id']
+        except docker.errors.NotFound:
+            return image.parent_name or ''
+
+    def pull_parent(self, image):
+        """Pull the distro image the base image is built from."""
+        self.logger.info('Pulling %s', image.parent_name)
+        for response in self.dc.pull(image.parent_name, stream=True,
+                                     decode=True):
+            if 'errorDetail' in response:
+                raise docker.errors.APIError(
+                    response['errorDetail']['message'])
+
+    def content_hash(self, image, buildargs):
+        """Hash all the inputs an image is built from.
+
+        This covers the rendered Dockerfile, every file of the build context
+        (including the source, plugins and additions archives), the build
+        arguments and the ID of the parent image.
+        """
+        digest = hashlib.sha256()
+        digest.update(self._parent_id(image).encode())
+        digest.update(json.dumps(buildargs, sort_keys=True).encode())
+        for root, dirs, files in os.walk(image.path):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                relpath = os.path.relpath(path, image.path)
+                digest.update(b'\0' + relpath.encode() + b'\0')
+                if os.path.islink(path):
+                    digest.update(b'l' + os.readlink(path).encode())
+                    continue
+                digest.update(b'x' if os.access(path, os.X_OK) else b'f')
+                if relpath == 'Dockerfile':
+                    # NOTE: the build date label changes every day without
+                    # the image content changing.
+                    with open(path) as f:
+                        content = re.sub(r'build-date="[^"]*"', '',
+                                         f.read())
+                    digest.update(content.encode())
+                    continue
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                        digest.update(chunk)
+        return digest.hexdigest()
+
+    def is_unchanged(self, image, content_hash):
+        """Check for an image built from the same inputs.
+
+        The image is looked up in the docker cache, then in the registry.
+        An image found in the registry only is pulled, so that it can be
+        used to build child images and pushed again.
+        """
+        try:
+            labels = self.dc.inspect_image(
+                image.canonical_name)['Config']['Labels'] or {}
+        except docker.errors.NotFound:
+            labels = {}
+        if labels.get(CONTENT_HASH_LABEL) == content_hash:
+            self.logger.info('Image with content hash %s found in the'
+                             ' docker cache', content_hash)
+            return True
+
+        if not self.conf.registry:
+            return False
+        registry, repository, tag = docker_registry.split_image_name(
+            image.canonical_name, self.conf.registry)
+        try:
+            client = docker_registry.get_client(registry, self.conf.timeout)
+            labels = client.get_labels(repository, tag) or {}
+        except (docker_registry.RegistryError,
+                requests_exc.RequestException) as e:
+            self.logger.warning('Unable to check the registry for %s: %s',
+                                image.canonical_name, e)
+            return False
+        if labels.get(CONTENT_HASH_LABEL) != content_hash:
+            return False
+        self.logger.info('Image with content hash %s found in the registry,'
+                         ' pulling it', content_hash)
+        for response in self.dc.pull(image.canonical_name, stream=True,
+                                     decode=True):
+            if 'errorDetail' in response:
+                self.logger.warning('Failed to pull %s: %s',
+                                    image.canonical_name,
+                                    response['errorDetail']['message'])
+                return False
+        return True
+
     def builder(self, image):
 
-        def make_an_archive(items, arcname, item_child_path=None):
-            if not item_child_path:
-                item_child_path = arcname
+        def make_an_archive(items, arcname):
             archives = list()
-            items_path = os.path.join(image.path, item_child_path)
             for item in items:
                 archive_path = self.process_source(image, item)
                 if image.status in STATUS_ERRORS:
                     raise ArchivingError
                 archives.append(archive_path)
-            if archives:
-                for archive in archives:
-                    with tarfile.open(archive, 'r') as archive_tar:
-                        archive_tar.extractall(path=items_path)
-            else:
-                try:
-                    os.mkdir(items_path)
-                except OSError as e:
-                    if e.errno == errno.EEXIST:
-                        self.logger.info(
-                            'Directory %s already exist. Skipping.',
-                            items_path)
-                    else:
-                        self.logger.error('Failed to create directory %s: %s',
-                                          items_path, e)
-                        image.status = Status.CONNECTION_ERROR
-                        raise ArchivingError
             arc_path = os.path.join(image.path, '%s-archive' % arcname)
-            with tarfile.open(arc_path, 'w') as tar:
-                tar.add(items_path, arcname=arcname)
-            return len(os.listdir(items_path))
+            try:
+                with image.timed('archive'):
+                    return archive.merge_archives(archives, arc_path, arcname)
+            except (archive.ArchiveError, tarfile.TarError, OSError) as e:
+                self.logger.error('Failed to create %s: %s', arc_path, e)
+                image.status = Status.ERROR
+                raise ArchivingError
 
         self.logger.debug('Processing')
 
@@ -499,8 +723,10 @@ class BuildTask(DockerTask):
             image.status = Status.PARENT_ERROR
             return
 
-        image.status = Status.BUILDING
+        # NOTE: the estimate of the remaining time reads the start of the
+        # images being built from another thread.
         image.start = datetime.datetime.now()
+        image.status = Status.BUILDING
         self.logger.info('Building started at %s' % image.start)
 
         if image.source and 'source' in image.source:
@@ -534,8 +760,31 @@ class BuildTask(DockerTask):
         pull = self.conf.pull if image.parent is None else False
 
         buildargs = self.update_buildargs()
+        build_kwargs = dict()
+        if self.conf.skip_unchanged:
+            try:
+                if pull and image.parent_name:
+                    # NOTE: the hash covers the distro image, which must be
+                    # up to date for a new upstream image to be noticed.
+                    self.pull_parent(image)
+                content_hash = self.content_hash(image, buildargs)
+                if self.is_unchanged(image, content_hash):
+                    image.status = Status.SKIPPED
+                    self.logger.info('Skipping unchanged image')
+                    return
+            except (docker.errors.DockerException, OSError):
+                image.status = Status.ERROR
+                self.logger.exception('Failed to check for unchanged image')
+                return
+            build_kwargs['labels'] = {CONTENT_HASH_LABEL: content_hash}
+
+        parser = build_steps.BuildStepParser()
+        context = None
+        build_start = time.monotonic()
         try:
-            for stream in self.dc.build(path=image.path,
+            context = self.build_context(image)
+            for stream in self.dc.build(fileobj=context,
+                                        custom_context=True,
                                         tag=image.canonical_name,
                                         nocache=not self.conf.cache,
                                         rm=True,
@@ -543,11 +792,13 @@ class BuildTask(DockerTask):
                                         network_mode=self.conf.network_mode,
                                         pull=pull,
                                         forcerm=self.forcerm,
-                                        buildargs=buildargs):
+                                        buildargs=buildargs,
+                                        **build_kwargs):
                 if 'stream' in stream:
                     for line in stream['stream'].split('\n'):
                         if line:
                             self.logger.info('%s', line)
+                        parser.feed(line)
                 if 'errorDetail' in stream:
                     image.status = Status.ERROR
                     self.logger.error('Error\'d with the following message')
@@ -556,8 +807,11 @@ class BuildTask(DockerTask):
                             self.logger.error('%s', line)
                     return
 
+            image.end_phase('build', build_start)
+            build_start = None
             if image.status != Status.ERROR and self.conf.squash:
-                self.squash()
+                with image.timed('squash'):
+                    self.squash()
         except docker.errors.DockerException:
             image.status = Status.ERROR
             self.logger.exception('Unknown docker error when building')
@@ -569,62 +823,340 @@ class BuildTask(DockerTask):
             now = datetime.datetime.now()
             self.logger.info('Built at %s (took %s)' %
                              (now, now - image.start))
+            if self.history is not None:
+                summary = build_steps.summarize(parser.steps)
+                self.history.record_build(
+                    image.name, (now - image.start).total_seconds(),
+                    cached_steps=summary['cached_steps'],
+                    steps=summary['steps'])
+        finally:
+            if build_start is not None:
+                image.end_phase('build', build_start)
+            parser.close()
+            image.build_steps = parser.steps
+            image.count('steps', len(parser.steps))
+            image.count('cached_steps',
+                        sum(1 for step in parser.steps if step.cached))
+            if self.conf.cache:
+                miss = build_steps.first_miss(parser.steps)
+                if miss is not None:
+                    self.logger.info('Layer cache invalidated at step %d: %s',
+                                     miss.number, miss.instruction)
+            if context is not None:
+                context.close()
+
+    def build_context(self, image):
+        """Archive the build context of an image into a temporary file.
+
+        The archive is reproducible, as the ownership and modification times
+        of the files of the context are part of the keys of the layer cache
+        of Docker. Files excluded by the .dockerignore file of the image are
+        left out, as Docker would.
+        """
+        context = tempfile.TemporaryFile()
+        try:
+            with archive.ArchiveWriter(fileobj=context) as writer:
+                writer.add_contents(
+                    image.path, include=archive.context_members(image.path))
+        except BaseException:
+            context.close()
+            raise
+        context.seek(0)
+        return context
 
     def squash(self):
-        image_tag = self.image.canonical_name
-        image_id = self.dc.inspect_image(image_tag)['Id']
+        image = self.image
+        result = squash.squash_image(self.dc, image.canonical_name,
+                                     image.parent_name,
+                                     cleanup=self.conf.squash_cleanup,
+                                     tmp_dir=self.conf.squash_tmp_dir)
+        self.logger.info('Image is squashed successfully: %d layers merged,'
+                         ' %d bytes saved', result.layers, result.saved_bytes)
 
-        parent_history = self.dc.history(self.image.parent_name)
-        parent_last_layer = parent_history[0]['Id']
-        self.logger.info('Parent lastest layer is: %s' % parent_last_layer)
 
-        utils.squash(image_id, image_tag, from_layer=parent_last_layer,
-                     cleanup=self.conf.squash_cleanup,
-                     tmp_dir=self.conf.squash_tmp_dir)
-        self.logger.info('Image is squashed successfully')
+class SourcePrefetcher(object):
+    """Downloads the sources of images ahead of their build.
 
+    Sources, plugins and additions of all the images to build are fetched
+    concurrently by a pool of threads, in the order the images are expected
+    to be built. A build waits for the prefetch of its sources, and fetches
+    them itself if the prefetch failed.
+    """
 
-class WorkerThread(threading.Thread):
-    """Thread that executes tasks until the queue provides a tombstone."""
+    def __init__(self, conf, threads):
+        self.conf = conf
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='prefetch')
+        self.futures = dict()
 
-    #: Object to be put on worker queues to get them to die.
-    tombstone = object()
+    @staticmethod
+    def image_sources(image):
+        image_sources = list()
+        if image.source and 'source' in image.source:
+            image_sources.append(image.source)
+        image_sources.extend(image.plugins)
+        image_sources.extend(image.additions)
+        return [source for source in image_sources
+                if source.get('type') in ('url', 'git')]
+
+    def _fetch(self, image, source):
+        """Fetch a source, returning its archive and the bytes downloaded."""
+        # NOTE: fetch on behalf of a copy, so that a failure does not mark
+        # the image to build as failed.
+        scratch = image.copy()
+        archive_path = BuildTask(self.conf, scratch, None).process_source(
+            scratch, source)
+        return archive_path, scratch.counters.get('download_bytes', 0)
+
+    def start(self, images):
+        if self.conf.install_type != 'source':
+            return
+        images = sorted((image for image in images
+                         if image.status == Status.MATCHED),
+                        key=lambda image: image.priority, reverse=True)
+        for image in images:
+            for source in self.image_sources(image):
+                key = (image.name, source['name'])
+                self.futures[key] = self.executor.submit(self._fetch, image,
+                                                         source)
+        LOG.info('Prefetching %d sources', len(self.futures))
+
+    def wait(self, image, source):
+        """Wait for the prefetch of a source.
+
+        :return: the path of the archive, or None if the source was not or
+                 could not be prefetched
+        """
+        future = self.futures.get((image.name, source.get('name')))
+        if future is None:
+            return None
+        try:
+            archive_path, download_bytes = future.result()
+        except Exception:
+            image.logger.exception('Failed to prefetch %s', source['name'])
+            return None
+        # NOTE: the bytes of a failed prefetch are downloaded again by the
+        # build, only count those of the archives used.
+        if archive_path is not None:
+            image.count('download_bytes', download_bytes)
+        return archive_path
+
+    def shutdown(self):
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+
+class TaskQueue(queue.PriorityQueue):
+    """Queue handing out the task with the highest priority first.
 
-    def __init__(self, conf, queue):
-        super(WorkerThread, self).__init__()
+    Tasks of equal priority are handed out in the order they were put. Once
+    the queue is closed, getting from an empty queue returns None instead of
+    blocking.
+    """
+
+    def __init__(self, maxsize=0):
+        super(TaskQueue, self).__init__(maxsize)
+        self._counter = itertools.count()
+        self.closed = False
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            self.not_empty.notify_all()
+
+    def get(self):
+        with self.not_empty:
+            while not self._qsize():
+                if self.closed:
+                    return None
+                self.not_empty.wait()
+            task = self._get()
+            self.not_full.notify()
+            return task
+
+    def _put(self, task):
+        priority = getattr(task, 'priority', 0)
+        super(TaskQueue, self)._put((-priority, next(self._counter),
+                                     time.monotonic(), task))
+
+    def _get(self):
+        _, _, queued, task = super(TaskQueue, self)._get()
+        # NOTE: remember how long the task waited for a worker
+        task.queue_wait = time.monotonic() - queued
+        return task
+
+
+class BuildCoordinator(object):
+    """Tracks the completion of tasks across the build and push queues.
+
+    Worker threads report every task they complete, which wakes up the
+    thread waiting on the coordinator.
+    """
+
+    def __init__(self, queues):
+        self.queues = queues
+        self.condition = threading.Condition()
+        self.completed = collections.deque()
+
+    def task_done(self, task):
+        with self.condition:
+            self.completed.append(task)
+            self.condition.notify_all()
+
+    def finished(self):
+        # NOTE: follow-up tasks are put into a queue before the task which
+        # created them is marked as done, so there is no window in which all
+        # queues look idle while work is still to come.
+        return not any(q.unfinished_tasks for q in self.queues)
+
+    def wait(self, timeout=None):
+        """Wait until tasks complete or all the work is finished.
+
+        :param timeout: seconds after which to give up waiting, None to wait
+                        for as long as it takes
+        :return: the list of tasks completed since the previous call, empty
+                 if the wait timed out
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: self.completed or self.finished(), timeout)
+            completed = list(self.completed)
+            self.completed.clear()
+        return completed
+
+
+class WorkerThread(threading.Thread):
+    """Thread that executes tasks until its queue is closed."""
+
+    def __init__(self, conf, queue, coordinator=None, name=None):
+        super(WorkerThread, self).__init__(name=name)
         self.queue = queue
         self.conf = conf
+        self.coordinator = coordinator
         self.should_stop = False
 
     def run(self):
+        try:
+            self._run()
+        finally:
+            # NOTE: give the Docker client of the thread back to the pool
+            if DockerTask.client_pool is not None:
+                DockerTask.client_pool.release()
+
+    def _run(self):
         while not self.should_stop:
             task = self.queue.get()
-            if task is self.tombstone:
-                # Ensure any other threads also get the tombstone.
-                self.queue.put(task)
+            if task is None:
                 break
+            kind = getattr(task, 'kind', None)
+            if kind is not None:
+                task.image.add_timing('%s_queue' % kind, task.queue_wait)
             try:
-                for attempt in range(self.conf.retries + 1):
-                    if self.should_stop:
-                        break
-                    LOG.info("Attempt number: %s to run task: %s ",
-                             attempt + 1, task.name)
-                    try:
-                        task.run()
-                        if task.success:
-                            break
-                    except Exception:
-                        LOG.exception('Unhandled error when running %s',
-                                      task.name)
-                    # try again...
-                    task.reset()
-                if task.success and not self.should_stop:
-                    for next_task in task.followups:
-                        LOG.info('Added next task %s to queue',
-                                 next_task.name)
-                        self.queue.put(next_task)
+                with trace.span(task.name, 'task') as start:
+                    trace.flow_end('unblocks', getattr(task, 'flow_id', None),
+                                   start)
+                    self.run_task(task)
             finally:
                 self.queue.task_done()
+                if self.coordinator is not None:
+                    self.coordinator.task_done(task)
+
+    def run_task(self, task):
+        """Run a task, retrying it on failure, and queue its followups."""
+        for attempt in range(self.conf.retries + 1):
+            if self.should_stop:
+                break
+            LOG.info("Attempt number: %s to run task: %s ",
+                     attempt + 1, task.name)
+            if attempt and getattr(task, 'kind', None) is not None:
+                task.image.count('%s_retries' % task.kind)
+            try:
+                task.run()
+                if task.success:
+                    break
+            except Exception:
+                LOG.exception('Unhandled error when running %s', task.name)
+            # try again...
+            task.reset()
+        if task.success and not self.should_stop:
+            for next_task in task.followups:
+                LOG.info('Added next task %s to queue', next_task.name)
+                next_task.flow_id = trace.flow_start('unblocks')
+                self.queue.put(next_task)
+
+
+class DockerfileRenderer(object):
+    """Renders the Dockerfiles of images from their templates.
+
+    One Jinja environment is shared by all the images, so that common
+    templates such as macros.j2 are only compiled once. Template overrides
+    are compiled once, and extend the template of each image.
+    """
+
+    def __init__(self, working_dir, values, filters, methods,
+                 template_cache_dir=None, overrides=None):
+        self.working_dir = working_dir
+        self.values = values
+        self.filters = filters
+        self.methods = methods
+        self.template_cache_dir = template_cache_dir
+        self.env = self._get_environment(
+            jinja2.FileSystemLoader(working_dir))
+        self.override_template = None
+        if overrides:
+            override_env = self._get_environment(jinja2.DictLoader(overrides))
+            self.override_template = override_env.get_template(
+                os.path.basename(list(overrides.keys())[0]))
+
+    def _get_environment(self, loader):
+        bytecode_cache = None
+        if self.template_cache_dir:
+            os.makedirs(self.template_cache_dir, exist_ok=True)
+            bytecode_cache = jinja_cache.TemplateBytecodeCache(
+                self.template_cache_dir)
+        env = jinja2.Environment(  # nosec: not used to render HTML
+            loader=loader, bytecode_cache=bytecode_cache)
+        env.filters.update(self.filters)
+        env.globals.update(self.methods)
+        return env
+
+    def render(self, path):
+        template_name = "Dockerfile.j2"
+        image_name = path.split("/")[-1]
+        values = dict(self.values, image_name=image_name)
+        tpl_path = os.path.join(
+            os.path.relpath(path, self.working_dir),
+            template_name)
+
+        template = self.env.get_template(tpl_path)
+        if self.override_template is not None:
+            values['parent_template'] = template
+            template = self.override_template
+        content = template.render(values, env=os.environ)
+        content_path = os.path.join(path, 'Dockerfile')
+        with open(content_path, 'w') as f:
+            LOG.debug("Rendered %s into:", tpl_path)
+            LOG.debug(content)
+            f.write(content)
+            LOG.debug("Wrote it to %s", content_path)
+
+
+# Renderer of the processes rendering Dockerfiles in a pool.
+_renderer = None
+
+
+def _init_renderer(*args):
+    global _renderer
+    _renderer = DockerfileRenderer(*args)
+
+
+def _render_dockerfile(path):
+    try:
+        _renderer.render(path)
+    except Exception as e:
+        return path, '%s: %s' % (type(e).__name__, e)
+    return path, None
 
 
 class KollaWorker(object):
@@ -649,6 +1181,7 @@ class KollaWorker(object):
         elif self.base_arch == 'x86_64':
             self.debian_arch = 'amd64'
         self.images = list()
+        self.graph = None
         self.openstack_release = conf.openstack_release
         self.docker_healthchecks = conf.docker_healthchecks
         rpm_setup_config = ([repo_file for repo_file in
@@ -700,10 +1233,20 @@ class KollaWorker(object):
         self.image_statuses_allowed_to_fail = dict()
         self.maintainer = conf.maintainer
         self.distro_python_version = conf.distro_python_version
+        self._users = None
+
+        self.history = None
+        if conf.history_file:
+            self.history = history.BuildHistory(
+                conf.history_file, self.base, self.install_type,
+                self.base_arch)
 
         docker_kwargs = docker.utils.kwargs_from_env()
         try:
-            self.dc = docker.APIClient(version='auto', **docker_kwargs)
+            if DockerTask.client_pool is not None:
+                self.dc = DockerTask.client_pool.get()
+            else:
+                self.dc = docker.APIClient(version='auto', **docker_kwargs)
         except docker.errors.DockerException as e:
             self.dc = None
             if not (conf.template_only or
@@ -797,6 +1340,70 @@ class KollaWorker(object):
                 else:
                     shutil.copy2(src_path, dest_path)
 
+    def copy_selected(self, src, dest, selected):
+        """Copy a docker dir, leaving out the images not selected."""
+        for root, dirs, files in os.walk(src):
+            if ('Dockerfile.j2' in files and
+                    os.path.basename(root) not in selected):
+                dirs[:] = []
+                continue
+            if not files:
+                continue
+            dest_root = os.path.join(dest, os.path.relpath(root, src))
+            os.makedirs(dest_root, exist_ok=True)
+            for name in files:
+                shutil.copy2(os.path.join(root, name),
+                             os.path.join(dest_root, name))
+
+    def select_images(self):
+        """Resolve the images to render from their templates.
+
+        Parents are read from the FROM line of the Dockerfile.j2 templates,
+        so the images matching the filter and their ancestors are known
+        before anything is copied or rendered.
+
+        :return: the set of names of the images to render, or None if all
+                 of them have to be rendered
+        """
+        filter_ = self.get_filter()
+        if not filter_ or self.conf.changed_since or self.conf.changed_files:
+            return None
+
+        templates = dict()
+        for docker_dir in [self.images_dir] + list(self.conf.docker_dir):
+            for root, dirs, names in os.walk(docker_dir):
+                if 'Dockerfile.j2' in names:
+                    templates[os.path.basename(root)] = os.path.join(
+                        root, 'Dockerfile.j2')
+
+        parents = dict()
+        for image_name, template in templates.items():
+            with open(template) as f:
+                content = f.read()
+            match = TEMPLATE_PARENT_RE.search(content)
+            if match:
+                parents[image_name] = match.group(1)
+                continue
+            # NOTE: images built from outside of the namespace are roots
+            match = TEMPLATE_FROM_RE.search(content)
+            if match and 'namespace' not in match.group(1):
+                parents[image_name] = None
+
+        patterns = re.compile(r"|".join(filter_).join('()'))
+        selected = set()
+        for image_name in templates:
+            if not re.search(patterns, image_name):
+                continue
+            while image_name is not None and image_name not in selected:
+                if image_name not in parents:
+                    LOG.debug('Unable to find the parent of %s in its'
+                              ' template, rendering all images', image_name)
+                    return None
+                selected.add(image_name)
+                image_name = parents[image_name]
+        LOG.debug('Selected %d images to render', len(selected))
+        return selected
+
     def setup_working_dir(self):
         """Creates a working directory for use while building."""
         if self.conf.work_dir:
@@ -807,9 +1414,14 @@ class KollaWorker(object):
                 '%Y-%m-%d_%H-%M-%S_')
             self.temp_dir = tempfile.mkdtemp(prefix='kolla-' + ts)
             self.working_dir = os.path.join(self.temp_dir, 'docker')
-        self.copy_dir(self.images_dir, self.working_dir)
-        for dir in self.conf.docker_dir:
-            self.copy_dir(dir, self.working_dir)
+        selected = None
+        if self.conf.selective_render:
+            selected = self.select_images()
+        for dir in [self.images_dir] + list(self.conf.docker_dir):
+            if selected is None:
+                self.copy_dir(dir, self.working_dir)
+            else:
+                self.copy_selected(dir, self.working_dir, selected)
         self.copy_apt_files()
         LOG.debug('Created working dir: %s', self.working_dir)
 
@@ -840,6 +1452,8 @@ class KollaWorker(object):
         }
 
     def get_users(self):
+        if self._users is not None:
+            return self._users
         all_sections = (set(self.conf._groups.keys()) |
                         set(self.conf.list_all_sections()))
         ret = dict()
@@ -852,67 +1466,75 @@ class KollaWorker(object):
                     'gid': user.gid,
                     'group': user.group,
                 }
+        self._users = ret
         return ret
 
-    def create_dockerfiles(self):
+    def get_template_values(self):
+        """Values shared by the templates of all images."""
         kolla_version = version.version_info.cached_version_string()
         supported_distro_name = common_config.DISTRO_PRETTY_NAME.get(
             self.base)
+        ts = time.time()
+        build_date = datetime.datetime.fromtimestamp(ts).strftime('%Y%m%d')
+        return {'base_distro': self.base,
+                'base_image': self.conf.base_image,
+                'base_distro_tag': self.base_tag,
+                'base_arch': self.base_arch,
+                'use_dumb_init': self.use_dumb_init,
+                'base_package_type': self.base_package_type,
+                'debian_arch': self.debian_arch,
+                'docker_healthchecks': self.docker_healthchecks,
+                'supported_distro_name': supported_distro_name,
+                'image_prefix': self.image_prefix,
+                'infra_image_prefix': self.infra_image_prefix,
+                'install_type': self.install_type,
+                'namespace': self.namespace,
+                'openstack_release': self.openstack_release,
+                'tag': self.tag,
+                'maintainer': self.maintainer,
+                'kolla_version': kolla_version,
+                'users': self.get_users(),
+                'distro_python_version': self.distro_python_version,
+                'distro_package_manager': self.distro_package_manager,
+                'rpm_setup': self.rpm_setup,
+                'build_date': build_date,
+                'clean_package_cache': self.clean_package_cache}
+
+    def create_dockerfiles(self):
+        overrides = None
+        if self.conf.template_override:
+            overrides = self._merge_overrides(self.conf.template_override)
+        renderer_args = (self.working_dir, self.get_template_values(),
+                         self._get_filters(), self._get_methods(),
+                         self.conf.template_cache_dir, overrides)
+
+        # NOTE: compile the template overrides here even when rendering in
+        # processes, so that their errors are reported like in this process
+        # rather than breaking the pool.
+        renderer = DockerfileRenderer(*renderer_args)
+        if self.conf.render_processes > 1:
+            self._create_dockerfiles_in_pool(renderer_args)
+            return
         for path in self.docker_build_paths:
-            template_name = "Dockerfile.j2"
-            image_name = path.split("/")[-1]
-            ts = time.time()
-            build_date = datetime.datetime.fromtimestamp(ts).strftime(
-                '%Y%m%d')
-            values = {'base_distro': self.base,
-                      'base_image': self.conf.base_image,
-                      'base_distro_tag': self.base_tag,
-                      'base_arch': self.base_arch,
-                      'use_dumb_init': self.use_dumb_init,
-                      'base_package_type': self.base_package_type,
-                      'debian_arch': self.debian_arch,
-                      'docker_healthchecks': self.docker_healthchecks,
-                      'supported_distro_name': supported_distro_name,
-                      'image_prefix': self.image_prefix,
-                      'infra_image_prefix': self.infra_image_prefix,
-                      'install_type': self.install_type,
-                      'namespace': self.namespace,
-                      'openstack_release': self.openstack_release,
-                      'tag': self.tag,
-                      'maintainer': self.maintainer,
-                      'kolla_version': kolla_version,
-                      'image_name': image_name,
-                      'users': self.get_users(),
-                      'distro_python_version': self.distro_python_version,
-                      'distro_package_manager': self.distro_package_manager,
-                      'rpm_setup': self.rpm_setup,
-                      'build_date': build_date,
-                      'clean_package_cache': self.clean_package_cache}
-            env = jinja2.Environment(  # nosec: not used to render HTML
-                loader=jinja2.FileSystemLoader(self.working_dir))
-            env.filters.update(self._get_filters())
-            env.globals.update(self._get_methods())
-            tpl_path = os.path.join(
-                os.path.relpath(path, self.working_dir),
-                template_name)
-
-            template = env.get_template(tpl_path)
-            if self.conf.template_override:
-                tpl_dict = self._merge_overrides(self.conf.template_override)
-                template_name = os.path.basename(list(tpl_dict.keys())[0])
-                values['parent_template'] = template
-                env = jinja2.Environment(  # nosec: not used to render HTML
-                    loader=jinja2.DictLoader(tpl_dict))
-                env.filters.update(self._get_filters())
-                env.globals.update(self._get_methods())
-                template = env.get_template(template_name)
-            content = template.render(values, env=os.environ)
-            content_path = os.path.join(path, 'Dockerfile')
-            with open(content_path, 'w') as f:
-                LOG.debug("Rendered %s into:", tpl_path)
-                LOG.debug(content)
-                f.write(content)
-                LOG.debug("Wrote it to %s", content_path)
+            renderer.render(path)
+
+    def _create_dockerfiles_in_pool(self, renderer_args):
+        errors = list()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.conf.render_processes,
+                initializer=_init_renderer,
+                initargs=renderer_args) as executor:
+            for path, error in executor.map(_render_dockerfile,
+                                            self.docker_build_paths,
+                                            chunksize=8):
+                if error is not None:
+                    LOG.error('Failed to render %s: %s', path, error)
+                    errors.append('%s: %s' % (
+                        os.path.relpath(path, self.working_dir), error))
+        if errors:
+            raise exception.KollaTemplateRenderException(
+                'Failed to render %d Dockerfiles:\n%s' %
+                (len(errors), '\n'.join(errors)))
 
     def _merge_overrides(self, overrides):
         tpl_name = os.path.basename(overrides[0])
@@ -953,8 +1575,8 @@ class KollaWorker(object):
             for tmp_image in image.children:
                 tmp_image.parent_name = image.canonical_name
 
-    def filter_images(self):
-        """Filter which images to build."""
+    def get_filter(self):
+        """Patterns of the images to build, from the regex or profiles."""
         filter_ = list()
 
         if self.regex:
@@ -970,6 +1592,104 @@ class KollaWorker(object):
                     raise ValueError(msg)
                 else:
                     filter_ += self.conf.profiles[profile]
+        return filter_
+
+    def find_impacted_images(self, filter_):
+        """Find the images changed by --changed-since or --changed-files.
+
+        :param filter_: patterns the impacted images must match, if any
+        :return: the set of names of the changed images and their
+                 descendants, or None if no changes were given
+        """
+        try:
+            if self.conf.changed_since:
+                paths = impact.git_changed_files(self.images_dir,
+                                                 self.conf.changed_since)
+            elif self.conf.changed_files:
+                paths = impact.resolve_paths(
+                    self.conf.changed_files,
+                    impact.git_top_level(self.images_dir))
+            else:
+                return None
+        except impact.ImpactError as e:
+            LOG.error('%s', e)
+            sys.exit(1)
+
+        # NOTE: template overrides and helpers are used to render all images
+        shared_paths = (list(self.conf.template_override or []) +
+                        [os.path.dirname(jinja_methods.__file__),
+                         common_config.__file__])
+        changed = impact.changed_images(
+            paths, [self.images_dir] + list(self.conf.docker_dir),
+            shared_paths)
+
+        graph = self.get_graph()
+        if changed is None:
+            impacted = set(graph.by_name)
+        else:
+            impacted = set()
+            for image_name in changed:
+                image = graph.get(image_name)
+                if image is None:
+                    continue
+                impacted.add(image_name)
+                impacted.update(graph.descendants(image))
+        if filter_:
+            patterns = re.compile(r"|".join(filter_).join('()'))
+            impacted = set(image_name for image_name in impacted
+                           if re.search(patterns, image_name))
+        LOG.info('%d images are impacted by %d changed files',
+                 len(impacted), len(paths))
+        return impacted
+
+    def find_existing_images(self, images):
+        """Find which images already exist, with bulk queries.
+
+        :return: the set of names of the existing images
+        """
+        if self.conf.existing_images_source == 'registry':
+            return self._find_images_in_registry(images)
+
+        # NOTE: list all images once rather than querying Docker per image
+        repo_tags = set()
+        for docker_image in self.dc.images():
+            for repo_tag in docker_image.get('RepoTags') or []:
+                repo_tags.add(repo_tag)
+                if repo_tag.startswith('docker.io/'):
+                    repo_tags.add(repo_tag[len('docker.io/'):])
+        return set(image.name for image in images
+                   if image.canonical_name in repo_tags)
+
+    def _find_images_in_registry(self, images):
+        def exists(image):
+            registry, repository, tag = docker_registry.split_image_name(
+                image.canonical_name, self.conf.registry)
+            client = docker_registry.get_client(registry, self.conf.timeout)
+            try:
+                return client.has_manifest(repository, tag)
+            except (docker_registry.RegistryError,
+                    requests_exc.RequestException) as e:
+                LOG.warning('Unable to find %s in the registry: %s',
+                            image.canonical_name, e)
+                return False
+
+        if not images:
+            return set()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.conf.threads) as executor:
+            found = list(executor.map(exists, images))
+        return set(image.name for image, exist in zip(images, found)
+                   if exist)
+
+    def filter_images(self):
+        """Filter which images to build."""
+        filter_ = self.get_filter()
+        impacted = self.find_impacted_images(filter_)
+        if impacted is not None:
+            # NOTE: match nothing rather than everything when no image is
+            # impacted
+            filter_ = ([re.escape(image_name).join('^$')
+                        for image_name in sorted(impacted)] or ['(?!)'])
 
         # mark unbuildable images and their children
         base = self.base
@@ -985,25 +1705,15 @@ class KollaWorker(object):
                 if tag_re.match(set_tag):
                     unbuildable_images.update(UNBUILDABLE_IMAGES[set_tag])
 
+        graph = self.get_graph()
         if unbuildable_images:
-            for image in self.images:
-                if image.name in unbuildable_images:
+            # NOTE: parents come first, so the status of an image only
+            # depends on its own name and the status of its parent.
+            for image in graph.topological_order():
+                if (image.name in unbuildable_images or
+                        (image.parent is not None and
+                         image.parent.status == Status.UNBUILDABLE)):
                     image.status = Status.UNBUILDABLE
-                else:
-                    # let's check ancestors
-                    # if any of them is unbuildable then we mark it
-                    # and then mark image
-                    build_image = True
-                    ancestor_image = image
-                    while (ancestor_image.parent is not None):
-                        ancestor_image = ancestor_image.parent
-                        if ancestor_image.name in unbuildable_images or \
-                           ancestor_image.status == Status.UNBUILDABLE:
-                            build_image = False
-                            ancestor_image.status = Status.UNBUILDABLE
-                            break
-                    if not build_image:
-                        image.status = Status.UNBUILDABLE
 
         # When we want to build a subset of images then filter_ part kicks in.
         # Otherwise we just mark everything buildable as matched for build.
@@ -1020,10 +1730,9 @@ class KollaWorker(object):
                 if re.search(patterns, image.name):
                     image.status = Status.MATCHED
 
-                    ancestor_image = image
-                    while (ancestor_image.parent is not None and
-                           ancestor_image.parent.status != Status.MATCHED):
-                        ancestor_image = ancestor_image.parent
+                    for ancestor_image in graph.ancestors(image):
+                        if ancestor_image.status == Status.MATCHED:
+                            break
                         # Parents of a buildable image must also be buildable.
                         ancestor_image.status = Status.MATCHED
                     LOG.debug('Image %s matched regex', image.name)
@@ -1036,29 +1745,27 @@ class KollaWorker(object):
 
         if self.conf.infra_rename:
             for image in self.images:
-                is_infra = True
-                if image.name in BINARY_SOURCE_IMAGES:
-                    # keep as is
-                    is_infra = False
-                else:
-                    # let's check ancestors if any of them is binary/source
-                    ancestor_image = image
-                    while (ancestor_image.parent is not None):
-                        ancestor_image = ancestor_image.parent
-                        if ancestor_image.name in BINARY_SOURCE_IMAGES:
-                            is_infra = False
-                            break
+                # keep as is images which are or derive from binary/source
+                # images
+                is_infra = not any(
+                    ancestor_image.name in BINARY_SOURCE_IMAGES
+                    for ancestor_image in (image,) + graph.ancestors(image))
 
                 if is_infra:
                     self.change_install_type(image, self.install_type, 'infra')
                     pass
 
         # Next, mark any skipped images.
+        existing = set()
+        if self.conf.skip_existing:
+            existing = self.find_existing_images(
+                [image for image in self.images
+                 if image.status == Status.MATCHED])
         for image in self.images:
             if image.status != Status.MATCHED:
                 continue
             # Skip image if --skip-existing was given and image exists.
-            if (self.conf.skip_existing and image.in_docker_cache()):
+            if (self.conf.skip_existing and image.name in existing):
                 LOG.debug('Skipping existing image %s', image.name)
                 image.status = Status.SKIPPED
             # Skip image if --skip-parents was given and image has children.
@@ -1091,6 +1798,8 @@ class KollaWorker(object):
                 LOG.info(name)
                 results['built'].append({
                     'name': name,
+                    'timings': self.get_timings(name),
+                    'cache': self.get_cache_summary(name),
                 })
 
         if self.image_statuses_bad or self.image_statuses_allowed_to_fail:
@@ -1109,17 +1818,21 @@ class KollaWorker(object):
                 results['failed'].append({
                     'name': name,
                     'status': status.value,
+                    'timings': self.get_timings(name),
+                    'cache': self.get_cache_summary(name),
                 })
                 if self.conf.logs_dir and status == Status.ERROR:
-                    linkname = os.path.join(self.conf.logs_dir,
-                                            "000_FAILED_%s.log" % name)
+                    linkname = os.path.join(
+                        self.conf.logs_dir, utils.log_filename(
+                            "000_FAILED_%s" % name, self.conf.logs_compress))
                     try:
                         os.lstat(linkname)
                         os.remove(linkname)
                     except OSError:
                         pass
 
-                    os.symlink("%s.log" % name, linkname)
+                    os.symlink(utils.log_filename(
+                        name, self.conf.logs_compress), linkname)
 
         if self.image_statuses_unmatched:
             LOG.debug("=====================================")
@@ -1151,8 +1864,62 @@ class KollaWorker(object):
                     'name': name,
                 })
 
+        results['cache'] = self.get_run_cache_summary()
+        invalidating = results['cache']['invalidated_by']
+        if invalidating and self.conf.cache:
+            LOG.info("=====================================")
+            LOG.info("Instructions invalidating layer cache")
+            LOG.info("=====================================")
+            for entry in invalidating:
+                LOG.info('%d images: %s', entry['count'],
+                         entry['instruction'])
+
         return results
 
+    def get_cache_summary(self, image_name):
+        """Layer cache hits of the steps of the build of an image."""
+        for image in self.images:
+            if image.name == image_name:
+                return build_steps.summarize(image.build_steps)
+        return build_steps.summarize([])
+
+    def get_run_cache_summary(self):
+        """Layer cache hits of the run and the instructions missing it."""
+        images_steps = dict((image.name, image.build_steps)
+                            for image in self.images if image.build_steps)
+        steps = [step for image_steps in images_steps.values()
+                 for step in image_steps]
+        return {
+            'steps': len(steps),
+            'cached_steps': sum(1 for step in steps if step.cached),
+            'invalidated_by': build_steps.invalidating_instructions(
+                images_steps),
+        }
+
+    def get_timings(self, image_name):
+        """Seconds spent in each phase of the build of an image."""
+        for image in self.images:
+            if image.name == image_name:
+                return dict((phase, round(duration, 3))
+                            for phase, duration in image.timings.items())
+        return {}
+
+    def save_timings(self, path):
+        """Save the phase timings of the images and their totals as JSON."""
+        images = dict()
+        totals = dict()
+        for image in self.images:
+            if not image.timings:
+                continue
+            images[image.name] = self.get_timings(image.name)
+            for phase, duration in image.timings.items():
+                totals[phase] = totals.get(phase, 0) + duration
+        with open(path, 'w') as f:
+            json.dump({'images': images,
+                       'totals': dict((phase, round(duration, 3))
+                                      for phase, duration in totals.items())},
+                      f, indent=2, sort_keys=True)
+
     def get_image_statuses(self):
         if any([self.image_statuses_bad,
                 self.image_statuses_good,
@@ -1318,25 +2085,71 @@ class KollaWorker(object):
 
     def find_parents(self):
         """Associate all images with parents and children."""
-        sort_images = dict()
+        self.graph = image_graph.ImageGraph.link(self.images,
+                                                 self.install_type)
 
-        for image in self.images:
-            sort_images[image.canonical_name] = image
+    def get_graph(self):
+        """Return the graph of the images, from their current links."""
+        if self.graph is None:
+            self.graph = image_graph.ImageGraph(self.images)
+        return self.graph
 
-        for parent_name, parent in sort_images.items():
-            for image in sort_images.values():
-                if (image.parent_name == parent_name or image.parent_name ==
-                        parent_name.replace(self.install_type, 'infra')):
-                    parent.children.append(image)
-                    image.parent = parent
+    def _build_cost(self, image):
+        """Expected build time of an image, taken from the build history.
 
-    def build_queue(self, push_queue):
+        Images without history are expected to take the average time of the
+        others. Without any history every image costs one unit.
+        """
+        if self.history is None:
+            return 1
+        build_time = self.history.build_time(image.name)
+        if build_time is not None:
+            return build_time
+        known = [t for t in (self.history.build_time(i.name)
+                             for i in self.images) if t is not None]
+        if not known:
+            return 1
+        return sum(known) / len(known)
+
+    def compute_priorities(self):
+        """Rank images by the critical chain of builds they unblock.
+
+        The priority of an image is the expected time of the longest chain
+        of images still to be built below it (itself included), plus its
+        number of descendants to be built as a fraction which only breaks
+        ties between chains of equal length.
+        """
+        chains = dict()
+        descendants = dict()
+        weight = len(self.images) + 1
+
+        def is_buildable(image):
+            return image.status not in (Status.UNMATCHED, Status.SKIPPED,
+                                        Status.UNBUILDABLE)
+
+        # NOTE: children come first, so their chains are known.
+        for image in reversed(self.get_graph().topological_order()):
+            chain = 0
+            count = 0
+            for child in image.children:
+                if not is_buildable(child):
+                    continue
+                chain = max(chain, chains[child.name])
+                count += descendants[child.name] + 1
+            chains[image.name] = chain + self._build_cost(image)
+            descendants[image.name] = count
+            image.priority = (chains[image.name] +
+                              float(count) / weight)
+
+    def build_queue(self, push_queue, prefetcher=None, push_pipeline=None):
         """Organizes Queue list.
 
-        Return a list of Queues that have been organized into a hierarchy
-        based on dependencies
+        Return a queue of the root build tasks. Tasks are handed out by
+        priority, so that images unblocking the longest chain of builds are
+        built first.
         """
-        build_queue = queue.Queue()
+        self.compute_priorities()
+        build_queue = TaskQueue()
 
         for image in self.images:
             if image.status in (Status.UNMATCHED, Status.SKIPPED,
@@ -1348,11 +2161,47 @@ class KollaWorker(object):
             # Build all root nodes, where a root is defined as having no parent
             # or having a parent that is explicitly being skipped.
             if image.parent is None or image.parent.status == Status.SKIPPED:
-                build_queue.put(BuildTask(self.conf, image, push_queue))
+                build_queue.put(BuildTask(self.conf, image, push_queue,
+                                          history=self.history,
+                                          prefetcher=prefetcher,
+                                          push_pipeline=push_pipeline))
                 LOG.info('Added image %s to queue', image.name)
 
         return build_queue
 
+    def estimate_remaining_time(self):
+        """Estimate the number of seconds needed to finish the build.
+
+        The estimate is the larger of the longest chain of images left to
+        build and the work left spread over all the build threads.
+        """
+        now = datetime.datetime.now()
+        graph = self.get_graph()
+        remaining = dict()
+        for image in self.images:
+            if image.status == Status.BUILDING:
+                elapsed = 0
+                if image.start is not None:
+                    elapsed = (now - image.start).total_seconds()
+                remaining[image.name] = max(
+                    self._build_cost(image) - elapsed, 0)
+            elif image.status == Status.MATCHED:
+                if not any(ancestor.status in STATUS_ERRORS
+                           for ancestor in graph.ancestors(image)):
+                    remaining[image.name] = self._build_cost(image)
+        if not remaining:
+            return 0
+
+        chains = dict()
+        for image in reversed(graph.topological_order()):
+            if image.name in remaining:
+                chains[image.name] = remaining[image.name] + max(
+                    [chains[child.name] for child in image.children
+                     if child.name in remaining] or [0])
+
+        return max(max(chains.values()),
+                   sum(remaining.values()) / self.conf.threads)
+
 
 def run_build():
     """Build container images.
@@ -1363,15 +2212,32 @@ def run_build():
     """
     conf = cfg.ConfigOpts()
     common_config.parse(conf, sys.argv[1:], prog='kolla-build')
+    utils.clear_run_caches()
 
     if conf.debug:
         LOG.setLevel(logging.DEBUG)
 
-    if conf.squash:
-        squash_version = utils.get_docker_squash_version()
-        LOG.info('Image squash is enabled and "docker-squash" version is %s',
-                 squash_version)
+    sources.set_download_memory_limit(conf.download_memory_limit * 1024 * 1024)
 
+    # NOTE: one client per worker thread, and one for the main thread
+    DockerTask.client_pool = docker_client.DockerClientPool(
+        conf.threads + conf.push_threads + 1,
+        **docker.utils.kwargs_from_env())
+    utils.start_log_writer()
+    if conf.trace_file:
+        trace.start_trace()
+    try:
+        return _run_build(conf)
+    finally:
+        DockerTask.client_pool = None
+        recorder = trace.stop_trace()
+        if recorder is not None:
+            recorder.save(conf.trace_file)
+            LOG.info('Build timeline is saved in %s', conf.trace_file)
+        utils.stop_log_writer()
+
+
+def _run_build(conf):
     kolla = KollaWorker(conf)
     kolla.setup_working_dir()
     kolla.find_dockerfiles()
@@ -1406,37 +2272,86 @@ def run_build():
         kolla.list_dependencies()
         return
 
-    push_queue = queue.Queue()
-    build_queue = kolla.build_queue(push_queue)
+    prefetcher = None
+    if conf.prefetch_threads:
+        prefetcher = SourcePrefetcher(conf, conf.prefetch_threads)
+    push_pipeline = None
+    if conf.push_engine == 'pipelined':
+        push_pipeline = push.PushPipeline(conf)
+    push_queue = TaskQueue()
+    build_queue = kolla.build_queue(push_queue, prefetcher, push_pipeline)
+    coordinator = BuildCoordinator([build_queue, push_queue])
     workers = []
+    build_metrics = metrics.BuildMetrics(
+        kolla.images, {'build': build_queue, 'push': push_queue})
+    metrics_server = None
 
     with join_many(workers):
         try:
+            if conf.metrics_port:
+                metrics_server = build_metrics.serve(conf.metrics_host,
+                                                     conf.metrics_port)
+                LOG.info('Serving metrics on http://%s:%d/metrics',
+                         conf.metrics_host, conf.metrics_port)
+            if prefetcher is not None:
+                prefetcher.start(kolla.images)
+
             for x in range(conf.threads):
-                worker = WorkerThread(conf, build_queue)
+                worker = WorkerThread(conf, build_queue, coordinator,
+                                      name='build-worker-%d' % x)
                 worker.daemon = True
                 worker.start()
                 workers.append(worker)
 
             for x in range(conf.push_threads):
-                worker = WorkerThread(conf, push_queue)
+                worker = WorkerThread(conf, push_queue, coordinator,
+                                      name='push-worker-%d' % x)
                 worker.daemon = True
                 worker.start()
                 workers.append(worker)
 
-            # sleep until build_queue is empty
-            while build_queue.unfinished_tasks or push_queue.unfinished_tasks:
-                time.sleep(3)
+            # wake up on every completed task, and at least once per ETA
+            # interval, until all the work is done
+            last_eta = time.time()
+            finished = False
+            while not finished:
+                finished = coordinator.finished()
+                for done_task in coordinator.wait(timeout=ETA_INTERVAL):
+                    if not done_task.success:
+                        LOG.warning('%s failed', done_task.name)
+                if (not finished and kolla.history is not None and
+                        time.time() - last_eta >= ETA_INTERVAL):
+                    last_eta = time.time()
+                    LOG.info('Estimated time remaining: %s',
+                             datetime.timedelta(
+                                 seconds=int(kolla.estimate_remaining_time())))
 
             # ensure all threads exited happily
-            push_queue.put(WorkerThread.tombstone)
-            build_queue.put(WorkerThread.tombstone)
+            push_queue.close()
+            build_queue.close()
         except KeyboardInterrupt:
             for w in workers:
                 w.should_stop = True
-            push_queue.put(WorkerThread.tombstone)
-            build_queue.put(WorkerThread.tombstone)
+            push_queue.close()
+            build_queue.close()
             raise
+        finally:
+            if prefetcher is not None:
+                prefetcher.shutdown()
+            if metrics_server is not None:
+                metrics_server.shutdown()
+                metrics_server.server_close()
+
+    if kolla.history is not None:
+        kolla.history.save()
+
+    if conf.timings_file:
+        kolla.save_timings(conf.timings_file)
+        LOG.info('Build timings are saved in %s', conf.timings_file)
+
+    if conf.metrics_file:
+        build_metrics.write(conf.metrics_file)
+        LOG.info('Build metrics are saved in %s', conf.metrics_file)
 
     if conf.summary:
         results = kolla.summary()
@@ -0,0 +1,138 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import docker
+from requests import exceptions as requests_exc
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Seconds a client may sit idle before being checked again.
+CHECK_INTERVAL = 60
+
+
+class DockerClientPool(object):
+    """Docker API clients shared by the threads of a run.
+
+    Each thread gets its own client, which it keeps for all of its tasks
+    and gives back once it is done. At most size clients are connected at
+    once: past that, a thread reuses a client given back by another thread,
+    or waits for one. The API version is negotiated by the first client
+    only; the others are created with the negotiated version. A client is
+    pinged before being reused after a failure or after sitting idle, and
+    replaced if the daemon does not answer.
+    """
+
+    def __init__(self, size, check_interval=CHECK_INTERVAL, **kwargs):
+        self.size = size
+        self.check_interval = check_interval
+        self.kwargs = kwargs
+        self.version = None
+        self.connected = 0
+        self._idle = list()
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._local = threading.local()
+
+    def _connect(self):
+        with self._lock:
+            # NOTE: connect under the lock until the version is negotiated,
+            # so that it is only negotiated once.
+            if self.version is None:
+                client = docker.APIClient(version='auto', **self.kwargs)
+                self.version = client.api_version
+                LOG.debug('Negotiated Docker API version %s', self.version)
+            else:
+                client = docker.APIClient(version=self.version,
+                                          **self.kwargs)
+        return client
+
+    def _acquire(self):
+        """Take an idle client, or a slot to connect a new one.
+
+        :return: a (client, last use) tuple, client being None if a new
+                 client is to be connected
+        """
+        with self._condition:
+            if not self._idle and self.connected >= self.size:
+                LOG.debug('Waiting for one of %d Docker clients', self.size)
+                self._condition.wait_for(
+                    lambda: self._idle or self.connected < self.size)
+            if self._idle:
+                return self._idle.pop()
+            self.connected += 1
+        return None, None
+
+    def _release_slot(self):
+        with self._condition:
+            self.connected -= 1
+            self._condition.notify()
+
+    def _is_healthy(self, client):
+        try:
+            client.ping()
+        except (docker.errors.DockerException,
+                requests_exc.RequestException) as e:
+            LOG.info('Reconnecting to Docker: %s', e)
+            return False
+        return True
+
+    def get(self):
+        """Return the client of the current thread."""
+        local = self._local
+        client = getattr(local, 'client', None)
+        used = getattr(local, 'used', None)
+        failed = getattr(local, 'failed', False)
+        if client is None:
+            client, used = self._acquire()
+        now = time.monotonic()
+        if client is not None and (failed or
+                                   now - used > self.check_interval):
+            if not self._is_healthy(client):
+                client.close()
+                client = None
+        if client is None:
+            try:
+                client = self._connect()
+            except BaseException:
+                local.client = None
+                self._release_slot()
+                raise
+        local.client = client
+        local.failed = False
+        local.used = now
+        return client
+
+    def report_failure(self):
+        """Check the client of the current thread before its next use."""
+        self._local.failed = True
+
+    def release(self):
+        """Give the client of the current thread back to the pool."""
+        local = self._local
+        client = getattr(local, 'client', None)
+        if client is None:
+            return
+        local.client = None
+        if local.failed:
+            local.failed = False
+            client.close()
+            self._release_slot()
+            return
+        with self._condition:
+            self._idle.append((client, local.used))
+            self._condition.notify()
@@ -0,0 +1,101 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+
+
+class ImageGraph(object):
+    """Dependency graph of images, indexed by image name.
+
+    The graph follows the parent and children links of the images. The
+    ancestors and descendants of every image and the topological order of
+    the graph are computed on first use and cached, as the links do not
+    change once the images are loaded.
+    """
+
+    def __init__(self, images):
+        self.images = list(images)
+        self.by_name = dict((image.name, image) for image in self.images)
+        self._order = None
+        self._ancestors = dict()
+        self._descendants = dict()
+
+    @classmethod
+    def link(cls, images, install_type):
+        """Link images with their parents and return their graph.
+
+        Parents are looked up by the canonical name, or by the canonical
+        name of the infra variant of the parent.
+        """
+        index = dict()
+        for image in images:
+            index.setdefault(image.canonical_name, image)
+        for image in images:
+            index.setdefault(
+                image.canonical_name.replace(install_type, 'infra'), image)
+        for image in images:
+            parent = index.get(image.parent_name)
+            if parent is not None:
+                parent.children.append(image)
+                image.parent = parent
+        return cls(images)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def roots(self):
+        """Return the images whose parent is not part of the graph."""
+        return [image for image in self.images
+                if image.parent is None or
+                self.by_name.get(image.parent.name) is not image.parent]
+
+    def topological_order(self):
+        """Return all images, each after its ancestors."""
+        if self._order is None:
+            order = list()
+            seen = set()
+            pending = collections.deque(self.roots())
+            while pending:
+                image = pending.popleft()
+                if id(image) in seen:
+                    continue
+                seen.add(id(image))
+                order.append(image)
+                pending.extend(image.children)
+            self._order = order
+        return self._order
+
+    def ancestors(self, image):
+        """Return the ancestors of an image, from its parent to its root."""
+        if image.name not in self._ancestors:
+            chain = list()
+            ancestor = image.parent
+            while ancestor is not None:
+                if ancestor.name in self._ancestors:
+                    chain.append(ancestor)
+                    chain.extend(self._ancestors[ancestor.name])
+                    break
+                chain.append(ancestor)
+                ancestor = ancestor.parent
+            self._ancestors[image.name] = tuple(chain)
+        return self._ancestors[image.name]
+
+    def descendants(self, image):
+        """Return the names of all the descendants of an image."""
+        if not self._descendants:
+            for node in reversed(self.topological_order()):
+                names = set()
+                for child in node.children:
+                    names.add(child.name)
+                    names.update(self._descendants[child.name])
+                self._descendants[node.name] = frozenset(names)
+        return self._descendants.get(image.name, frozenset())
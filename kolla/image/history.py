@@ -0,0 +1,116 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+HISTORY_VERSION = 1
+
+# Weight of the latest sample in the moving averages kept per image.
+SMOOTHING = 0.5
+
+
+class BuildHistory(object):
+    """Persistent record of build and push durations of past runs.
+
+    Entries are keyed by image name, base distro, install type and
+    architecture, as the same image can take very different times to build
+    for different targets. Durations and the ratio of cached build steps are
+    kept as exponential moving averages.
+    """
+
+    def __init__(self, path, base, install_type, arch):
+        self.path = path
+        self.base = base
+        self.install_type = install_type
+        self.arch = arch
+        self.entries = dict()
+        self.lock = threading.Lock()
+        self.load()
+
+    def key(self, image_name):
+        return '/'.join([image_name, self.base, self.install_type, self.arch])
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            LOG.warning('Ignoring unreadable build history %s: %s',
+                        self.path, e)
+            return
+        if data.get('version') != HISTORY_VERSION:
+            LOG.warning('Ignoring build history %s with unknown version %s',
+                        self.path, data.get('version'))
+            return
+        self.entries = data.get('images', {})
+
+    def save(self):
+        with self.lock:
+            data = {'version': HISTORY_VERSION, 'images': self.entries}
+            dirname = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.history-')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+    def get(self, image_name):
+        return self.entries.get(self.key(image_name))
+
+    def build_time(self, image_name):
+        entry = self.get(image_name)
+        if entry is None:
+            return None
+        return entry.get('build_time')
+
+    def push_time(self, image_name):
+        entry = self.get(image_name)
+        if entry is None:
+            return None
+        return entry.get('push_time')
+
+    @staticmethod
+    def _average(old, sample):
+        if old is None:
+            return sample
+        return SMOOTHING * sample + (1 - SMOOTHING) * old
+
+    def _update(self, image_name, **samples):
+        with self.lock:
+            entry = self.entries.setdefault(self.key(image_name), {})
+            for name, sample in samples.items():
+                entry[name] = self._average(entry.get(name), sample)
+            entry['updated'] = time.time()
+
+    def record_build(self, image_name, duration, cached_steps=0, steps=0):
+        samples = {'build_time': duration}
+        if steps:
+            samples['cache_hit_ratio'] = float(cached_steps) / steps
+        self._update(image_name, **samples)
+
+    def record_push(self, image_name, duration):
+        self._update(image_name, push_time=duration)
@@ -0,0 +1,115 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import git
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+TEMPLATE_NAME = 'Dockerfile.j2'
+
+
+class ImpactError(Exception):
+    pass
+
+
+def git_top_level(path):
+    """The top-level directory of the git checkout holding path, or None."""
+    try:
+        return git.Git(path).rev_parse('--show-toplevel')
+    except (git.GitCommandError, git.GitCommandNotFound) as e:
+        LOG.debug('%s is not in a git checkout: %s', path, e)
+        return None
+
+
+def git_changed_files(path, revisions):
+    """List the files changed in a revision range of a git repository.
+
+    :param path: a path inside the repository
+    :param revisions: a revision range such as ``origin/master..HEAD``, or a
+                      single revision to compare the working tree with
+    :return: the absolute paths of the changed files
+    :raises ImpactError: if path is not in a git checkout or the revisions
+                         are unknown
+    """
+    top_level = git_top_level(path)
+    if top_level is None:
+        raise ImpactError('Unable to find changes since %s: %s is not in a'
+                          ' git checkout' % (revisions, path))
+    try:
+        names = git.Git(top_level).diff('--name-only',
+                                        revisions).splitlines()
+    except git.GitCommandError as e:
+        raise ImpactError('Unable to find changes since %s: %s' %
+                          (revisions, (e.stderr or '').strip() or e))
+    return [os.path.join(top_level, name) for name in names if name]
+
+
+def resolve_paths(paths, top_level=None):
+    """Make changed files relative to the top of the checkout absolute.
+
+    Files are relative to the current directory when there is no checkout.
+    """
+    return [os.path.join(top_level, path) if top_level is not None
+            else os.path.abspath(path) for path in paths]
+
+
+def _is_under(path, directory):
+    return os.path.commonpath([path, directory]) == directory
+
+
+def _image_of(path, docker_dir):
+    """Name of the image whose directory holds path, or None."""
+    directory = os.path.dirname(path)
+    while _is_under(directory, docker_dir) and directory != docker_dir:
+        if os.path.isfile(os.path.join(directory, TEMPLATE_NAME)):
+            return os.path.basename(directory)
+        directory = os.path.dirname(directory)
+    return None
+
+
+def changed_images(paths, docker_dirs, shared_paths=()):
+    """Map changed files to the images they change.
+
+    Files of an image directory change that image. Other files of a docker
+    directory, such as ``macros.j2``, and the shared paths, such as template
+    overrides, change all the images. Any other file changes no image.
+
+    :param paths: absolute paths of the changed files
+    :param docker_dirs: the directories holding image directories
+    :param shared_paths: files or directories used to render every image
+    :return: the set of names of the changed images, or None if all of them
+             are changed
+    """
+    docker_dirs = [os.path.abspath(d) for d in docker_dirs]
+    shared_paths = [os.path.abspath(p) for p in shared_paths]
+    images = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if any(_is_under(path, shared) for shared in shared_paths):
+            LOG.info('%s changes all images', path)
+            return None
+        for docker_dir in docker_dirs:
+            if not _is_under(path, docker_dir):
+                continue
+            image_name = _image_of(path, docker_dir)
+            if image_name is None:
+                LOG.info('%s changes all images', path)
+                return None
+            LOG.debug('%s changes image %s', path, image_name)
+            images.add(image_name)
+            break
+    return images
@@ -0,0 +1,143 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import http.server
+import os
+import tempfile
+import threading
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Counters of the images, with the metrics they are exposed as.
+IMAGE_COUNTERS = (
+    ('steps', 'kolla_build_image_steps_total',
+     'Dockerfile steps run to build the image'),
+    ('cached_steps', 'kolla_build_image_cached_steps_total',
+     'Dockerfile steps of the image found in the layer cache'),
+    ('download_bytes', 'kolla_build_image_download_bytes_total',
+     'Bytes downloaded to fetch the sources of the image'),
+)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('\n', '\\n')
+            .replace('"', '\\"'))
+
+
+def _sample(name, labels, value):
+    if labels:
+        name += '{%s}' % ','.join('%s="%s"' % (key, _escape(labels[key]))
+                                  for key in sorted(labels))
+    return '%s %s' % (name, repr(float(value)))
+
+
+class BuildMetrics(object):
+    """Metrics of a run in the Prometheus text exposition format.
+
+    Metrics are computed from the images and queues of the run whenever they
+    are rendered, so that they can be scraped while the run goes on or be
+    written for the textfile collector of the node exporter at its end.
+    """
+
+    def __init__(self, images, queues):
+        self.images = images
+        self.queues = queues
+
+    def collect(self):
+        """Yield (name, type, help, samples) metric families."""
+        images = [image for image in self.images
+                  if image.timings or image.counters]
+
+        statuses = collections.Counter(image.status.value
+                                       for image in self.images)
+        yield ('kolla_build_images', 'gauge', 'Images by status',
+               [({'status': status}, count)
+                for status, count in sorted(statuses.items())])
+        yield ('kolla_build_queue_depth', 'gauge',
+               'Tasks waiting in the queues',
+               [({'queue': name}, queue.qsize())
+                for name, queue in sorted(self.queues.items())])
+        yield ('kolla_build_image_phase_seconds', 'gauge',
+               'Seconds spent by the image in each phase of its build',
+               [({'image': image.name, 'phase': phase}, duration)
+                for image in images
+                for phase, duration in sorted(dict(image.timings).items())])
+        yield ('kolla_build_image_retries_total', 'counter',
+               'Retries of the build and push tasks of the image',
+               [({'image': image.name, 'task': task}, retries)
+                for image in images
+                for task in ('build', 'push')
+                for retries in [image.counters.get('%s_retries' % task)]
+                if retries])
+        for counter, name, help_text in IMAGE_COUNTERS:
+            yield (name, 'counter', help_text,
+                   [({'image': image.name}, image.counters[counter])
+                    for image in images if counter in image.counters])
+
+    def render(self):
+        lines = list()
+        for name, metric_type, help_text, samples in self.collect():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                lines.append(_sample(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Write the metrics to a file, atomically."""
+        dirname = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.metrics-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def serve(self, host, port):
+        """Serve the metrics over HTTP from a thread.
+
+        :return: the server, to be shut down at the end of the run
+        """
+        server = http.server.ThreadingHTTPServer((host, port), _Handler)
+        server.daemon_threads = True
+        server.metrics = self
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='metrics', daemon=True)
+        thread.start()
+        return server
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOG.debug('Metrics request from %s: %s', self.address_string(),
+                  format % args)
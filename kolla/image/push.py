@@ -0,0 +1,123 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from requests import exceptions as requests_exc
+
+from kolla.image import registry as docker_registry
+
+
+class PushProgress(object):
+    """Accounts for the layers of an image push from its progress stream."""
+
+    def __init__(self):
+        self.sizes = dict()
+        self.pushed = set()
+        self.mounted = set()
+        self.existing = set()
+
+    def update(self, response):
+        layer = response.get('id')
+        status = response.get('status') or ''
+        if not layer:
+            return
+        if status == 'Pushing':
+            detail = response.get('progressDetail') or {}
+            self.sizes[layer] = detail.get('current', 0)
+        elif status == 'Pushed':
+            self.pushed.add(layer)
+        elif status.startswith('Mounted from'):
+            self.mounted.add(layer)
+        elif status == 'Layer already exists':
+            self.existing.add(layer)
+
+    @property
+    def bytes_pushed(self):
+        return sum(self.sizes.get(layer, 0) for layer in self.pushed)
+
+    def __str__(self):
+        return ('%d bytes in %d layers, %d layers mounted, %d layers already'
+                ' present' % (self.bytes_pushed, len(self.pushed),
+                              len(self.mounted), len(self.existing)))
+
+
+class PushPipeline(object):
+    """Pushes the images of a run along their dependency graph.
+
+    The push of an image waits for the push of its parent, so that the
+    layers they share are uploaded once. The layers of the parent are then
+    mounted into the repository of the image from the repository of the
+    parent, so that Docker finds them in place instead of uploading them.
+    """
+
+    def __init__(self, conf):
+        self.conf = conf
+        self._pushes = dict()
+        self._lock = threading.Lock()
+
+    def register(self, image):
+        """Record that the image is going to be pushed."""
+        with self._lock:
+            self._pushes.setdefault(image.name, threading.Event())
+
+    def done(self, image):
+        """Record that the push of the image ended, successfully or not."""
+        with self._lock:
+            push = self._pushes.get(image.name)
+        if push is not None:
+            push.set()
+
+    def wait_for_parent(self, image):
+        """Wait for the push of the parent of the image, if there is one."""
+        if image.parent is None:
+            return
+        with self._lock:
+            push = self._pushes.get(image.parent.name)
+        if push is not None and not push.is_set():
+            image.logger.info('Waiting for the push of %s',
+                              image.parent.name)
+            push.wait()
+
+    def mount_parent_layers(self, image):
+        """Mount the layers of the parent into the repository of the image.
+
+        :return: the number of layers mounted
+        """
+        if image.parent is None:
+            return 0
+        registry, repository, _ = docker_registry.split_image_name(
+            image.canonical_name, self.conf.registry)
+        parent_registry, parent_repository, parent_tag = (
+            docker_registry.split_image_name(image.parent.canonical_name,
+                                             self.conf.registry))
+        if parent_registry != registry:
+            return 0
+        client = docker_registry.get_client(registry, self.conf.timeout)
+        mounted = 0
+        try:
+            layers = client.get_layers(parent_repository, parent_tag)
+            for digest in layers or []:
+                if not client.mount_blob(repository, digest,
+                                         parent_repository):
+                    image.logger.debug('Registry refused to mount %s from'
+                                       ' %s', digest, parent_repository)
+                    break
+                mounted += 1
+        except (docker_registry.RegistryError,
+                requests_exc.RequestException) as e:
+            image.logger.warning('Unable to mount the layers of %s: %s',
+                                 image.parent.canonical_name, e)
+        if mounted:
+            image.logger.info('Mounted %d layers from %s', mounted,
+                              parent_repository)
+        return mounted
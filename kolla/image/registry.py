@@ -0,0 +1,272 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import re
+import threading
+from urllib import parse
+
+from docker import auth as docker_auth
+from docker import credentials as docker_credentials
+import requests
+from requests import exceptions as requests_exc
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+DOCKER_HUB = 'registry-1.docker.io'
+
+MANIFEST_TYPES = (
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+)
+
+_CLIENTS = dict()
+_CLIENTS_LOCK = threading.Lock()
+
+
+class RegistryError(Exception):
+    pass
+
+
+def split_image_name(image_name, registry=None):
+    """Split an image name into registry host, repository and tag.
+
+    :param image_name: the image name, e.g. ``localhost:4000/kolla/base:tag``
+    :param registry: the registry host the name is prefixed with, if any
+    :return: a (registry, repository, tag) tuple
+    """
+    if registry and image_name.startswith(registry + '/'):
+        image_name = image_name[len(registry) + 1:]
+    else:
+        registry = DOCKER_HUB
+    repository, _, tag = image_name.rpartition(':')
+    if not repository or '/' in tag:
+        repository, tag = image_name, 'latest'
+    return registry, repository, tag
+
+
+def load_credentials(registry):
+    """Return the Docker login of a registry as (username, password), or None.
+
+    The credentials are read the way ``docker login`` stores them, including
+    through credential helpers.
+    """
+    try:
+        config = docker_auth.load_config()
+        auth_config = docker_auth.resolve_authconfig(
+            config, None if registry == DOCKER_HUB else registry)
+    except docker_credentials.StoreError as e:
+        LOG.warning('Unable to read the credentials of %s: %s', registry, e)
+        return None
+    if not auth_config or not auth_config.get('username'):
+        return None
+    return auth_config['username'], auth_config.get('password') or ''
+
+
+def get_client(registry, timeout=120):
+    """Return the client of a registry, shared across threads of a run."""
+    with _CLIENTS_LOCK:
+        if registry not in _CLIENTS:
+            _CLIENTS[registry] = RegistryClient(
+                registry, timeout=timeout,
+                credentials=load_credentials(registry))
+        return _CLIENTS[registry]
+
+
+class RegistryClient(object):
+    """Minimal client of the Docker registry HTTP API v2.
+
+    HTTPS is tried first and plain HTTP is used if the registry does not
+    speak TLS, which is how Docker treats local insecure registries such as
+    the one started by ``tools/start-registry``. Bearer tokens are requested
+    when the registry asks for them, anonymously unless credentials are
+    given. Clients are shared by threads: tokens are shared, and each thread
+    gets its own HTTP session.
+    """
+
+    def __init__(self, registry, timeout=120, credentials=None):
+        self.registry = registry
+        self.timeout = timeout
+        self.credentials = credentials
+        self.session_factory = requests.Session
+        self._base_url = None
+        self._tokens = dict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        """The HTTP session of the current thread."""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.session_factory()
+        return session
+
+    @property
+    def base_url(self):
+        if self._base_url is None:
+            for scheme in ('https', 'http'):
+                url = '%s://%s' % (scheme, self.registry)
+                try:
+                    self.session.get(url + '/v2/', timeout=self.timeout)
+                except (requests_exc.SSLError,
+                        requests_exc.ConnectionError):
+                    LOG.debug('Registry %s does not answer over %s',
+                              self.registry, scheme)
+                    continue
+                self._base_url = url
+                break
+            else:
+                raise RegistryError('Registry %s is not reachable'
+                                    % self.registry)
+        return self._base_url
+
+    def _authenticate(self, challenge, scopes):
+        scheme, _, challenge = (challenge or '').partition(' ')
+        if scheme.lower() == 'basic' and self.credentials:
+            return 'Basic %s' % base64.b64encode(
+                ('%s:%s' % self.credentials).encode('utf-8')).decode('ascii')
+        if scheme.lower() != 'bearer':
+            return None
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm', None)
+        # NOTE: challenges answering a rejected token describe the error,
+        # which is not a parameter of the token request.
+        params.pop('error', None)
+        params.pop('error_description', None)
+        if realm is None:
+            return None
+        scopes = list(scopes)
+        if params.get('scope') and params['scope'] not in scopes:
+            scopes.append(params['scope'])
+        params['scope'] = scopes[0] if len(scopes) == 1 else scopes
+        kwargs = dict(params=params, timeout=self.timeout)
+        if self.credentials:
+            kwargs['auth'] = self.credentials
+        r = self.session.get(realm, **kwargs)
+        if r.status_code != 200:
+            return None
+        body = r.json()
+        token = body.get('token') or body.get('access_token')
+        return 'Bearer %s' % token if token else None
+
+    def _send(self, method, url, scopes, headers=None, **kwargs):
+        headers = dict(headers or {})
+        with self._lock:
+            authorization = self._tokens.get(scopes)
+        if authorization:
+            headers['Authorization'] = authorization
+        kwargs.setdefault('timeout', self.timeout)
+        r = self.session.request(method, url, headers=headers, **kwargs)
+        if r.status_code == 401:
+            if authorization:
+                # NOTE: bearer tokens are short-lived, the cached token
+                # expired and a new one is needed.
+                LOG.debug('Token for %s rejected, authenticating again',
+                          ', '.join(scopes))
+                with self._lock:
+                    # NOTE: another thread may have renewed it already.
+                    if self._tokens.get(scopes) == authorization:
+                        self._tokens.pop(scopes, None)
+            authorization = self._authenticate(
+                r.headers.get('WWW-Authenticate'), scopes)
+            if authorization:
+                with self._lock:
+                    self._tokens[scopes] = authorization
+                headers['Authorization'] = authorization
+                r = self.session.request(method, url, headers=headers,
+                                         **kwargs)
+        return r
+
+    def request(self, method, repository, path, headers=None, scopes=None,
+                **kwargs):
+        """Send a request about a repository, authenticating if needed.
+
+        :param scopes: the token scopes the request needs, pull access to the
+                       repository by default
+        """
+        url = '%s/v2/%s/%s' % (self.base_url, repository, path)
+        if scopes is None:
+            scopes = ('repository:%s:pull' % repository,)
+        return self._send(method, url, tuple(scopes), headers=headers,
+                          **kwargs)
+
+    def get_manifest(self, repository, reference):
+        """Return the image manifest of a tag or digest, or None."""
+        r = self.request('GET', repository, 'manifests/%s' % reference,
+                         headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        if r.status_code == 404:
+            return None
+        if r.status_code != 200:
+            raise RegistryError('Failed to get manifest of %s:%s: %s' %
+                                (repository, reference, r.status_code))
+        return r.json()
+
+    def has_manifest(self, repository, reference):
+        """Whether a tag or digest exists in a repository."""
+        r = self.request('HEAD', repository, 'manifests/%s' % reference,
+                         headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        if r.status_code == 404:
+            return False
+        if r.status_code != 200:
+            raise RegistryError('Failed to check manifest of %s:%s: %s' %
+                                (repository, reference, r.status_code))
+        return True
+
+    def get_labels(self, repository, reference):
+        """Return the labels of an image, or None if it does not exist."""
+        manifest = self.get_manifest(repository, reference)
+        if manifest is None or 'config' not in manifest:
+            return None
+        digest = manifest['config']['digest']
+        r = self.request('GET', repository, 'blobs/%s' % digest)
+        if r.status_code != 200:
+            raise RegistryError('Failed to get config of %s:%s: %s' %
+                                (repository, reference, r.status_code))
+        return r.json().get('config', {}).get('Labels') or {}
+
+    def get_layers(self, repository, reference):
+        """Return the layer digests of an image, or None if it is missing."""
+        manifest = self.get_manifest(repository, reference)
+        if manifest is None or 'layers' not in manifest:
+            return None
+        return [layer['digest'] for layer in manifest['layers']]
+
+    def mount_blob(self, repository, digest, from_repository):
+        """Mount a blob of another repository of the registry.
+
+        The blob is linked into the repository without being uploaded again.
+
+        :return: whether the blob was mounted; registries may refuse to
+                 mount, for instance without pull access to the other
+                 repository
+        """
+        scopes = ('repository:%s:pull,push' % repository,
+                  'repository:%s:pull' % from_repository)
+        r = self.request('POST', repository, 'blobs/uploads/', scopes=scopes,
+                         params={'mount': digest, 'from': from_repository})
+        if r.status_code == 201:
+            return True
+        if r.status_code == 202:
+            # NOTE: the registry opened a regular upload instead, which is
+            # not needed.
+            location = r.headers.get('Location')
+            if location:
+                self._send('DELETE',
+                           parse.urljoin(self.base_url + '/', location),
+                           scopes)
+            return False
+        raise RegistryError('Failed to mount %s into %s: %s' %
+                            (digest, repository, r.status_code))
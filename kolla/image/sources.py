@@ -0,0 +1,348 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import configparser
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+
+import git
+from packaging import version as packaging_version
+import requests
+from requests import exceptions as requests_exc
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+# Size of the chunks downloads are streamed to disk with.
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_URL_LOCKS = dict()
+_URL_LOCKS_LOCK = threading.Lock()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ByteBudget(object):
+    """Bounds the number of bytes held in memory across threads."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        size = min(size, self.limit)
+        with self.condition:
+            while self.used and self.used + size > self.limit:
+                self.condition.wait()
+            self.used += size
+        return size
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+#: Budget shared by all the downloads of a run.
+DOWNLOAD_BUDGET = ByteBudget(64 * 1024 * 1024)
+
+
+def set_download_memory_limit(limit):
+    DOWNLOAD_BUDGET.limit = limit
+
+
+def download(url, dest, timeout, headers=None):
+    """Stream a URL into a file, holding a chunk at a time in memory.
+
+    The chunks of all the downloads in flight are bounded by the
+    DOWNLOAD_BUDGET. The file is only created once fully downloaded, and
+    only if the server answered with the content.
+
+    :return: a (response, sha256 hex digest of the content) tuple, the
+             digest being None if nothing was downloaded
+    """
+    r = requests.get(url, headers=headers, timeout=timeout, stream=True)
+    with r:
+        if r.status_code != 200:
+            return r, None
+        digest = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                        prefix='.download-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                chunks = r.iter_content(DOWNLOAD_CHUNK_SIZE)
+                while True:
+                    reserved = DOWNLOAD_BUDGET.acquire(DOWNLOAD_CHUNK_SIZE)
+                    try:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        f.write(chunk)
+                        digest.update(chunk)
+                    finally:
+                        DOWNLOAD_BUDGET.release(reserved)
+            os.replace(tmp_path, dest)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return r, digest.hexdigest()
+
+
+def _url_lock(url):
+    with _URL_LOCKS_LOCK:
+        return _URL_LOCKS.setdefault(url, threading.Lock())
+
+
+def _link_or_copy(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class DownloadCache(object):
+    """Cache of downloaded archives, shared across runs and work dirs.
+
+    Archives are stored under the hash of their URL, along with the ETag and
+    Last-Modified headers of the response. A cached archive is revalidated
+    with a conditional request before being used. When the cache grows over
+    its maximum size, the least recently used archives are evicted.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = os.path.join(path, 'downloads')
+        self.max_size = max_size
+
+    def _paths(self, url):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.path, name)
+        return base + '.data', base + '.json'
+
+    def _read_metadata(self, meta_path):
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_metadata(self, meta_path, metadata):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.meta-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(tmp_path, meta_path)
+
+    def fetch(self, url, dest, timeout, logger=LOG):
+        """Fetch an archive into dest, from the cache when still valid.
+
+        :return: the number of bytes downloaded, 0 if the cached archive was
+                 used
+        """
+        os.makedirs(self.path, exist_ok=True)
+        data_path, meta_path = self._paths(url)
+        with _url_lock(url):
+            metadata = None
+            if os.path.exists(data_path):
+                metadata = self._read_metadata(meta_path)
+            headers = dict()
+            if metadata:
+                if metadata.get('etag'):
+                    headers['If-None-Match'] = metadata['etag']
+                if metadata.get('last_modified'):
+                    headers['If-Modified-Since'] = metadata['last_modified']
+
+            try:
+                r, digest = download(url, data_path, timeout, headers)
+            except requests_exc.ConnectionError:
+                if not metadata:
+                    raise
+                logger.warning('Unable to revalidate %s, using the cached'
+                               ' archive', url)
+                r = None
+
+            downloaded = 0
+            if r is not None and r.status_code == 200:
+                downloaded = os.path.getsize(data_path)
+                metadata = {
+                    'url': url,
+                    'etag': r.headers.get('ETag'),
+                    'last_modified': r.headers.get('Last-Modified'),
+                    'size': downloaded,
+                    'sha256': digest,
+                }
+                logger.debug('Stored %s in the download cache (sha256 %s)',
+                             url, digest)
+            elif r is not None and not (r.status_code == 304 and metadata):
+                raise DownloadError('Failed to download archive: status_code'
+                                    ' %s' % r.status_code)
+            else:
+                logger.debug('Using cached archive of %s', url)
+
+            metadata['last_used'] = time.time()
+            self._write_metadata(meta_path, metadata)
+            _link_or_copy(data_path, dest)
+        self.evict(keep=url)
+        return downloaded
+
+    def evict(self, keep=None):
+        """Remove the least recently used archives over the maximum size."""
+        entries = list()
+        total = 0
+        for name in os.listdir(self.path):
+            if not name.endswith('.json') or name.startswith('.'):
+                continue
+            metadata = self._read_metadata(os.path.join(self.path, name))
+            if not metadata:
+                continue
+            entries.append(metadata)
+            total += metadata.get('size', 0)
+        entries.sort(key=lambda m: m.get('last_used', 0))
+        for metadata in entries:
+            if total <= self.max_size:
+                break
+            if metadata['url'] == keep:
+                continue
+            data_path, meta_path = self._paths(metadata['url'])
+            with _url_lock(metadata['url']):
+                for path in (meta_path, data_path):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            total -= metadata.get('size', 0)
+            LOG.debug('Evicted %s from the download cache', metadata['url'])
+
+
+class GitMirror(object):
+    """Bare mirror of a git repository.
+
+    Mirrors kept in a cache directory are shared across runs and only
+    fetch the refs which changed since the previous run. Archives are
+    produced straight from a commit of the mirror, so no clone is checked
+    out and no .git directory ends up in the build context.
+    """
+
+    def __init__(self, path, url):
+        self.url = url
+        name = hashlib.sha256(url.encode()).hexdigest()
+        self.path = os.path.join(path, 'git', name + '.git')
+
+    def update(self, reference, logger=LOG):
+        """Make the mirror up to date and resolve a reference in it.
+
+        :return: the SHA-1 of the commit the reference points to
+        """
+        with _url_lock('git:' + self.url):
+            if not os.path.isdir(self.path):
+                logger.debug("Mirroring %s", self.url)
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                tmp_path = tempfile.mkdtemp(dir=os.path.dirname(self.path),
+                                            prefix='.mirror-')
+                try:
+                    git.Git().clone('--mirror', self.url, tmp_path)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+                    raise
+            elif not self._is_commit(reference):
+                logger.debug("Fetching new refs of %s", self.url)
+                git.Git(self.path).fetch('--prune', 'origin')
+            return git.Git(self.path).rev_parse(
+                '--verify', '%s^{commit}' % reference)
+
+    def _is_commit(self, reference):
+        """Whether the reference is a commit SHA-1 already mirrored."""
+        if not re.match(r'^[0-9a-f]{40}$', reference):
+            return False
+        try:
+            git.Git(self.path).cat_file('-e', '%s^{commit}' % reference)
+        except git.GitCommandError:
+            return False
+        return True
+
+    def archive(self, commit, dest, prefix):
+        """Write the tree of a commit into a tar archive under prefix."""
+        repo = git.Git(self.path)
+        repo.archive('--format=tar', '--prefix=%s/' % prefix,
+                     '--output=%s' % dest, commit)
+        # NOTE: pbr needs the git history or a PKG-INFO file to find out
+        # the version of a package.
+        package = self._package_name(commit)
+        if package is None:
+            return
+        pkg_info = ('Metadata-Version: 1.1\nName: %s\nVersion: %s\n' %
+                    (package, self._package_version(commit))).encode()
+        info = tarfile.TarInfo('%s/PKG-INFO' % prefix)
+        info.size = len(pkg_info)
+        info.mode = 0o644
+        info.mtime = int(repo.show('-s', '--format=%ct', commit))
+        with tarfile.open(dest, 'a') as tar:
+            tar.addfile(info, io.BytesIO(pkg_info))
+
+    def _package_name(self, commit):
+        try:
+            setup_cfg = git.Git(self.path).show('%s:setup.cfg' % commit)
+        except git.GitCommandError:
+            return None
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read_string(setup_cfg)
+            return parser.get('metadata', 'name')
+        except configparser.Error:
+            return None
+
+    def _package_version(self, commit):
+        """Approximate the version pbr derives from the git history.
+
+        Only tags looking like release versions are considered, as the
+        history of projects also holds tags such as ``xena-eol``. Versions
+        pip would reject fall back to the version pbr gives untagged
+        histories.
+        """
+        repo = git.Git(self.path)
+        try:
+            described = repo.describe('--tags', '--long', '--match', '[0-9]*',
+                                      commit)
+        except git.GitCommandError:
+            version = None
+        else:
+            tag, count, _ = described.rsplit('-', 2)
+            if count == '0':
+                version = tag
+            else:
+                parts = tag.split('.')
+                if parts[-1].isdigit():
+                    parts[-1] = str(int(parts[-1]) + 1)
+                version = '%s.dev%s' % ('.'.join(parts), count)
+        if version is not None:
+            try:
+                packaging_version.Version(version)
+                return version
+            except packaging_version.InvalidVersion:
+                LOG.debug('Ignoring tag %s of %s, which is not a valid'
+                          ' version', tag, self.url)
+        count = repo.rev_list('--count', commit)
+        return '0.0.1.dev%s' % count
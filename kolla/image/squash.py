@@ -0,0 +1,389 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import copy
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+
+import docker
+
+from kolla.common import utils
+
+
+LOG = utils.make_a_logger()
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+
+CHUNK_SIZE = 1024 * 1024
+
+# Members of a saved image other than layers are small JSON documents.
+MAX_METADATA_SIZE = 16 * 1024 * 1024
+
+SquashResult = collections.namedtuple('SquashResult',
+                                      ['layers', 'saved_bytes'])
+
+
+class SquashError(Exception):
+    pass
+
+
+class _ChunkReader(object):
+    """File-like object reading from an iterator of byte chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = list()
+        while size:
+            if self.offset == len(self.chunk):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.chunk, self.offset = chunk, 0
+                continue
+            end = len(self.chunk) if size < 0 else self.offset + size
+            part = self.chunk[self.offset:end]
+            self.offset += len(part)
+            if size > 0:
+                size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+
+class _HashingWriter(object):
+    """File-like object computing the digest of what is written to it."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    @property
+    def digest(self):
+        return 'sha256:' + self.sha256.hexdigest()
+
+
+def _normalize(name):
+    name = os.path.normpath(name.lstrip('/'))
+    return '' if name == '.' else name
+
+
+def _ancestors(name):
+    name = os.path.dirname(name)
+    while name:
+        yield name
+        name = os.path.dirname(name)
+
+
+def merge_layers(layers, fileobj):
+    """Merge layers into a single layer.
+
+    Layers are read from the top one down, and a file is kept from the
+    upper-most layer it appears in, unless an upper layer deletes it, replaces
+    one of its directories or makes one of them opaque. Whiteouts are kept,
+    as they delete files of the layers below the merged ones. Hard links to
+    files replaced by upper layers are turned into copies of the files.
+
+    :param layers: paths of the layer archives, from the bottom one up
+    :param fileobj: file object the merged layer is streamed to
+    :return: the number of members of the merged layer
+    """
+    # Path of every member written, mapped to whether it is a directory.
+    written = dict()
+    # Paths hiding the paths below them in the layers underneath: deleted
+    # paths and paths which are not directories.
+    hiding = set()
+    opaque = set()
+    with tarfile.open(fileobj=fileobj, mode='w|',
+                      format=tarfile.PAX_FORMAT) as merged:
+        for path in reversed(layers):
+            layer_hiding = set()
+            layer_opaque = set()
+            layer_written = set()
+            members = dict()
+            with tarfile.open(path) as layer:
+                for member in layer:
+                    name = _normalize(member.name)
+                    if not name:
+                        continue
+                    members[name] = member
+                    if name in written or name in hiding or any(
+                            parent in hiding or parent in opaque
+                            for parent in _ancestors(name)):
+                        continue
+                    directory, base = os.path.split(name)
+                    if base == OPAQUE_WHITEOUT:
+                        layer_opaque.add(directory)
+                    elif base.startswith(WHITEOUT_PREFIX):
+                        target = os.path.join(directory,
+                                              base[len(WHITEOUT_PREFIX):])
+                        layer_hiding.add(target)
+                        if target in written:
+                            if not written[target]:
+                                # NOTE: an upper layer replaced the file.
+                                continue
+                            # NOTE: an upper layer recreated the directory,
+                            # which must not show the deleted content.
+                            name = os.path.join(target, OPAQUE_WHITEOUT)
+                            if name in written:
+                                continue
+                    elif not member.isdir():
+                        layer_hiding.add(name)
+
+                    # NOTE: the member whose data is written, which differs
+                    # from the member for links turned into copies.
+                    source = member
+                    if member.islnk():
+                        target = _normalize(member.linkname)
+                        if target not in layer_written and target in members:
+                            # NOTE: the target of the link is replaced by
+                            # an upper layer, the link keeps the content.
+                            source = members[target]
+                    member = copy.copy(source)
+                    member.name = name
+                    if member.islnk():
+                        member.linkname = _normalize(member.linkname)
+                    if member.isreg():
+                        merged.addfile(member, layer.extractfile(source))
+                    else:
+                        merged.addfile(member)
+                    written[name] = member.isdir()
+                    layer_written.add(name)
+            hiding.update(layer_hiding)
+            opaque.update(layer_opaque)
+    return len(written)
+
+
+def _spool(fileobj, path):
+    """Copy a file object to a path, returning the digest of its content."""
+    with open(path, 'wb') as f:
+        writer = _HashingWriter(f)
+        shutil.copyfileobj(fileobj, writer, CHUNK_SIZE)
+    return writer.digest
+
+
+def _blob_digest(name):
+    """The digest of a blob of an OCI layout, or None for other members."""
+    directory, base = os.path.split(name)
+    if directory != 'blobs/sha256':
+        return None
+    return 'sha256:' + base
+
+
+def _read_archive(chunks, wanted, tmp_dir, metadata, paths):
+    """Read an archive, writing the layers wanted to disk.
+
+    :param wanted: a callable returning the digest of the layer a member
+                   holds if the layer is to be written to disk, else None
+    """
+    with tarfile.open(fileobj=_ChunkReader(chunks), mode='r|') as saved:
+        for member in saved:
+            if not member.isfile():
+                continue
+            digest = wanted(member.name)
+            if digest is not None:
+                if digest in paths:
+                    continue
+                path = os.path.join(tmp_dir, 'layer-%d.tar' % len(paths))
+                if _spool(saved.extractfile(member), path) != digest:
+                    raise SquashError('Layer %s of the saved image does not'
+                                      ' match its digest %s'
+                                      % (member.name, digest))
+                paths[digest] = path
+            elif (not member.name.endswith('/layer.tar') and
+                    member.size <= MAX_METADATA_SIZE):
+                metadata[member.name] = saved.extractfile(member).read()
+
+
+def _legacy_layer_names(metadata):
+    """Map the layer members of a legacy archive to their digests."""
+    try:
+        manifest = json.loads(metadata['manifest.json'])[0]
+        config = json.loads(metadata[manifest['Config']])
+        return dict(zip(manifest['Layers'], config['rootfs']['diff_ids']))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return {}
+
+
+def read_saved_image(get_chunks, layers, tmp_dir):
+    """Read the layers to squash from the archive of a saved image.
+
+    The archive is streamed and only the layers to squash are written to
+    disk, the layers of the parent being skipped. Both the legacy format of
+    ``docker save`` and the OCI layout are understood. The OCI layout names
+    layers after their digest and is read once. The legacy format names
+    layers after their v1 ID, which is only mapped to a digest by the
+    manifest at the end of the archive, so the archive is read a second
+    time to write the layers to squash.
+
+    :param get_chunks: a callable returning the archive, as an iterator of
+                       byte chunks
+    :param layers: the digests of the layers to squash
+    :param tmp_dir: directory the layers are written to
+    :return: a (metadata, layer paths) tuple, metadata mapping the names of
+             the JSON members of the archive to their content and layer
+             paths mapping digests to files
+    """
+    layers = set(layers)
+    metadata = dict()
+    paths = dict()
+
+    def wanted_blob(name):
+        digest = _blob_digest(name)
+        return digest if digest in layers else None
+
+    _read_archive(get_chunks(), wanted_blob, tmp_dir, metadata, paths)
+    missing = layers - set(paths)
+    if missing:
+        legacy = dict((name, digest) for name, digest
+                      in _legacy_layer_names(metadata).items()
+                      if digest in missing)
+        if legacy:
+            _read_archive(get_chunks(), legacy.get, tmp_dir, dict(), paths)
+            missing = layers - set(paths)
+    if missing:
+        raise SquashError('Layers %s are missing from the saved image' %
+                          ', '.join(sorted(missing)))
+    return metadata, paths
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT)
+
+
+def _padding(size):
+    return b'\0' * (-size % tarfile.BLOCKSIZE)
+
+
+def load_archive(layer_path, config, repo_tag, diff_ids):
+    """Stream the archive loading an image with a single new layer.
+
+    Only the new layer is part of the archive. The other layers are listed in
+    its manifest but are already known to Docker, which skips them.
+    """
+    config_data = json.dumps(config).encode('utf-8')
+    config_name = '%s.json' % hashlib.sha256(config_data).hexdigest()
+    layer_names = ['%s/layer.tar' % diff_id.split(':', 1)[1]
+                   for diff_id in diff_ids]
+    manifest_data = json.dumps([{'Config': config_name,
+                                 'RepoTags': [repo_tag],
+                                 'Layers': layer_names}]).encode('utf-8')
+
+    size = os.path.getsize(layer_path)
+    yield _tar_header(layer_names[-1], size)
+    with open(layer_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield chunk
+    yield _padding(size)
+    for name, data in ((config_name, config_data),
+                       ('manifest.json', manifest_data)):
+        yield _tar_header(name, len(data))
+        yield data + _padding(len(data))
+    yield b'\0' * (2 * tarfile.BLOCKSIZE)
+
+
+def _squashed_config(config, parent_count, layer_count, diff_id):
+    config = dict(config)
+    config['rootfs'] = dict(config['rootfs'])
+    config['rootfs']['diff_ids'] = (
+        config['rootfs']['diff_ids'][:parent_count] + [diff_id])
+    history = list()
+    remaining = parent_count
+    for entry in config.get('history') or []:
+        if not remaining:
+            break
+        history.append(entry)
+        if not entry.get('empty_layer'):
+            remaining -= 1
+    history.append({'created': config.get('created'),
+                    'created_by': 'kolla-build squash',
+                    'comment': 'Squashed %d layers' % layer_count})
+    config['history'] = history
+    return config
+
+
+def squash_image(dc, image, parent=None, cleanup=False, tmp_dir=None):
+    """Squash the layers an image adds to its parent into a single layer.
+
+    The image is streamed out of Docker. Only the layers to squash and the
+    merged layer are written to disk, never the whole image, and the
+    squashed image is streamed back into Docker under the same tag.
+
+    :param dc: the Docker API client
+    :param image: the name of the image to squash
+    :param parent: the name of its parent image, None to squash all layers
+    :param cleanup: whether to remove the image that was squashed
+    :param tmp_dir: directory for the layers, the system default if None
+    :return: a SquashResult of the number of layers squashed and of the
+             bytes saved
+    """
+    info = dc.inspect_image(image)
+    diff_ids = info['RootFS']['Layers']
+    parent_layers = list()
+    if parent is not None:
+        parent_layers = dc.inspect_image(parent)['RootFS']['Layers']
+        if diff_ids[:len(parent_layers)] != parent_layers:
+            raise SquashError('%s is not based on %s' % (image, parent))
+    layers = diff_ids[len(parent_layers):]
+    if len(layers) < 2:
+        return SquashResult(len(layers), 0)
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir:
+        metadata, paths = read_saved_image(
+            lambda: dc.get_image(image, chunk_size=CHUNK_SIZE), layers,
+            work_dir)
+        try:
+            manifest = json.loads(metadata['manifest.json'])[0]
+            config = json.loads(metadata[manifest['Config']])
+        except (KeyError, IndexError, ValueError) as e:
+            raise SquashError('Unable to read the configuration of %s: %r'
+                              % (image, e))
+
+        merged_path = os.path.join(work_dir, 'merged.tar')
+        with open(merged_path, 'wb') as f:
+            writer = _HashingWriter(f)
+            merge_layers([paths[diff_id] for diff_id in layers], writer)
+        config = _squashed_config(config, len(parent_layers), len(layers),
+                                  writer.digest)
+        saved_bytes = sum(os.path.getsize(paths[diff_id])
+                          for diff_id in set(layers)) - writer.size
+
+        for response in dc.load_image(load_archive(
+                merged_path, config, image,
+                config['rootfs']['diff_ids'])) or []:
+            if 'errorDetail' in response:
+                raise SquashError(response['errorDetail']['message'])
+
+    if cleanup:
+        try:
+            dc.remove_image(info['Id'])
+        except docker.errors.APIError as e:
+            LOG.warning('Unable to remove %s after squashing it: %s',
+                        info['Id'], e)
+    return SquashResult(len(layers), saved_bytes)
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import re
+import time
+
+
+STEP_RE = re.compile(r'^Step (\d+)/\d+ : (.*)$')
+USING_CACHE = '---> Using cache'
+
+
+class BuildStep(object):
+    """A step of a Docker build, as reported by its output stream."""
+
+    def __init__(self, number, instruction, start):
+        self.number = number
+        self.instruction = instruction
+        self.start = start
+        self.duration = 0.0
+        self.cached = False
+
+    @property
+    def cacheable(self):
+        # NOTE: FROM only names the base of the build, it is never cached.
+        return not self.instruction.upper().startswith('FROM ')
+
+    def to_dict(self):
+        return {'step': self.number, 'instruction': self.instruction,
+                'cached': self.cached, 'duration': round(self.duration, 3)}
+
+
+class BuildStepParser(object):
+    """Splits the output stream of a Docker build into its steps.
+
+    Each step records its instruction, whether it was found in the layer
+    cache and how long it took, up to the start of the next step or the end
+    of the build.
+    """
+
+    def __init__(self):
+        self.steps = list()
+
+    def feed(self, line):
+        match = STEP_RE.match(line)
+        if match:
+            now = time.monotonic()
+            self._finish(now)
+            self.steps.append(BuildStep(int(match.group(1)),
+                                        match.group(2).strip(), now))
+        elif self.steps and line.strip() == USING_CACHE:
+            self.steps[-1].cached = True
+
+    def _finish(self, now):
+        if self.steps and not self.steps[-1].duration:
+            self.steps[-1].duration = now - self.steps[-1].start
+
+    def close(self):
+        """Account for the last step at the end of the build."""
+        self._finish(time.monotonic())
+
+
+def first_miss(steps):
+    """The first step of a build not found in the cache, or None."""
+    for step in steps:
+        if step.cacheable and not step.cached:
+            return step
+    return None
+
+
+def summarize(steps):
+    """Summarize the steps of the build of an image."""
+    miss = first_miss(steps)
+    return {
+        'steps': len(steps),
+        'cached_steps': sum(1 for step in steps if step.cached),
+        'duration': round(sum(step.duration for step in steps), 3),
+        'cache_invalidated_by': miss.to_dict() if miss is not None else None,
+    }
+
+
+def invalidating_instructions(images_steps):
+    """Rank the instructions which first invalidated the cache of images.
+
+    An instruction invalidating the cache of many images, once their parent
+    images are themselves cached, usually comes from a template breaking
+    the cache needlessly.
+
+    :param images_steps: a mapping of image names to their build steps
+    :return: a list of dicts of instructions, the number of images and the
+             names of the images they invalidated the cache of, most
+             frequent first
+    """
+    images = collections.defaultdict(list)
+    for name, steps in sorted(images_steps.items()):
+        miss = first_miss(steps)
+        if miss is not None:
+            images[miss.instruction].append(name)
+    return [{'instruction': instruction, 'count': len(names),
+             'images': names}
+            for instruction, names in sorted(
+                images.items(), key=lambda item: (-len(item[1]), item[0]))]
@@ -0,0 +1,126 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import itertools
+import json
+import os
+import threading
+import time
+
+
+# The recorder of the run, see start_trace().
+_RECORDER = None
+
+
+class TraceRecorder(object):
+    """Timeline of a run in the Chrome trace event format.
+
+    Each thread gets its own track, named after the thread. The timeline can
+    be opened with chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.pid = os.getpid()
+        self.events = list()
+        self.threads = set()
+        self._flow_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _timestamp(self, monotonic):
+        return round((monotonic - self.start) * 1000000, 1)
+
+    def _add(self, event):
+        thread = threading.current_thread()
+        event.update(pid=self.pid, tid=thread.ident)
+        with self._lock:
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({'name': 'thread_name', 'ph': 'M',
+                                    'pid': self.pid, 'tid': thread.ident,
+                                    'args': {'name': thread.name}})
+            self.events.append(event)
+
+    def complete(self, name, category, start, end, **args):
+        """Record a span of the current thread between monotonic times."""
+        self._add({'name': name, 'cat': category, 'ph': 'X',
+                   'ts': self._timestamp(start),
+                   'dur': self._timestamp(end) - self._timestamp(start),
+                   'args': args})
+
+    def flow_start(self, name):
+        """Start an arrow from the current span, returning its ID."""
+        flow_id = next(self._flow_ids)
+        self._add({'name': name, 'cat': 'flow', 'ph': 's', 'id': flow_id,
+                   'ts': self._timestamp(time.monotonic())})
+        return flow_id
+
+    def flow_end(self, name, flow_id, start):
+        """End an arrow at the span of the current thread starting then."""
+        self._add({'name': name, 'cat': 'flow', 'ph': 'f', 'bp': 'e',
+                   'id': flow_id, 'ts': self._timestamp(start)})
+
+    def save(self, path):
+        with self._lock:
+            data = {'traceEvents': list(self.events),
+                    'displayTimeUnit': 'ms'}
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+
+def start_trace():
+    """Record the timeline of the run."""
+    global _RECORDER
+    _RECORDER = TraceRecorder()
+    return _RECORDER
+
+
+def stop_trace():
+    """Stop recording, returning the recorder, if any."""
+    global _RECORDER
+    recorder, _RECORDER = _RECORDER, None
+    return recorder
+
+
+def complete(name, category, start, end=None, **args):
+    """Record a span of the current thread, if recording."""
+    recorder = _RECORDER
+    if recorder is not None:
+        if end is None:
+            end = time.monotonic()
+        recorder.complete(name, category, start, end, **args)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """Record the block as a span of the current thread, if recording."""
+    start = time.monotonic()
+    try:
+        yield start
+    finally:
+        complete(name, category, start, **args)
+
+
+def flow_start(name):
+    """Start an arrow from the current span, if recording."""
+    recorder = _RECORDER
+    if recorder is None:
+        return None
+    return recorder.flow_start(name)
+
+
+def flow_end(name, flow_id, start):
+    """End an arrow at the span starting then, if recording."""
+    recorder = _RECORDER
+    if recorder is not None and flow_id is not None:
+        recorder.flow_end(name, flow_id, start)
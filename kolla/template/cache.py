@@ -0,0 +1,41 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import tempfile
+
+import jinja2
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """Bytecode cache of templates, shared across runs.
+
+    Templates are rendered from a new working dir on every run, so entries
+    are keyed by template name only instead of by file path. Jinja checks
+    the checksum of the template source before using an entry, so a changed
+    template is compiled again. Entries are written atomically, as several
+    runs may share the cache.
+    """
+
+    def get_cache_key(self, name, filename=None):
+        return hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+    def dump_bytecode(self, bucket):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                bucket.write_bytecode(f)
+            os.replace(tmp_path, self._get_cache_filename(bucket))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -17,6 +17,8 @@ import yaml
 
 from jinja2 import contextfunction
 
+from kolla.common import utils
+
 
 def debian_package_install(packages, clean_package_cache=True):
     """Jinja utility method for building debian-based package install command.
@@ -81,25 +83,37 @@ def handle_repos(context, reponames, mode):
     Distro/arch are not required to have all entries - we ignore missing ones.
     """
 
-    if mode == 'enable':
-        rpm_switch = '--enable'
-    elif mode == 'disable':
-        rpm_switch = '--disable'
-    else:
+    if mode not in ('enable', 'disable'):
         raise KeyError
 
     if not isinstance(reponames, list):
         raise TypeError("First argument should be a list of repositories")
 
-    repofile = os.path.dirname(os.path.realpath(__file__)) + '/repos.yaml'
+    return _repo_commands(context.get('base_package_type'),
+                          context.get('base_distro'),
+                          context.get('base_arch'),
+                          tuple(reponames), mode)
+
+
+@utils.run_cached
+def load_repos(repofile):
     with open(repofile, 'r') as repos_file:
         repo_data = {}
         for name, params in yaml.safe_load(repos_file).items():
             repo_data[name] = params
+    return repo_data
 
-    base_package_type = context.get('base_package_type')
-    base_distro = context.get('base_distro')
-    base_arch = context.get('base_arch')
+
+@utils.run_cached
+def _repo_commands(base_package_type, base_distro, base_arch, reponames,
+                   mode):
+    if mode == 'enable':
+        rpm_switch = '--enable'
+    else:
+        rpm_switch = '--disable'
+
+    repofile = os.path.dirname(os.path.realpath(__file__)) + '/repos.yaml'
+    repo_data = load_repos(repofile)
 
     commands = ''
 
@@ -18,6 +18,7 @@ from oslo_config import cfg
 from oslotest import base as oslotest_base
 
 from kolla.common import config as common_config
+from kolla.common import utils
 
 
 TESTS_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -38,6 +39,7 @@ class TestCase(oslotest_base.BaseTestCase):
         self.useFixture(fixtures.MockPatch(
             'kolla.image.build.KollaWorker._get_images_dir',
             mock.Mock(return_value=os.path.join(TESTS_ROOT, 'docker'))))
+        self.addCleanup(utils.clear_run_caches)
 
     def get_default_config_files(self):
         if self.config_file:
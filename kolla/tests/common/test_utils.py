@@ -0,0 +1,99 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import logging
+import os
+from unittest import mock
+
+import fixtures
+
+from kolla.common import utils
+from kolla.tests import base
+
+
+class LogWriterTest(base.TestCase):
+
+    def setUp(self):
+        super(LogWriterTest, self).setUp()
+        self.logs_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('logs_dir', self.logs_dir)
+        self.conf.set_override('debug', False)
+        self.console = mock.Mock(level=logging.NOTSET,
+                                 formatter=logging.Formatter())
+        self.useFixture(fixtures.MockPatchObject(
+            utils.LOG, 'handlers', [self.console]))
+        self.addCleanup(utils.stop_log_writer)
+
+    def _logger(self, name):
+        logger = utils.make_a_logger(self.conf, name)
+        self.addCleanup(logger.handlers.clear)
+        return logger
+
+    def _read(self, name, compress=False):
+        path = os.path.join(self.logs_dir,
+                            utils.log_filename(name, compress))
+        with (gzip.open if compress else open)(path, 'rt') as f:
+            return f.read()
+
+    def test_batched_writes(self):
+        writer = utils.start_log_writer()
+        logger = self._logger('writer-image')
+        with mock.patch.object(utils._BatchedFileHandler, 'flush') as flush:
+            for i in range(100):
+                logger.info('line %d', i)
+            utils.stop_log_writer()
+
+        self.assertFalse(writer.is_alive())
+        self.assertLess(flush.call_count, 100)
+        lines = self._read('writer-image').splitlines()
+        self.assertEqual(['INFO:kolla.common.utils.writer-image:line %d' % i
+                          for i in range(100)], lines)
+        self.assertEqual(100, self.console.handle.call_count)
+
+    def test_compressed(self):
+        self.conf.set_override('logs_compress', True)
+        utils.start_log_writer()
+        logger = self._logger('compressed-image')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception('failed')
+        utils.stop_log_writer()
+
+        log = self._read('compressed-image', compress=True)
+        self.assertIn('failed', log)
+        self.assertIn('ValueError: boom', log)
+
+    def test_synchronous_without_writer(self):
+        logger = self._logger('sync-image')
+        logger.info('line')
+        self.assertEqual('INFO:kolla.common.utils.sync-image:line\n',
+                         self._read('sync-image'))
+        self.console.handle.assert_called_once_with(mock.ANY)
+
+    def test_synchronous_compressed(self):
+        self.conf.set_override('logs_compress', True)
+        logger = self._logger('sync-compressed-image')
+        logger.info('first')
+        utils.stop_log_writer()
+        logger.info('second')
+        for handler in logger.handlers:
+            handler.close()
+
+        path = os.path.join(self.logs_dir, utils.log_filename(
+            'sync-compressed-image', compress=True))
+        with gzip.open(path) as f:
+            self.assertEqual(
+                b'INFO:kolla.common.utils.sync-compressed-image:first\n'
+                b'INFO:kolla.common.utils.sync-compressed-image:second\n',
+                f.read())
@@ -0,0 +1,174 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import tarfile
+
+import fixtures
+
+from kolla.image import archive
+from kolla.tests import base
+
+
+class ArchiveWriterTest(base.TestCase):
+
+    def setUp(self):
+        super(ArchiveWriterTest, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+
+    def _make_tree(self, name, files, mtime):
+        root = os.path.join(self.path, name)
+        for file_name, mode in files:
+            path = os.path.join(root, file_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(file_name)
+            os.chmod(path, mode)
+            os.utime(path, (mtime, mtime))
+        return root
+
+    def _archive(self, path):
+        dest = path + '.tar'
+        with archive.ArchiveWriter(dest) as writer:
+            writer.add(path, 'source')
+        with open(dest, 'rb') as f:
+            return f.read()
+
+    def test_reproducible(self):
+        first = self._make_tree('first', [('b/run.sh', 0o700),
+                                          ('a.txt', 0o600)], 1000)
+        second = self._make_tree('second', [('a.txt', 0o600),
+                                            ('b/run.sh', 0o700)], 2000)
+        for tree in (first, second):
+            os.chmod(os.path.join(tree, 'b'), 0o755)
+            os.chmod(tree, 0o755)
+
+        self.assertEqual(self._archive(first), self._archive(second))
+
+    def test_normalized_members(self):
+        tree = self._make_tree('tree', [('b/run.sh', 0o4750),
+                                        ('a.txt', 0o600)], 1000)
+        os.chmod(tree, 0o755)
+        os.chmod(os.path.join(tree, 'b'), 0o700)
+        self._archive(tree)
+
+        with tarfile.open(tree + '.tar') as tar:
+            members = tar.getmembers()
+        self.assertEqual(['source', 'source/a.txt', 'source/b',
+                          'source/b/run.sh'], [m.name for m in members])
+        self.assertEqual([0o755, 0o600, 0o700, 0o4750],
+                         [m.mode for m in members])
+        for member in members:
+            self.assertEqual((0, 0, '', '', 0),
+                             (member.uid, member.gid, member.uname,
+                              member.gname, member.mtime))
+
+    def test_add_contents(self):
+        tree = self._make_tree('tree', [('Dockerfile', 0o644)], 1000)
+        dest = os.path.join(self.path, 'context.tar')
+        with archive.ArchiveWriter(dest) as writer:
+            writer.add_contents(tree)
+
+        with tarfile.open(dest) as tar:
+            self.assertEqual(['Dockerfile'], tar.getnames())
+
+    def test_dockerignore(self):
+        tree = self._make_tree('tree', [('Dockerfile', 0o644),
+                                        ('.dockerignore', 0o644),
+                                        ('docs/index.rst', 0o644),
+                                        ('docs/keep/conf', 0o644),
+                                        ('scripts/run.sh', 0o755),
+                                        ('scripts/run.sh.orig', 0o644)],
+                               1000)
+        with open(os.path.join(tree, '.dockerignore'), 'w') as f:
+            f.write('# comment\ndocs\n!docs/keep\n**/*.orig\n')
+        dest = os.path.join(self.path, 'context.tar')
+        with archive.ArchiveWriter(dest) as writer:
+            writer.add_contents(tree, include=archive.context_members(tree))
+
+        with tarfile.open(dest) as tar:
+            self.assertEqual(['.dockerignore', 'Dockerfile', 'docs',
+                              'docs/keep', 'docs/keep/conf', 'scripts',
+                              'scripts/run.sh'], tar.getnames())
+
+    def test_no_dockerignore(self):
+        tree = self._make_tree('tree', [('Dockerfile', 0o644)], 1000)
+        self.assertIsNone(archive.context_members(tree))
+
+
+class MergeArchivesTest(base.TestCase):
+
+    def setUp(self):
+        super(MergeArchivesTest, self).setUp()
+        self.path = self.useFixture(fixtures.TempDir()).path
+
+    def _make_archive(self, name, members, mode='w'):
+        path = os.path.join(self.path, name)
+        with tarfile.open(path, mode) as tar:
+            for member_name, content in members:
+                info = tarfile.TarInfo(member_name)
+                if content is None:
+                    info.type = tarfile.DIRTYPE
+                    tar.addfile(info)
+                elif isinstance(content, tuple):
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = content[0]
+                    tar.addfile(info)
+                else:
+                    info.size = len(content)
+                    tar.addfile(info, io.BytesIO(content))
+        return path
+
+    def test_merge_archives(self):
+        first = self._make_archive('first-archive', [
+            ('first-plugin', None),
+            ('first-plugin/setup.py', b'setup'),
+            ('first-plugin/link.py', ('first-plugin/setup.py',)),
+        ])
+        second = self._make_archive('second-archive.tar.gz', [
+            ('second-plugin/pkg/module.py', b'module'),
+        ], mode='w:gz')
+        dest = os.path.join(self.path, 'plugins-archive')
+
+        count = archive.merge_archives([first, second], dest, 'plugins')
+
+        self.assertEqual(2, count)
+        with tarfile.open(dest) as tar:
+            members = {m.name: m for m in tar.getmembers()}
+            self.assertEqual(
+                ['plugins', 'plugins/first-plugin',
+                 'plugins/first-plugin/setup.py',
+                 'plugins/first-plugin/link.py',
+                 'plugins/second-plugin', 'plugins/second-plugin/pkg',
+                 'plugins/second-plugin/pkg/module.py'],
+                [m.name for m in tar.getmembers()])
+            self.assertTrue(members['plugins/second-plugin/pkg'].isdir())
+            self.assertEqual('plugins/first-plugin/setup.py',
+                             members['plugins/first-plugin/link.py'].linkname)
+            self.assertEqual(
+                b'module',
+                tar.extractfile('plugins/second-plugin/pkg/module.py').read())
+
+    def test_merge_no_archives(self):
+        dest = os.path.join(self.path, 'additions-archive')
+
+        self.assertEqual(0, archive.merge_archives([], dest, 'additions'))
+        with tarfile.open(dest) as tar:
+            self.assertEqual(['additions'], tar.getnames())
+
+    def test_merge_member_outside(self):
+        evil = self._make_archive('evil-archive', [('../evil', b'evil')])
+        dest = os.path.join(self.path, 'plugins-archive')
+
+        self.assertRaises(archive.ArchiveError, archive.merge_archives,
+                          [evil], dest, 'plugins')
@@ -11,14 +11,20 @@
 # limitations under the License.
 
 import fixtures
+import git
 import itertools
+import json
 import os
 import requests
 import sys
 from unittest import mock
 
 from kolla.cmd import build as build_cmd
+from kolla import exception
 from kolla.image import build
+from kolla.image import steps
+from kolla.image import trace
+from kolla.template import cache as jinja_cache
 from kolla.tests import base
 
 
@@ -117,6 +123,39 @@ class TasksTest(base.TestCase):
         self.assertTrue(pusher.success)
         self.assertEqual(build.Status.BUILT, self.image.status)
 
+    @mock.patch('docker.version', '3.0.0')
+    def test_push_image_failure_retry_pool(self):
+        pool = mock.Mock()
+        pool.get.return_value.push.side_effect = [Exception, []]
+        self.useFixture(fixtures.MockPatchObject(build.DockerTask,
+                                                 'client_pool', pool))
+        pusher = build.PushTask(self.conf, self.image)
+        pusher.run()
+        self.assertFalse(pusher.success)
+
+        # NOTE: the client is checked before the retry
+        pusher.reset()
+        pool.report_failure.assert_called_once_with()
+        pusher.run()
+        self.assertTrue(pusher.success)
+        self.assertEqual(2, pool.get.call_count)
+
+    @mock.patch('docker.version', '3.0.0')
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_push_image_pipelined(self, mock_client):
+        pipeline = mock.Mock()
+        mock_client().push.return_value = [
+            {'status': 'Mounted from kolla/base', 'id': 'a'}]
+        pusher = build.PushTask(self.conf, self.imageChild,
+                                pipeline=pipeline)
+        pipeline.register.assert_called_once_with(self.imageChild)
+        pusher.run()
+        self.assertTrue(pusher.success)
+        pipeline.wait_for_parent.assert_called_once_with(self.imageChild)
+        pipeline.mount_parent_layers.assert_called_once_with(self.imageChild)
+        pipeline.done.assert_called_once_with(self.imageChild)
+
     @mock.patch('docker.version', '3.0.0')
     @mock.patch.dict(os.environ, clear=True)
     @mock.patch('docker.APIClient')
@@ -164,12 +203,45 @@ class TasksTest(base.TestCase):
         builder.run()
 
         mock_client().build.assert_called_once_with(
-            path=self.image.path, tag=self.image.canonical_name, decode=True,
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
             network_mode='host', nocache=False, rm=True, pull=True,
             forcerm=True, buildargs=None)
 
         self.assertTrue(builder.success)
 
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_timings(self, mock_client):
+        self.conf.set_override('squash', True)
+        self.image.parent_name = None
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        with mock.patch.object(builder, 'squash'):
+            builder.run()
+
+        self.assertTrue(builder.success)
+        self.assertEqual({'archive', 'build', 'squash'},
+                         set(self.image.timings))
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_cache_steps(self, mock_client):
+        mock_client().build.return_value = [
+            {'stream': 'Step 1/3 : FROM base\n ---> 0123456789ab\n'},
+            {'stream': 'Step 2/3 : RUN true\n'},
+            {'stream': ' ---> Using cache\n ---> 123456789abc\n'},
+            {'stream': 'Step 3/3 : COPY file /file\n ---> 23456789abcd\n'},
+        ]
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        builder.run()
+
+        self.assertTrue(builder.success)
+        self.assertEqual([(1, False), (2, True), (3, False)],
+                         [(step.number, step.cached)
+                          for step in self.image.build_steps])
+        self.assertEqual(3, self.image.counters['steps'])
+        self.assertEqual(1, self.image.counters['cached_steps'])
+
     @mock.patch.dict(os.environ, clear=True)
     @mock.patch('docker.APIClient')
     def test_build_image_with_network_mode(self, mock_client):
@@ -181,7 +253,8 @@ class TasksTest(base.TestCase):
         builder.run()
 
         mock_client().build.assert_called_once_with(
-            path=self.image.path, tag=self.image.canonical_name, decode=True,
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
             network_mode='bridge', nocache=False, rm=True, pull=True,
             forcerm=True, buildargs=None)
 
@@ -201,7 +274,8 @@ class TasksTest(base.TestCase):
         builder.run()
 
         mock_client().build.assert_called_once_with(
-            path=self.image.path, tag=self.image.canonical_name, decode=True,
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
             network_mode='host', nocache=False, rm=True, pull=True,
             forcerm=True, buildargs=build_args)
 
@@ -220,7 +294,8 @@ class TasksTest(base.TestCase):
         builder.run()
 
         mock_client().build.assert_called_once_with(
-            path=self.image.path, tag=self.image.canonical_name, decode=True,
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
             network_mode='host', nocache=False, rm=True, pull=True,
             forcerm=True, buildargs=build_args)
 
@@ -241,12 +316,125 @@ class TasksTest(base.TestCase):
         builder.run()
 
         mock_client().build.assert_called_once_with(
-            path=self.image.path, tag=self.image.canonical_name, decode=True,
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
             network_mode='host', nocache=False, rm=True, pull=True,
             forcerm=True, buildargs=build_args)
 
         self.assertTrue(builder.success)
 
+    def _write_dockerfile(self, content):
+        with open(os.path.join(self.image.path, 'Dockerfile'), 'w') as f:
+            f.write(content)
+
+    @mock.patch('docker.APIClient')
+    def test_content_hash(self, mock_client):
+        mock_client().inspect_image.return_value = {'Id': 'sha256:parent'}
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+
+        self._write_dockerfile('FROM base\nLABEL build-date="20210101"\n')
+        content_hash = builder.content_hash(self.image, None)
+        self._write_dockerfile('FROM base\nLABEL build-date="20210102"\n')
+        self.assertEqual(content_hash,
+                         builder.content_hash(self.image, None))
+        self.assertNotEqual(content_hash,
+                            builder.content_hash(self.image, {'a': 'b'}))
+        self._write_dockerfile('FROM base\nRUN true\n')
+        self.assertNotEqual(content_hash,
+                            builder.content_hash(self.image, None))
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_skip_unchanged(self, mock_client):
+        self.conf.set_override('skip_unchanged', True)
+        mock_client().inspect_image.return_value = {
+            'Id': 'sha256:image',
+            'Config': {'Labels': {build.CONTENT_HASH_LABEL: 'abc'}}}
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        with mock.patch.object(builder, 'content_hash', return_value='abc'):
+            builder.run()
+
+        mock_client().build.assert_not_called()
+        self.assertEqual(build.Status.SKIPPED, self.image.status)
+        self.assertTrue(builder.success)
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_skip_unchanged_pulls_distro(self, mock_client):
+        self.conf.set_override('skip_unchanged', True)
+        self.image.parent_name = 'centos:stream9'
+        calls = list()
+        mock_client().pull.side_effect = (
+            lambda *args, **kwargs: calls.append('pull') or [])
+        mock_client().inspect_image.side_effect = (
+            lambda name: calls.append('inspect') or {
+                'Id': 'sha256:image',
+                'Config': {'Labels': {build.CONTENT_HASH_LABEL: 'stale'}}})
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        builder.run()
+
+        mock_client().pull.assert_called_once_with(
+            'centos:stream9', stream=True, decode=True)
+        # NOTE: the distro image is pulled before being hashed
+        self.assertEqual('pull', calls[0])
+        self.assertTrue(builder.success)
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_pull_error(self, mock_client):
+        self.conf.set_override('skip_unchanged', True)
+        self.image.parent_name = 'centos:stream9'
+        mock_client().pull.return_value = [
+            {'errorDetail': {'message': 'manifest unknown'}}]
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        builder.run()
+
+        mock_client().build.assert_not_called()
+        self.assertEqual(build.Status.ERROR, self.image.status)
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('docker.APIClient')
+    def test_build_image_changed(self, mock_client):
+        self.conf.set_override('skip_unchanged', True)
+        mock_client().inspect_image.return_value = {
+            'Id': 'sha256:image',
+            'Config': {'Labels': {build.CONTENT_HASH_LABEL: 'stale'}}}
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        builder.run()
+
+        content_hash = builder.content_hash(self.image, None)
+        mock_client().build.assert_called_once_with(
+            fileobj=mock.ANY, custom_context=True,
+            tag=self.image.canonical_name, decode=True,
+            network_mode='host', nocache=False, rm=True, pull=True,
+            forcerm=True, buildargs=None,
+            labels={build.CONTENT_HASH_LABEL: content_hash})
+        self.assertTrue(builder.success)
+
+    @mock.patch.dict(os.environ, clear=True)
+    @mock.patch('kolla.image.registry.get_client')
+    @mock.patch('docker.APIClient')
+    def test_build_image_unchanged_in_registry(self, mock_client,
+                                               mock_get_client):
+        self.conf.set_override('skip_unchanged', True)
+        self.conf.set_override('registry', 'localhost:4000')
+        self.image.canonical_name = 'localhost:4000/kolla/image-base:latest'
+        mock_client().inspect_image.side_effect = build.docker.errors.NotFound(
+            'not found')
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        mock_get_client().get_labels.return_value = {
+            build.CONTENT_HASH_LABEL: 'abc'}
+        mock_client().pull.return_value = [{'status': 'Pulled'}]
+        with mock.patch.object(builder, 'content_hash', return_value='abc'):
+            builder.run()
+
+        mock_get_client().get_labels.assert_called_once_with(
+            'kolla/image-base', 'latest')
+        mock_client().pull.assert_called_once_with(
+            self.image.canonical_name, stream=True, decode=True)
+        mock_client().build.assert_not_called()
+        self.assertEqual(build.Status.SKIPPED, self.image.status)
+
     @mock.patch('docker.APIClient')
     @mock.patch('requests.get')
     def test_requests_get_timeout(self, mock_get, mock_client):
@@ -264,10 +452,29 @@ class TasksTest(base.TestCase):
         self.assertIsNone(get_result)
         self.assertEqual(self.image.status, build.Status.ERROR)
         mock_get.assert_called_once_with(self.image.source['source'],
-                                         timeout=120)
+                                         headers=None, timeout=120,
+                                         stream=True)
 
         self.assertFalse(builder.success)
 
+    @mock.patch('kolla.image.sources.DownloadCache.fetch')
+    def test_process_source_cached(self, mock_fetch):
+        self.conf.set_override('source_cache_dir', '/cache')
+        source = {'source': 'http://fake/source', 'type': 'url',
+                  'name': 'fake-image-base'}
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        dest_archive = os.path.join(self.image.path, 'fake-image-base-archive')
+        mock_fetch.side_effect = (
+            lambda url, dest, *args: open(dest, 'w').close() or 42)
+        get_result = builder.process_source(self.image, source)
+
+        self.assertEqual(dest_archive, get_result)
+        self.assertEqual(42, self.image.counters['download_bytes'])
+        mock_fetch.assert_called_once_with('http://fake/source', dest_archive,
+                                           120, self.image.logger)
+        self.assertEqual('/cache/downloads', builder.download_cache.path)
+        self.assertEqual(10240 * 1024 * 1024, builder.download_cache.max_size)
+
     @mock.patch('os.utime')
     @mock.patch('shutil.copyfile')
     @mock.patch('shutil.rmtree')
@@ -298,28 +505,47 @@ class TasksTest(base.TestCase):
             else:
                 self.assertIsNotNone(get_result)
 
-    @mock.patch('os.path.exists')
-    @mock.patch('os.utime')
     @mock.patch('shutil.rmtree')
-    def test_process_git_source_existing_dir(self, mock_rmtree, mock_utime,
-                                             mock_path_exists):
+    @mock.patch('kolla.image.sources.GitMirror.update')
+    def test_process_git_source_without_cache(self, mock_update,
+                                              mock_rmtree):
         source = {'source': 'http://fake/source1', 'type': 'git',
                   'name': 'fake-image1',
                   'reference': 'fake/reference1'}
 
         self.image.source = source
         self.image.path = "fake_image_path"
-        mock_path_exists.return_value = True
+        mock_update.side_effect = build.sources.git.GitCommandError('fetch')
         push_queue = mock.Mock()
         builder = build.BuildTask(self.conf, self.image, push_queue)
         get_result = builder.process_source(self.image, self.image.source)
 
-        mock_rmtree.assert_called_with(
-            "fake_image_path/fake-image1-archive-fake-reference1")
+        mock_update.assert_called_once_with('fake/reference1',
+                                            self.image.logger)
+        mock_rmtree.assert_called_once_with(
+            "fake_image_path/fake-image1-archive-mirror", ignore_errors=True)
         self.assertEqual(self.image.status, build.Status.ERROR)
         self.assertFalse(builder.success)
         self.assertIsNone(get_result)
 
+    @mock.patch('os.utime')
+    @mock.patch('kolla.image.sources.GitMirror.archive')
+    @mock.patch('kolla.image.sources.GitMirror.update')
+    def test_process_git_source_with_cache(self, mock_update, mock_archive,
+                                           mock_utime):
+        self.conf.set_override('source_cache_dir', '/cache')
+        source = {'source': 'http://fake/source1', 'type': 'git',
+                  'name': 'fake-image1',
+                  'reference': 'stable/xena'}
+        mock_update.return_value = 'a' * 40
+        builder = build.BuildTask(self.conf, self.image, mock.Mock())
+        get_result = builder.process_source(self.image, source)
+
+        dest_archive = os.path.join(self.image.path, 'fake-image1-archive')
+        self.assertEqual(dest_archive, get_result)
+        mock_archive.assert_called_once_with(
+            'a' * 40, dest_archive, 'fake-image1-archive-stable-xena')
+
     @mock.patch('docker.APIClient')
     def test_followups_docker_image(self, mock_client):
         self.imageChild.source = {
@@ -336,6 +562,170 @@ class TasksTest(base.TestCase):
         self.assertEqual(1, len(get_result))
 
 
+class WorkerThreadTest(base.TestCase):
+
+    def _task(self, name, success=True, followups=()):
+        task = mock.Mock(success=success, followups=list(followups),
+                         priority=0)
+        task.name = name
+        return task
+
+    def test_run_until_closed(self):
+        build_queue = build.TaskQueue()
+        push_queue = build.TaskQueue()
+        coordinator = build.BuildCoordinator([build_queue, push_queue])
+        child = self._task('child', success=False)
+        build_queue.put(self._task('parent', followups=[child]))
+        workers = [build.WorkerThread(self.conf, q, coordinator)
+                   for q in (build_queue, push_queue)]
+        for worker in workers:
+            worker.start()
+
+        completed = []
+        finished = False
+        while not finished:
+            finished = coordinator.finished()
+            completed.extend(coordinator.wait())
+        build_queue.close()
+        push_queue.close()
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+
+        self.assertEqual(['parent', 'child'],
+                         [task.name for task in completed])
+        # a failed task is retried before being reported
+        self.assertEqual(self.conf.retries + 1, child.run.call_count)
+
+    def test_coordinator_wait_timeout(self):
+        build_queue = build.TaskQueue()
+        build_queue.put(self._task('pending'))
+        coordinator = build.BuildCoordinator([build_queue])
+        self.assertEqual([], coordinator.wait(timeout=0.01))
+        self.assertFalse(coordinator.finished())
+
+    def test_count_retries(self):
+        task_queue = build.TaskQueue()
+        task = self._task('task', success=False)
+        task.kind = 'build'
+        task.image = build.Image('base', 'kolla/base:tag', '/base')
+        task_queue.put(task)
+        task_queue.close()
+        build.WorkerThread(self.conf, task_queue).run()
+
+        self.assertEqual(self.conf.retries,
+                         task.image.counters['build_retries'])
+        self.assertIn('build_queue', task.image.timings)
+
+    def test_trace(self):
+        recorder = trace.start_trace()
+        self.addCleanup(trace.stop_trace)
+        task_queue = build.TaskQueue()
+        child = self._task('child', success=False)
+        task_queue.put(self._task('parent', followups=[child]))
+        worker = build.WorkerThread(self.conf, task_queue, name='worker-0')
+        worker.start()
+        task_queue.join()
+        task_queue.close()
+        worker.join(10)
+
+        spans = dict((event['name'], event) for event in recorder.events
+                     if event['ph'] == 'X')
+        self.assertEqual({'parent', 'child'}, set(spans))
+        flows = dict((event['ph'], event) for event in recorder.events
+                     if event.get('cat') == 'flow')
+        self.assertEqual(flows['s']['id'], flows['f']['id'])
+        self.assertEqual(spans['child']['ts'], flows['f']['ts'])
+        self.assertLessEqual(flows['s']['ts'],
+                             spans['parent']['ts'] + spans['parent']['dur'])
+        self.assertEqual({'thread_name'}, set(
+            event['name'] for event in recorder.events
+            if event['ph'] == 'M'))
+
+    def test_queue_wait(self):
+        task_queue = build.TaskQueue()
+        task = self._task('task')
+        task_queue.put(task)
+        self.assertIs(task, task_queue.get())
+        self.assertGreaterEqual(task.queue_wait, 0)
+
+    def test_get_from_closed_queue(self):
+        task_queue = build.TaskQueue()
+        task = self._task('task')
+        task_queue.put(task)
+        task_queue.close()
+        self.assertIs(task, task_queue.get())
+        self.assertIsNone(task_queue.get())
+
+
+class SourcePrefetcherTest(base.TestCase):
+
+    def setUp(self):
+        super(SourcePrefetcherTest, self).setUp()
+        self.conf.set_override('install_type', 'source')
+        self.image = FAKE_IMAGE.copy()
+        self.image.path = self.useFixture(fixtures.TempDir()).path
+        self.image.source = {'source': 'http://fake/source', 'type': 'url',
+                             'name': 'image-base'}
+        self.image.plugins = [{'source': '/local/plugin', 'type': 'local',
+                               'name': 'image-base-plugin-local'}]
+        self.prefetcher = build.SourcePrefetcher(self.conf, 2)
+        self.addCleanup(self.prefetcher.shutdown)
+
+    @mock.patch.object(build.BuildTask, 'process_source')
+    def test_start(self, mock_process_source):
+        mock_process_source.return_value = '/fake/archive'
+        skipped = FAKE_IMAGE_CHILD.copy()
+        skipped.status = build.Status.SKIPPED
+        skipped.source = dict(self.image.source)
+        self.prefetcher.start([self.image, skipped])
+
+        # NOTE: local sources are not worth prefetching
+        self.assertEqual([('image-base', 'image-base')],
+                         list(self.prefetcher.futures))
+        self.assertEqual('/fake/archive',
+                         self.prefetcher.wait(self.image, self.image.source))
+        self.assertIsNone(self.prefetcher.wait(self.image,
+                                               self.image.plugins[0]))
+
+    @mock.patch('requests.get')
+    def test_failure_does_not_fail_image(self, mock_get):
+        mock_get.return_value.status_code = 404
+        self.prefetcher.start([self.image])
+
+        self.assertIsNone(self.prefetcher.wait(self.image, self.image.source))
+        self.assertEqual(build.Status.MATCHED, self.image.status)
+        self.assertNotIn('download_bytes', self.image.counters)
+
+    def test_download_bytes_of_used_archive(self):
+        def fetch(image, source):
+            image.count('download_bytes', 42)
+            return '/fake/archive'
+
+        with mock.patch.object(build.BuildTask, 'process_source',
+                               side_effect=fetch):
+            self.prefetcher.start([self.image])
+            self.assertEqual('/fake/archive', self.prefetcher.wait(
+                self.image, self.image.source))
+        self.assertEqual(42, self.image.counters['download_bytes'])
+
+    def test_start_binary(self):
+        self.conf.set_override('install_type', 'binary')
+        self.prefetcher.start([self.image])
+        self.assertEqual({}, self.prefetcher.futures)
+
+    @mock.patch.object(build.SourcePrefetcher, 'wait')
+    def test_build_task_uses_prefetched(self, mock_wait):
+        mock_wait.return_value = '/fake/archive'
+        builder = build.BuildTask(self.conf, self.image, mock.Mock(),
+                                  prefetcher=self.prefetcher)
+
+        self.assertEqual('/fake/archive',
+                         builder.process_source(self.image,
+                                                self.image.source))
+        mock_wait.assert_called_once_with(self.image, self.image.source)
+
+
 class KollaWorkerTest(base.TestCase):
 
     config_file = 'default.conf'
@@ -489,9 +879,11 @@ class KollaWorkerTest(base.TestCase):
         self.assertEqual(build.Status.SKIPPED, kolla.images[2].parent.status)
         self.assertEqual(build.Status.SKIPPED, kolla.images[1].parent.status)
 
-    @mock.patch.object(build.Image, 'in_docker_cache')
-    def test_skip_existing(self, mock_in_cache):
-        mock_in_cache.side_effect = [True, False]
+    def test_skip_existing(self):
+        self.mock_client.return_value.images.return_value = [
+            {'RepoTags': ['image-base:latest', 'other:latest']},
+            {'RepoTags': None},
+        ]
         self.conf.set_override('skip_existing', True)
         kolla = build.KollaWorker(self.conf)
         kolla.images = self.images[:2]
@@ -501,6 +893,26 @@ class KollaWorkerTest(base.TestCase):
 
         self.assertEqual(build.Status.SKIPPED, kolla.images[0].status)
         self.assertEqual(build.Status.MATCHED, kolla.images[1].status)
+        self.mock_client.return_value.images.assert_called_once_with()
+
+    @mock.patch('kolla.image.registry.RegistryClient.has_manifest')
+    def test_skip_existing_in_registry(self, mock_has_manifest):
+        mock_has_manifest.side_effect = (
+            lambda repository, tag: repository == 'kolla/image-base')
+        self.conf.set_override('skip_existing', True)
+        self.conf.set_override('existing_images_source', 'registry')
+        self.conf.set_override('registry', 'localhost:4000')
+        kolla = build.KollaWorker(self.conf)
+        kolla.images = [image.copy() for image in self.images[:2]]
+        for i in kolla.images:
+            i.canonical_name = 'localhost:4000/kolla/%s:master' % i.name
+            i.status = build.Status.UNPROCESSED
+        kolla.filter_images()
+
+        self.assertEqual(build.Status.SKIPPED, kolla.images[0].status)
+        self.assertEqual(build.Status.MATCHED, kolla.images[1].status)
+        mock_has_manifest.assert_any_call('kolla/image-base', 'master')
+        self.mock_client.return_value.images.assert_not_called()
 
     def test_without_profile(self):
         kolla = build.KollaWorker(self.conf)
@@ -613,6 +1025,329 @@ class KollaWorkerTest(base.TestCase):
         self.assertEqual('error', results['failed'][0]['status'])  # bad
         self.assertEqual('error', results['failed'][1]['status'])  # bad2
 
+    def test_summary_timings(self):
+        kolla = build.KollaWorker(self.conf)
+        kolla.images = self.images
+        self.images[0].add_timing('build', 2.5)
+        self.images[0].add_timing('build', 1.25)
+        self.images[1].add_timing('build_queue', 1)
+        kolla.image_statuses_good[self.images[0].name] = build.Status.BUILT
+        results = kolla.summary()
+        self.assertEqual({'build': 3.75}, results['built'][0]['timings'])
+
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'timings.json')
+        kolla.save_timings(path)
+        with open(path) as f:
+            timings = json.load(f)
+        self.assertEqual({'build': 3.75, 'build_queue': 1},
+                         timings['totals'])
+        self.assertEqual({'build_queue': 1},
+                         timings['images'][self.images[1].name])
+
+    def test_summary_cache(self):
+        kolla = build.KollaWorker(self.conf)
+        kolla.images = self.images
+        for image in self.images[:2]:
+            parser = steps.BuildStepParser()
+            for line in ('Step 1/3 : FROM base', 'Step 2/3 : RUN true',
+                         ' ---> Using cache', 'Step 3/3 : ADD . /'):
+                parser.feed(line)
+            parser.close()
+            image.build_steps = parser.steps
+        kolla.image_statuses_good[self.images[0].name] = build.Status.BUILT
+        results = kolla.summary()
+
+        cache = results['built'][0]['cache']
+        self.assertEqual(3, cache['steps'])
+        self.assertEqual(1, cache['cached_steps'])
+        self.assertEqual('ADD . /',
+                         cache['cache_invalidated_by']['instruction'])
+        self.assertEqual(6, results['cache']['steps'])
+        self.assertEqual(2, results['cache']['cached_steps'])
+        self.assertEqual(
+            [{'instruction': 'ADD . /', 'count': 2,
+              'images': sorted(image.name for image in self.images[:2])}],
+            results['cache']['invalidated_by'])
+
+    def test_compute_priorities(self):
+        kolla = build.KollaWorker(self.conf)
+        image_grandchild = FAKE_IMAGE_GRANDCHILD.copy()
+        image_grandchild.parent = self.images[1]
+        self.images[1].children.append(image_grandchild)
+        kolla.images = self.images[:2] + [image_grandchild] + self.images[2:]
+        for i in kolla.images:
+            i.status = build.Status.MATCHED
+            if i.parent and i not in i.parent.children:
+                i.parent.children.append(i)
+        self.images[2].status = build.Status.UNMATCHED
+        kolla.compute_priorities()
+
+        base, child, grandchild, unmatched, error, built = kolla.images
+        self.assertEqual(1, grandchild.priority)
+        self.assertEqual(1, error.priority)
+        self.assertGreater(child.priority, error.priority)
+        self.assertGreater(base.priority, child.priority)
+        # unmatched children do not count as descendants
+        self.assertAlmostEqual(3 + 4.0 / 7, base.priority)
+
+    def test_compute_priorities_history(self):
+        self.conf.set_override('history_file', '/nonexistent/history.json')
+        kolla = build.KollaWorker(self.conf)
+        kolla.images = self.images[:2] + [self.images[3]]
+        for i in kolla.images:
+            i.status = build.Status.MATCHED
+            if i.parent and i not in i.parent.children:
+                i.parent.children.append(i)
+        kolla.history.record_build('image-base', 10)
+        kolla.history.record_build('image-child', 100)
+        kolla.compute_priorities()
+
+        base_image, child, error = kolla.images
+        self.assertEqual(100, child.priority)
+        # unknown images cost the average of the known ones
+        self.assertEqual(55, error.priority)
+        self.assertAlmostEqual(110 + 2.0 / 4, base_image.priority)
+
+    def test_estimate_remaining_time(self):
+        self.conf.set_override('history_file', '/nonexistent/history.json')
+        self.conf.set_override('threads', 2)
+        kolla = build.KollaWorker(self.conf)
+        kolla.images = self.images[:2] + [self.images[3]]
+        for i in kolla.images:
+            i.status = build.Status.MATCHED
+            if i.parent and i not in i.parent.children:
+                i.parent.children.append(i)
+        kolla.history.record_build('image-base', 10)
+        kolla.history.record_build('image-child', 100)
+        kolla.history.record_build('image-child-error', 20)
+
+        self.assertEqual(110, kolla.estimate_remaining_time())
+        # NOTE: the build of the image may not have recorded its start yet
+        kolla.images[0].status = build.Status.BUILDING
+        kolla.images[0].start = None
+        self.assertEqual(110, kolla.estimate_remaining_time())
+        kolla.images[0].status = build.Status.ERROR
+        self.assertEqual(0, kolla.estimate_remaining_time())
+
+    def test_build_queue_priority(self):
+        queue = build.TaskQueue()
+        leaf = mock.Mock(priority=1)
+        chain = mock.Mock(priority=3)
+        other_leaf = mock.Mock(priority=1)
+        for task in (leaf, chain, other_leaf):
+            queue.put(task)
+
+        self.assertIs(chain, queue.get())
+        self.assertIs(leaf, queue.get())
+        self.assertIs(other_leaf, queue.get())
+
+    def _render(self):
+        self.conf.set_override('work_dir',
+                               self.useFixture(fixtures.TempDir()).path)
+        kolla = build.KollaWorker(self.conf)
+        kolla.setup_working_dir()
+        kolla.find_dockerfiles()
+        kolla.create_dockerfiles()
+        return kolla
+
+    def test_create_dockerfiles_bytecode_cache(self):
+        cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('template_cache_dir', cache_dir)
+        self._render()
+        self.assertEqual(2, len(os.listdir(cache_dir)))
+
+        with mock.patch.object(jinja_cache.TemplateBytecodeCache,
+                               'dump_bytecode') as mock_dump:
+            kolla = self._render()
+        mock_dump.assert_not_called()
+        with open(os.path.join(kolla.working_dir, 'neutron-server',
+                               'Dockerfile')) as f:
+            self.assertEqual('FROM kolla/centos-source-base:%s' %
+                             self.conf.tag, f.read().strip())
+
+    def test_create_dockerfiles_without_bytecode_cache(self):
+        with mock.patch.object(jinja_cache, 'TemplateBytecodeCache') as cache:
+            self._render()
+        cache.assert_not_called()
+
+    def test_create_dockerfiles_template_override(self):
+        override = self.useFixture(fixtures.TempDir()).join('override.j2')
+        with open(override, 'w') as f:
+            f.write('{% extends parent_template %}\n')
+        self.conf.set_override('template_override', [override])
+        self.conf.set_override('template_cache_dir',
+                               self.useFixture(fixtures.TempDir()).path)
+
+        with mock.patch.object(build.KollaWorker, '_merge_overrides',
+                               wraps=lambda overrides: {
+                                   'override.j2': open(override).read()}
+                               ) as mock_merge:
+            kolla = self._render()
+        mock_merge.assert_called_once_with([override])
+        with open(os.path.join(kolla.working_dir, 'base',
+                               'Dockerfile')) as f:
+            self.assertTrue(f.read().startswith('FROM centos:'))
+
+    def test_create_dockerfiles_in_processes(self):
+        sequential = self._render()
+        self.conf.set_override('template_cache_dir',
+                               self.useFixture(fixtures.TempDir()).path)
+        self.conf.set_override('render_processes', 2)
+        parallel = self._render()
+
+        for image_name in ('base', 'neutron-server'):
+            with open(os.path.join(sequential.working_dir, image_name,
+                                   'Dockerfile')) as f:
+                expected = f.read()
+            with open(os.path.join(parallel.working_dir, image_name,
+                                   'Dockerfile')) as f:
+                self.assertEqual(expected, f.read())
+
+    def test_create_dockerfiles_in_processes_errors(self):
+        docker_dir = self.useFixture(fixtures.TempDir()).path
+        for image_name in ('broken-one', 'broken-two'):
+            os.mkdir(os.path.join(docker_dir, image_name))
+            with open(os.path.join(docker_dir, image_name, 'Dockerfile.j2'),
+                      'w') as f:
+                f.write('{% if %}\n')
+        self.conf.set_override('docker_dir', [docker_dir])
+        self.conf.set_override('render_processes', 2)
+
+        error = self.assertRaises(exception.KollaTemplateRenderException,
+                                  self._render)
+        self.assertIn('Failed to render 2 Dockerfiles', str(error))
+        self.assertIn('broken-one: TemplateSyntaxError',
+                      str(error))
+        self.assertIn('broken-two: TemplateSyntaxError',
+                      str(error))
+
+    def test_create_dockerfiles_in_processes_override_error(self):
+        override = self.useFixture(fixtures.TempDir()).join('override.j2')
+        with open(override, 'w') as f:
+            f.write('{% extends parent_template %}\n{% if %}\n')
+        self.conf.set_override('template_override', [override])
+        self.conf.set_override('render_processes', 2)
+
+        with mock.patch('concurrent.futures.ProcessPoolExecutor') as pool:
+            self.assertRaises(build.jinja2.TemplateSyntaxError, self._render)
+        pool.assert_not_called()
+
+    def test_get_users_memoized(self):
+        kolla = build.KollaWorker(self.conf)
+        users = kolla.get_users()
+
+        with mock.patch.object(self.conf, 'list_all_sections') as mock_list:
+            self.assertIs(users, kolla.get_users())
+        mock_list.assert_not_called()
+        self.assertIn('keystone', users)
+
+    def _load_images(self):
+        self.conf.set_override('work_dir',
+                               self.useFixture(fixtures.TempDir()).path)
+        kolla = build.KollaWorker(self.conf)
+        kolla.setup_working_dir()
+        kolla.find_dockerfiles()
+        kolla.create_dockerfiles()
+        kolla.build_image_list()
+        kolla.find_parents()
+        return kolla
+
+    def _statuses(self, kolla):
+        return dict((image.name, image.status) for image in kolla.images)
+
+    def test_filter_images_changed_files(self):
+        self.conf.set_override('changed_files', [os.path.join(
+            base.TESTS_ROOT, 'docker', 'neutron-server', 'Dockerfile.j2')])
+        kolla = self._load_images()
+        kolla.filter_images()
+
+        # NOTE: parents of changed images are built too
+        self.assertEqual({'base': build.Status.MATCHED,
+                          'neutron-server': build.Status.MATCHED},
+                         self._statuses(kolla))
+
+    def test_filter_images_changed_files_none_impacted(self):
+        self.conf.set_override('changed_files', ['README.rst'])
+        kolla = self._load_images()
+        kolla.filter_images()
+
+        self.assertEqual({'base': build.Status.UNMATCHED,
+                          'neutron-server': build.Status.UNMATCHED},
+                         self._statuses(kolla))
+
+    def test_filter_images_changed_files_relative(self):
+        top_level = git.Git(base.TESTS_ROOT).rev_parse('--show-toplevel')
+        self.conf.set_override('changed_files', [os.path.relpath(
+            os.path.join(base.TESTS_ROOT, 'docker', 'neutron-server',
+                         'Dockerfile.j2'), top_level)])
+        kolla = self._load_images()
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.useFixture(fixtures.TempDir()).path)
+        kolla.filter_images()
+
+        self.assertEqual({'base': build.Status.MATCHED,
+                          'neutron-server': build.Status.MATCHED},
+                         self._statuses(kolla))
+
+    @mock.patch('kolla.image.impact.git_changed_files')
+    def test_filter_images_changed_since_error(self, mock_changed):
+        mock_changed.side_effect = build.impact.ImpactError('not a checkout')
+        self.conf.set_override('changed_since', 'HEAD~1')
+        kolla = self._load_images()
+        self.assertRaises(SystemExit, kolla.filter_images)
+
+    @mock.patch('kolla.image.impact.git_changed_files')
+    def test_filter_images_changed_since_regex(self, mock_changed):
+        mock_changed.return_value = [os.path.join(
+            base.TESTS_ROOT, 'docker', 'base', 'Dockerfile.j2')]
+        self.conf.set_override('changed_since', 'HEAD~1')
+        self.conf.set_override('regex', ['base'])
+        kolla = self._load_images()
+        kolla.filter_images()
+
+        mock_changed.assert_called_once_with(kolla.images_dir, 'HEAD~1')
+        self.assertEqual({'base': build.Status.MATCHED,
+                          'neutron-server': build.Status.UNMATCHED},
+                         self._statuses(kolla))
+
+    def test_select_images(self):
+        self.conf.set_override('regex', ['^neutron'])
+        kolla = build.KollaWorker(self.conf)
+
+        self.assertEqual({'base', 'neutron-server'}, kolla.select_images())
+
+    def test_select_images_unknown_parent(self):
+        docker_dir = self.useFixture(fixtures.TempDir()).path
+        os.mkdir(os.path.join(docker_dir, 'custom'))
+        with open(os.path.join(docker_dir, 'custom', 'Dockerfile.j2'),
+                  'w') as f:
+            f.write('FROM {{ namespace }}/{{ parent_image }}:{{ tag }}\n')
+        self.conf.set_override('docker_dir', [docker_dir])
+        self.conf.set_override('regex', ['custom'])
+        kolla = build.KollaWorker(self.conf)
+
+        self.assertIsNone(kolla.select_images())
+
+    def test_select_images_without_filter(self):
+        kolla = build.KollaWorker(self.conf)
+
+        self.assertIsNone(kolla.select_images())
+
+    def test_selective_work_dir(self):
+        work_dir = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('work_dir', work_dir)
+        self.conf.set_override('regex', ['^base$'])
+        self.conf.set_override('selective_render', True)
+        kolla = build.KollaWorker(self.conf)
+        kolla.setup_working_dir()
+        kolla.find_dockerfiles()
+
+        self.assertEqual([os.path.join(kolla.working_dir, 'base')],
+                         kolla.docker_build_paths)
+        self.assertFalse(os.path.exists(os.path.join(kolla.working_dir,
+                                                     'neutron-server')))
+
     @mock.patch('shutil.copytree')
     def test_work_dir(self, copytree_mock):
         self.conf.set_override('work_dir', 'tmp/foo')
@@ -650,6 +1385,15 @@ class MainTest(base.TestCase):
         result = build_cmd.main()
         self.assertEqual(1, result)
 
+    @mock.patch.object(build, 'run_build')
+    def test_render_errors(self, mock_run_build):
+        mock_run_build.side_effect = exception.KollaTemplateRenderException(
+            'Failed to render 2 Dockerfiles')
+        with mock.patch.object(build.LOG, 'error') as mock_error:
+            result = build_cmd.main()
+        self.assertEqual(1, result)
+        mock_error.assert_called_once_with('%s', mock.ANY)
+
     @mock.patch('sys.argv')
     @mock.patch('docker.APIClient')
     def test_run_build(self, mock_client, mock_sys):
@@ -0,0 +1,111 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from unittest import mock
+
+from requests import exceptions as requests_exc
+
+from kolla.image import docker_client
+from kolla.tests import base
+
+
+@mock.patch('docker.APIClient')
+class DockerClientPoolTest(base.TestCase):
+
+    def setUp(self):
+        super(DockerClientPoolTest, self).setUp()
+        self.pool = docker_client.DockerClientPool(2, base_url='unix://x')
+
+    def _in_thread(self, func):
+        result = list()
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_version_negotiated_once(self, mock_client):
+        clients = [mock.Mock(api_version='1.41'), mock.Mock()]
+        mock_client.side_effect = clients
+
+        self.assertIs(clients[0], self.pool.get())
+        self.assertIs(clients[1], self._in_thread(self.pool.get))
+        self.assertEqual([mock.call(version='auto', base_url='unix://x'),
+                          mock.call(version='1.41', base_url='unix://x')],
+                         mock_client.call_args_list)
+
+    def test_client_per_thread(self, mock_client):
+        mock_client.side_effect = lambda **kwargs: mock.Mock(
+            api_version='1.41')
+
+        client = self.pool.get()
+        self.assertIs(client, self.pool.get())
+        self.assertIsNot(client, self._in_thread(self.pool.get))
+        client.ping.assert_not_called()
+
+    def test_check_after_failure(self, mock_client):
+        broken = mock.Mock(api_version='1.41')
+        broken.ping.side_effect = requests_exc.ConnectionError
+        fresh = mock.Mock()
+        mock_client.side_effect = [broken, fresh]
+
+        self.assertIs(broken, self.pool.get())
+        self.pool.report_failure()
+        self.assertIs(fresh, self.pool.get())
+        broken.close.assert_called_once_with()
+
+    def test_check_after_idle(self, mock_client):
+        client = mock.Mock(api_version='1.41')
+        mock_client.return_value = client
+        self.pool.check_interval = 0
+
+        self.assertIs(client, self.pool.get())
+        self.assertIs(client, self.pool.get())
+        client.ping.assert_called_once_with()
+        self.assertEqual(1, mock_client.call_count)
+
+    def test_reuse_released_client(self, mock_client):
+        mock_client.side_effect = lambda **kwargs: mock.Mock(
+            api_version='1.41')
+        self.pool.size = 1
+        client = self._in_thread(lambda: (self.pool.get(),
+                                          self.pool.release())[0])
+
+        self.assertIs(client, self.pool.get())
+        self.assertEqual(1, mock_client.call_count)
+        self.assertEqual(1, self.pool.connected)
+
+    def test_wait_when_full(self, mock_client):
+        mock_client.side_effect = lambda **kwargs: mock.Mock(
+            api_version='1.41')
+        self.pool.size = 1
+        client = self.pool.get()
+        got = list()
+        thread = threading.Thread(target=lambda: got.append(self.pool.get()))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+
+        self.pool.release()
+        thread.join(10)
+        self.assertEqual([client], got)
+        self.assertEqual(1, mock_client.call_count)
+
+    def test_release_failed_client(self, mock_client):
+        client = mock.Mock(api_version='1.41')
+        mock_client.return_value = client
+        self.pool.get()
+        self.pool.report_failure()
+        self.pool.release()
+
+        client.close.assert_called_once_with()
+        self.assertEqual(0, self.pool.connected)
@@ -0,0 +1,76 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from kolla.image import build
+from kolla.image import graph
+from kolla.tests import base
+
+
+def _image(name, parent_name=None, prefix='centos-binary-'):
+    return build.Image(name, 'kolla/%s%s:tag' % (prefix, name),
+                       '/fake/%s' % name, parent_name=parent_name)
+
+
+class ImageGraphTest(base.TestCase):
+
+    def setUp(self):
+        super(ImageGraphTest, self).setUp()
+        self.base = _image('base')
+        self.openstack = _image('openstack-base',
+                                'kolla/centos-binary-base:tag')
+        self.nova = _image('nova-base',
+                           'kolla/centos-binary-openstack-base:tag')
+        self.nova_api = _image('nova-api', 'kolla/centos-binary-nova-base:tag')
+        # NOTE: infra images name their parent with the infra prefix
+        self.cron = _image('cron', 'kolla/centos-infra-base:tag',
+                           prefix='centos-infra-')
+        # NOTE: children listed before their parents
+        self.images = [self.nova_api, self.cron, self.nova, self.openstack,
+                       self.base]
+        self.graph = graph.ImageGraph.link(self.images, 'binary')
+
+    def test_link(self):
+        self.assertIsNone(self.base.parent)
+        self.assertIs(self.base, self.openstack.parent)
+        self.assertIs(self.base, self.cron.parent)
+        self.assertIs(self.nova, self.nova_api.parent)
+        self.assertEqual([self.cron, self.openstack], self.base.children)
+        self.assertIs(self.nova, self.graph.get('nova-base'))
+
+    def test_topological_order(self):
+        order = self.graph.topological_order()
+
+        self.assertEqual(len(self.images), len(order))
+        for image in order:
+            if image.parent is not None:
+                self.assertLess(order.index(image.parent), order.index(image))
+
+    def test_ancestors(self):
+        self.assertEqual((self.nova, self.openstack, self.base),
+                         self.graph.ancestors(self.nova_api))
+        self.assertEqual((self.openstack, self.base),
+                         self.graph.ancestors(self.nova))
+        self.assertEqual((), self.graph.ancestors(self.base))
+
+    def test_descendants(self):
+        self.assertEqual({'nova-base', 'nova-api'},
+                         self.graph.descendants(self.openstack))
+        self.assertEqual({'cron', 'openstack-base', 'nova-base', 'nova-api'},
+                         self.graph.descendants(self.base))
+        self.assertEqual(set(), self.graph.descendants(self.nova_api))
+
+    def test_roots_parent_outside_graph(self):
+        subgraph = graph.ImageGraph([self.nova, self.nova_api])
+
+        self.assertEqual([self.nova], subgraph.roots())
+        self.assertEqual([self.nova, self.nova_api],
+                         subgraph.topological_order())
@@ -0,0 +1,61 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+
+import fixtures
+
+from kolla.image import history
+from kolla.tests import base
+
+
+class BuildHistoryTest(base.TestCase):
+
+    def setUp(self):
+        super(BuildHistoryTest, self).setUp()
+        self.path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'history.json')
+
+    def _history(self, base_distro='centos'):
+        return history.BuildHistory(self.path, base_distro, 'source',
+                                    'x86_64')
+
+    def test_missing_file(self):
+        self.assertIsNone(self._history().build_time('nova-base'))
+
+    def test_record_and_reload(self):
+        hist = self._history()
+        hist.record_build('nova-base', 100, cached_steps=1, steps=4)
+        hist.record_push('nova-base', 10)
+        hist.save()
+
+        hist = self._history()
+        self.assertEqual(100, hist.build_time('nova-base'))
+        self.assertEqual(10, hist.push_time('nova-base'))
+        self.assertEqual(0.25, hist.get('nova-base')['cache_hit_ratio'])
+
+    def test_moving_average(self):
+        hist = self._history()
+        hist.record_build('nova-base', 100)
+        hist.record_build('nova-base', 50)
+        self.assertEqual(75, hist.build_time('nova-base'))
+
+    def test_keyed_by_target(self):
+        hist = self._history()
+        hist.record_build('nova-base', 100)
+        hist.save()
+        self.assertIsNone(self._history('ubuntu').build_time('nova-base'))
+
+    def test_unreadable_file(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.assertEqual({}, self._history().entries)
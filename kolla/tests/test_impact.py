@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest import mock
+
+import fixtures
+
+from kolla.image import impact
+from kolla.tests import base
+
+
+class ChangedImagesTest(base.TestCase):
+
+    def setUp(self):
+        super(ChangedImagesTest, self).setUp()
+        self.root = self.useFixture(fixtures.TempDir()).path
+        self.docker_dir = os.path.join(self.root, 'docker')
+        for path in ('macros.j2', 'base/Dockerfile.j2',
+                     'nova/nova-base/Dockerfile.j2',
+                     'nova/nova-base/extend_start.sh',
+                     'nova/nova-api/Dockerfile.j2'):
+            path = os.path.join(self.docker_dir, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        self.override = os.path.join(self.root, 'override.j2')
+
+    def _changed(self, *paths):
+        return impact.changed_images(
+            [os.path.join(self.root, path) for path in paths],
+            [self.docker_dir], [self.override])
+
+    def test_image_files(self):
+        self.assertEqual({'nova-base', 'nova-api'},
+                         self._changed('docker/nova/nova-base/extend_start.sh',
+                                       'docker/nova/nova-api/Dockerfile.j2'))
+
+    def test_deleted_image_file(self):
+        self.assertEqual({'nova-base'},
+                         self._changed('docker/nova/nova-base/gone/file'))
+
+    def test_shared_templates(self):
+        self.assertIsNone(self._changed('docker/nova/nova-api/Dockerfile.j2',
+                                        'docker/macros.j2'))
+        self.assertIsNone(self._changed('override.j2'))
+
+    def test_other_files(self):
+        self.assertEqual(set(), self._changed('doc/source/index.rst',
+                                              'docker-compose.yml'))
+
+    @mock.patch('git.Git')
+    def test_git_changed_files(self, mock_git):
+        mock_git.return_value.rev_parse.return_value = '/repo'
+        mock_git.return_value.diff.return_value = (
+            'docker/macros.j2\nREADME.rst\n')
+
+        self.assertEqual(['/repo/docker/macros.j2', '/repo/README.rst'],
+                         impact.git_changed_files('/repo/docker',
+                                                  'origin/master..HEAD'))
+        mock_git.assert_has_calls([mock.call('/repo/docker'),
+                                   mock.call('/repo')], any_order=True)
+        mock_git.return_value.diff.assert_called_once_with(
+            '--name-only', 'origin/master..HEAD')
+
+    def test_git_changed_files_not_a_checkout(self):
+        self.assertIsNone(impact.git_top_level(self.root))
+        self.assertRaises(impact.ImpactError, impact.git_changed_files,
+                          self.root, 'HEAD~1')
+
+    @mock.patch('git.Git')
+    def test_git_changed_files_unknown_revision(self, mock_git):
+        mock_git.return_value.rev_parse.return_value = '/repo'
+        mock_git.return_value.diff.side_effect = impact.git.GitCommandError(
+            'diff', 128, stderr='fatal: bad revision')
+        error = self.assertRaises(impact.ImpactError,
+                                  impact.git_changed_files, '/repo',
+                                  'missing')
+        self.assertIn('bad revision', str(error))
+
+    def test_resolve_paths(self):
+        self.assertEqual(['/repo/docker/macros.j2', '/abs/file'],
+                         impact.resolve_paths(['docker/macros.j2',
+                                               '/abs/file'], '/repo'))
+        self.assertEqual([os.path.join(os.getcwd(), 'file')],
+                         impact.resolve_paths(['file']))
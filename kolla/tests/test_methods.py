@@ -10,12 +10,31 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from unittest import mock
+
 from kolla.template import methods
 from kolla.tests import base
 
 
 class MethodsTest(base.TestCase):
 
+    def test_handle_repos_memoized(self):
+        template_vars = {
+            'base_arch': 'x86_64',
+            'base_distro': 'centos',
+            'base_package_type': 'rpm',
+        }
+
+        with mock.patch('yaml.safe_load',
+                        wraps=methods.yaml.safe_load) as mock_load:
+            first = methods.handle_repos(template_vars, ['grafana'],
+                                         'enable')
+            second = methods.handle_repos(template_vars, ['grafana'],
+                                          'enable')
+            methods.handle_repos(template_vars, ['grafana'], 'disable')
+        self.assertEqual(first, second)
+        mock_load.assert_called_once()
+
     def test_debian_package_install(self):
         packages = ['https://packages.debian.org/package1.deb', 'package2.deb']
         result = methods.debian_package_install(packages)
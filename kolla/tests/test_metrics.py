@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from unittest import mock
+import urllib.request
+
+import fixtures
+
+from kolla.image import build
+from kolla.image import metrics
+from kolla.tests import base
+
+
+class BuildMetricsTest(base.TestCase):
+
+    def setUp(self):
+        super(BuildMetricsTest, self).setUp()
+        built = build.Image('base', 'kolla/base:tag', '/base',
+                            status=build.Status.BUILT)
+        built.add_timing('build', 12.5)
+        built.add_timing('push', 3)
+        built.count('build_retries')
+        built.count('steps', 10)
+        built.count('cached_steps', 8)
+        built.count('download_bytes', 1024)
+        unmatched = build.Image('nova"api', 'kolla/nova-api:tag', '/nova',
+                                status=build.Status.UNMATCHED)
+        self.metrics = metrics.BuildMetrics(
+            [built, unmatched], {'build': mock.Mock(**{'qsize.return_value':
+                                                       2}),
+                                 'push': mock.Mock(**{'qsize.return_value':
+                                                      0})})
+
+    def test_render(self):
+        lines = self.metrics.render().splitlines()
+        for line in [
+                '# TYPE kolla_build_images gauge',
+                'kolla_build_images{status="built"} 1.0',
+                'kolla_build_images{status="unmatched"} 1.0',
+                'kolla_build_queue_depth{queue="build"} 2.0',
+                'kolla_build_queue_depth{queue="push"} 0.0',
+                'kolla_build_image_phase_seconds{image="base",phase="build"}'
+                ' 12.5',
+                'kolla_build_image_phase_seconds{image="base",phase="push"}'
+                ' 3.0',
+                '# TYPE kolla_build_image_retries_total counter',
+                'kolla_build_image_retries_total{image="base",task="build"}'
+                ' 1.0',
+                'kolla_build_image_steps_total{image="base"} 10.0',
+                'kolla_build_image_cached_steps_total{image="base"} 8.0',
+                'kolla_build_image_download_bytes_total{image="base"}'
+                ' 1024.0']:
+            self.assertIn(line, lines)
+        self.assertNotIn('task="push"', self.metrics.render())
+        self.assertNotIn('nova', self.metrics.render())
+
+    def test_escape(self):
+        self.assertEqual('m{a="x\\"y\\\\z\\n"} 1.0',
+                         metrics._sample('m', {'a': 'x"y\\z\n'}, 1))
+
+    def test_write(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'kolla.prom')
+        self.metrics.write(path)
+        with open(path) as f:
+            self.assertEqual(self.metrics.render(), f.read())
+        self.assertEqual(['kolla.prom'], os.listdir(os.path.dirname(path)))
+
+    def test_serve(self):
+        server = self.metrics.serve('127.0.0.1', 0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/metrics' % server.server_address[1]
+        with urllib.request.urlopen(url, timeout=10) as response:
+            self.assertEqual(metrics.CONTENT_TYPE,
+                             response.headers['Content-Type'])
+            self.assertEqual(self.metrics.render(),
+                             response.read().decode('utf-8'))
@@ -0,0 +1,107 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from unittest import mock
+
+from kolla.image import build
+from kolla.image import push
+from kolla.image import registry
+from kolla.tests import base
+
+
+class PushProgressTest(base.TestCase):
+
+    def test_update(self):
+        progress = push.PushProgress()
+        for response in [
+                {'status': 'The push refers to repository [kolla/nova]'},
+                {'status': 'Preparing', 'id': 'a'},
+                {'status': 'Mounted from kolla/base', 'id': 'a'},
+                {'status': 'Layer already exists', 'id': 'b'},
+                {'status': 'Pushing', 'id': 'c',
+                 'progressDetail': {'current': 512, 'total': 2048}},
+                {'status': 'Pushing', 'id': 'c',
+                 'progressDetail': {'current': 2048, 'total': 2048}},
+                {'status': 'Pushed', 'id': 'c'},
+                {'status': 'Pushing', 'id': 'd',
+                 'progressDetail': {'current': 10}}]:
+            progress.update(response)
+
+        self.assertEqual(2048, progress.bytes_pushed)
+        self.assertEqual({'a'}, progress.mounted)
+        self.assertEqual({'b'}, progress.existing)
+        self.assertEqual('2048 bytes in 1 layers, 1 layers mounted,'
+                         ' 1 layers already present', str(progress))
+
+
+class PushPipelineTest(base.TestCase):
+
+    def setUp(self):
+        super(PushPipelineTest, self).setUp()
+        self.conf.set_override('registry', 'localhost:4000')
+        self.parent = build.Image(
+            'base', 'localhost:4000/kolla/centos-source-base:master', '/base')
+        self.image = build.Image(
+            'nova-base', 'localhost:4000/kolla/centos-source-nova-base:master',
+            '/nova-base')
+        self.image.parent = self.parent
+        self.pipeline = push.PushPipeline(self.conf)
+
+    def test_wait_for_parent(self):
+        self.pipeline.register(self.parent)
+        self.pipeline.register(self.image)
+        waiter = threading.Thread(target=self.pipeline.wait_for_parent,
+                                  args=(self.image,))
+        waiter.start()
+        waiter.join(0.1)
+        self.assertTrue(waiter.is_alive())
+
+        self.pipeline.done(self.parent)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+
+    def test_wait_for_parent_not_pushed(self):
+        self.pipeline.register(self.image)
+        self.pipeline.wait_for_parent(self.image)
+        self.pipeline.wait_for_parent(self.parent)
+
+    @mock.patch('kolla.image.registry.get_client')
+    def test_mount_parent_layers(self, mock_get_client):
+        client = mock_get_client.return_value
+        client.get_layers.return_value = ['sha256:a', 'sha256:b']
+        client.mount_blob.return_value = True
+
+        self.assertEqual(2, self.pipeline.mount_parent_layers(self.image))
+        client.get_layers.assert_called_once_with(
+            'kolla/centos-source-base', 'master')
+        client.mount_blob.assert_has_calls([
+            mock.call('kolla/centos-source-nova-base', 'sha256:a',
+                      'kolla/centos-source-base'),
+            mock.call('kolla/centos-source-nova-base', 'sha256:b',
+                      'kolla/centos-source-base')])
+
+    @mock.patch('kolla.image.registry.get_client')
+    def test_mount_parent_layers_refused(self, mock_get_client):
+        client = mock_get_client.return_value
+        client.get_layers.return_value = ['sha256:a', 'sha256:b']
+        client.mount_blob.return_value = False
+
+        self.assertEqual(0, self.pipeline.mount_parent_layers(self.image))
+        self.assertEqual(1, client.mount_blob.call_count)
+
+    @mock.patch('kolla.image.registry.get_client')
+    def test_mount_parent_layers_error(self, mock_get_client):
+        mock_get_client.return_value.get_layers.side_effect = (
+            registry.RegistryError)
+        self.assertEqual(0, self.pipeline.mount_parent_layers(self.image))
+        self.assertEqual(0, self.pipeline.mount_parent_layers(self.parent))
@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from unittest import mock
+
+from requests import exceptions as requests_exc
+
+from kolla.image import registry
+from kolla.tests import base
+
+
+def fake_response(status_code=200, json=None, headers=None):
+    response = mock.Mock(status_code=status_code, headers=headers or {})
+    response.json.return_value = json
+    return response
+
+
+class SplitImageNameTest(base.TestCase):
+
+    def test_with_registry(self):
+        self.assertEqual(
+            ('localhost:4000', 'kolla/centos-source-base', 'master'),
+            registry.split_image_name(
+                'localhost:4000/kolla/centos-source-base:master',
+                'localhost:4000'))
+
+    def test_docker_hub(self):
+        self.assertEqual(
+            (registry.DOCKER_HUB, 'kolla/centos-source-base', 'master'),
+            registry.split_image_name('kolla/centos-source-base:master'))
+
+    def test_without_tag(self):
+        self.assertEqual(
+            ('localhost:4000', 'kolla/base', 'latest'),
+            registry.split_image_name('localhost:4000/kolla/base',
+                                      'localhost:4000'))
+
+
+class RegistryClientTest(base.TestCase):
+
+    def setUp(self):
+        super(RegistryClientTest, self).setUp()
+        self.client = registry.RegistryClient('localhost:4000')
+        self.session = mock.Mock()
+        self.client.session_factory = lambda: self.session
+
+    def test_base_url_falls_back_to_http(self):
+        self.session.get.side_effect = [requests_exc.SSLError,
+                                        fake_response()]
+        self.assertEqual('http://localhost:4000', self.client.base_url)
+        self.assertEqual('http://localhost:4000', self.client.base_url)
+        self.assertEqual(2, self.session.get.call_count)
+
+    def test_get_labels(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.side_effect = [
+            fake_response(json={'config': {'digest': 'sha256:abc'}}),
+            fake_response(json={'config': {'Labels': {'a': 'b'}}}),
+        ]
+        self.assertEqual({'a': 'b'},
+                         self.client.get_labels('kolla/base', 'master'))
+        self.session.request.assert_called_with(
+            'GET', 'http://localhost:4000/v2/kolla/base/blobs/sha256:abc',
+            headers={}, timeout=120)
+
+    def test_get_labels_missing_image(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.return_value = fake_response(404)
+        self.assertIsNone(self.client.get_labels('kolla/base', 'master'))
+
+    def test_has_manifest(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.side_effect = [fake_response(200),
+                                            fake_response(404)]
+        self.assertTrue(self.client.has_manifest('kolla/base', 'master'))
+        self.assertFalse(self.client.has_manifest('kolla/base', 'other'))
+        self.assertEqual('HEAD', self.session.request.call_args[0][0])
+
+    def test_bearer_authentication(self):
+        self.client._base_url = 'https://registry'
+        challenge = ('Bearer realm="https://auth/token",'
+                     'service="registry"')
+        self.session.request.side_effect = [
+            fake_response(401, headers={'WWW-Authenticate': challenge}),
+            fake_response(404),
+        ]
+        self.session.get.return_value = fake_response(json={'token': 'tok'})
+
+        self.assertIsNone(self.client.get_manifest('kolla/base', 'master'))
+        self.session.get.assert_called_once_with(
+            'https://auth/token',
+            params={'service': 'registry',
+                    'scope': 'repository:kolla/base:pull'},
+            timeout=120)
+        headers = self.session.request.call_args[1]['headers']
+        self.assertEqual('Bearer tok', headers['Authorization'])
+
+    def test_bearer_token_expired(self):
+        self.client._base_url = 'https://registry'
+        challenge = ('Bearer realm="https://auth/token",'
+                     'service="registry"')
+        self.session.request.side_effect = [
+            fake_response(401, headers={'WWW-Authenticate': challenge}),
+            fake_response(404),
+            fake_response(401, headers={
+                'WWW-Authenticate': challenge + ',error="invalid_token"'}),
+            fake_response(200),
+        ]
+        self.session.get.side_effect = [
+            fake_response(json={'token': 'expired'}),
+            fake_response(json={'token': 'renewed'}),
+        ]
+
+        self.assertIsNone(self.client.get_manifest('kolla/base', 'master'))
+        self.assertTrue(self.client.has_manifest('kolla/base', 'master'))
+        self.assertEqual(2, self.session.get.call_count)
+        self.session.get.assert_called_with(
+            'https://auth/token',
+            params={'service': 'registry',
+                    'scope': 'repository:kolla/base:pull'},
+            timeout=120)
+        self.assertEqual(4, self.session.request.call_count)
+        headers = self.session.request.call_args[1]['headers']
+        self.assertEqual('Bearer renewed', headers['Authorization'])
+        self.assertEqual({('repository:kolla/base:pull',): 'Bearer renewed'},
+                         self.client._tokens)
+
+    def test_bearer_token_renewed_by_other_thread(self):
+        self.client._base_url = 'https://registry'
+        scopes = ('repository:kolla/base:pull',)
+        self.client._tokens[scopes] = 'Bearer expired'
+        challenge = ('Bearer realm="https://auth/token",'
+                     'service="registry"')
+
+        def expire(*args, **kwargs):
+            # NOTE: another thread renews the token meanwhile
+            self.client._tokens[scopes] = 'Bearer other'
+            return fake_response(401, headers={'WWW-Authenticate': challenge})
+        responses = iter([expire, lambda *args, **kwargs: fake_response()])
+        self.session.request.side_effect = (
+            lambda *args, **kwargs: next(responses)(*args, **kwargs))
+        self.session.get.return_value = fake_response(json={'token': 'tok'})
+
+        self.assertTrue(self.client.has_manifest('kolla/base', 'master'))
+        self.assertEqual({scopes: 'Bearer tok'}, self.client._tokens)
+
+    def test_session_per_thread(self):
+        self.client.session_factory = mock.Mock
+        session = self.client.session
+        self.assertIs(session, self.client.session)
+        other = list()
+        thread = threading.Thread(
+            target=lambda: other.append(self.client.session))
+        thread.start()
+        thread.join()
+        self.assertIsNot(session, other[0])
+
+    def test_get_layers(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.return_value = fake_response(
+            json={'layers': [{'digest': 'sha256:a'}, {'digest': 'sha256:b'}]})
+        self.assertEqual(['sha256:a', 'sha256:b'],
+                         self.client.get_layers('kolla/base', 'master'))
+
+    def test_mount_blob(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.return_value = fake_response(201)
+        self.assertTrue(self.client.mount_blob('kolla/nova', 'sha256:a',
+                                               'kolla/base'))
+        self.session.request.assert_called_once_with(
+            'POST', 'http://localhost:4000/v2/kolla/nova/blobs/uploads/',
+            headers={}, timeout=120,
+            params={'mount': 'sha256:a', 'from': 'kolla/base'})
+
+    def test_mount_blob_refused(self):
+        self.client._base_url = 'http://localhost:4000'
+        self.session.request.side_effect = [
+            fake_response(202, headers={
+                'Location': '/v2/kolla/nova/blobs/uploads/uuid'}),
+            fake_response(204),
+        ]
+        self.assertFalse(self.client.mount_blob('kolla/nova', 'sha256:a',
+                                                'kolla/base'))
+        self.session.request.assert_called_with(
+            'DELETE', 'http://localhost:4000/v2/kolla/nova/blobs/uploads/uuid',
+            headers={}, timeout=120)
+
+    def test_bearer_authentication_credentials(self):
+        self.client._base_url = 'https://registry'
+        self.client.credentials = ('user', 'secret')
+        challenge = ('Bearer realm="https://auth/token",service="registry",'
+                     'scope="repository:kolla/nova:pull,push"')
+        self.session.request.side_effect = [
+            fake_response(401, headers={'WWW-Authenticate': challenge}),
+            fake_response(201),
+        ]
+        self.session.get.return_value = fake_response(json={'token': 'tok'})
+
+        self.assertTrue(self.client.mount_blob('kolla/nova', 'sha256:a',
+                                               'kolla/base'))
+        self.session.get.assert_called_once_with(
+            'https://auth/token',
+            params={'service': 'registry',
+                    'scope': ['repository:kolla/nova:pull,push',
+                              'repository:kolla/base:pull']},
+            auth=('user', 'secret'), timeout=120)
+
+    def test_basic_authentication(self):
+        self.client._base_url = 'https://registry'
+        self.client.credentials = ('user', 'secret')
+        self.session.request.side_effect = [
+            fake_response(401, headers={
+                'WWW-Authenticate': 'Basic realm="registry"'}),
+            fake_response(404),
+        ]
+        self.assertIsNone(self.client.get_manifest('kolla/base', 'master'))
+        headers = self.session.request.call_args[1]['headers']
+        self.assertEqual('Basic dXNlcjpzZWNyZXQ=', headers['Authorization'])
@@ -0,0 +1,259 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import shutil
+import tarfile
+import threading
+from unittest import mock
+
+import fixtures
+import git
+from requests import exceptions as requests_exc
+
+from kolla.image import sources
+from kolla.tests import base
+
+
+def fake_response(status_code=200, content=b'', headers=None):
+    response = mock.MagicMock(status_code=status_code, headers=headers or {})
+    response.iter_content.return_value = iter([content])
+    return response
+
+
+class DownloadTest(base.TestCase):
+
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        self.dest = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                                 'archive')
+
+    @mock.patch('requests.get')
+    def test_download(self, mock_get):
+        response = fake_response()
+        response.iter_content.return_value = iter([b'ab', b'c'])
+        mock_get.return_value = response
+        r, digest = sources.download('http://fake/a', self.dest, 120)
+
+        self.assertIs(response, r)
+        self.assertEqual(hashlib.sha256(b'abc').hexdigest(), digest)
+        with open(self.dest, 'rb') as f:
+            self.assertEqual(b'abc', f.read())
+        response.iter_content.assert_called_once_with(
+            sources.DOWNLOAD_CHUNK_SIZE)
+        self.assertEqual(0, sources.DOWNLOAD_BUDGET.used)
+
+    @mock.patch('requests.get')
+    def test_download_error(self, mock_get):
+        mock_get.return_value = fake_response(404)
+        r, digest = sources.download('http://fake/a', self.dest, 120)
+        self.assertIsNone(digest)
+        self.assertFalse(os.path.exists(self.dest))
+
+    @mock.patch('requests.get')
+    def test_download_interrupted(self, mock_get):
+        def chunks():
+            yield b'ab'
+            raise IOError
+
+        response = fake_response()
+        response.iter_content.return_value = chunks()
+        mock_get.return_value = response
+        self.assertRaises(IOError, sources.download, 'http://fake/a',
+                          self.dest, 120)
+        self.assertEqual([], os.listdir(os.path.dirname(self.dest)))
+        self.assertEqual(0, sources.DOWNLOAD_BUDGET.used)
+
+
+class ByteBudgetTest(base.TestCase):
+
+    def test_acquire_waits_for_release(self):
+        budget = sources.ByteBudget(10)
+        self.assertEqual(10, budget.acquire(20))
+        acquired = threading.Event()
+
+        def acquire():
+            budget.acquire(5)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        self.assertFalse(acquired.wait(0.1))
+        budget.release(10)
+        self.assertTrue(acquired.wait(10))
+        thread.join()
+        self.assertEqual(5, budget.used)
+
+
+class DownloadCacheTest(base.TestCase):
+
+    def setUp(self):
+        super(DownloadCacheTest, self).setUp()
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.cache = sources.DownloadCache(os.path.join(tmp_dir, 'cache'),
+                                           1024)
+        self.dest = os.path.join(tmp_dir, 'archive')
+
+    def _read_dest(self):
+        with open(self.dest, 'rb') as f:
+            return f.read()
+
+    @mock.patch('requests.get')
+    def test_fetch_and_revalidate(self, mock_get):
+        mock_get.return_value = fake_response(
+            content=b'data', headers={'ETag': '"v1"'})
+        self.assertEqual(4, self.cache.fetch('http://fake/a.tar.gz',
+                                             self.dest, 120))
+        mock_get.assert_called_once_with('http://fake/a.tar.gz', headers={},
+                                         timeout=120, stream=True)
+        self.assertEqual(b'data', self._read_dest())
+
+        os.remove(self.dest)
+        mock_get.reset_mock()
+        mock_get.return_value = fake_response(304)
+        self.assertEqual(0, self.cache.fetch('http://fake/a.tar.gz',
+                                             self.dest, 120))
+        mock_get.assert_called_once_with('http://fake/a.tar.gz',
+                                         headers={'If-None-Match': '"v1"'},
+                                         timeout=120, stream=True)
+        self.assertEqual(b'data', self._read_dest())
+
+    @mock.patch('requests.get')
+    def test_fetch_updated(self, mock_get):
+        mock_get.return_value = fake_response(
+            content=b'old', headers={'Last-Modified': 'yesterday'})
+        self.cache.fetch('http://fake/a.tar.gz', self.dest, 120)
+        mock_get.return_value = fake_response(content=b'new')
+        self.cache.fetch('http://fake/a.tar.gz', self.dest, 120)
+        self.assertEqual(
+            {'If-Modified-Since': 'yesterday'},
+            mock_get.call_args[1]['headers'])
+        self.assertEqual(b'new', self._read_dest())
+
+    @mock.patch('requests.get')
+    def test_fetch_error(self, mock_get):
+        mock_get.return_value = fake_response(404)
+        self.assertRaises(sources.DownloadError, self.cache.fetch,
+                          'http://fake/a.tar.gz', self.dest, 120)
+
+    @mock.patch('requests.get')
+    def test_fetch_offline(self, mock_get):
+        mock_get.return_value = fake_response(content=b'data')
+        self.cache.fetch('http://fake/a.tar.gz', self.dest, 120)
+        mock_get.side_effect = requests_exc.ConnectionError
+        self.cache.fetch('http://fake/a.tar.gz', self.dest, 120)
+        self.assertEqual(b'data', self._read_dest())
+        self.assertRaises(requests_exc.ConnectionError, self.cache.fetch,
+                          'http://fake/b.tar.gz', self.dest, 120)
+
+    @mock.patch('requests.get')
+    def test_evict_least_recently_used(self, mock_get):
+        for url in ('http://fake/a', 'http://fake/b', 'http://fake/a',
+                    'http://fake/c'):
+            mock_get.return_value = fake_response(content=b'x' * 400)
+            self.cache.fetch(url, self.dest, 120)
+
+        cached = sorted(name for name in os.listdir(self.cache.path)
+                        if name.endswith('.data'))
+        self.assertEqual(
+            sorted(os.path.basename(self.cache._paths(url)[0])
+                   for url in ('http://fake/a', 'http://fake/c')),
+            cached)
+
+
+class GitMirrorTest(base.TestCase):
+
+    def setUp(self):
+        super(GitMirrorTest, self).setUp()
+        tmp_dir = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.EnvironmentVariable('HOME', tmp_dir))
+        for var in ('GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME'):
+            self.useFixture(fixtures.EnvironmentVariable(var, 'kolla'))
+        for var in ('GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL'):
+            self.useFixture(fixtures.EnvironmentVariable(var, 'kolla@test'))
+        self.upstream = os.path.join(tmp_dir, 'upstream')
+        self.cache = os.path.join(tmp_dir, 'cache')
+        self.dest = os.path.join(tmp_dir, 'archive')
+        os.mkdir(self.upstream)
+        self.repo = git.Git(self.upstream)
+        self.repo.init('-b', 'master')
+        self._commit('setup.cfg', '[metadata]\nname = fake-project\n')
+        self.repo.tag('1.2.3')
+
+    def _commit(self, name, content):
+        with open(os.path.join(self.upstream, name), 'w') as f:
+            f.write(content)
+        self.repo.add(name)
+        self.repo.commit('-m', 'Update %s' % name)
+
+    def test_update_and_archive(self):
+        mirror = sources.GitMirror(self.cache, self.upstream)
+        commit = mirror.update('master')
+        self.assertEqual(self.repo.rev_parse('master'), commit)
+
+        mirror.archive(commit, self.dest, 'fake-archive')
+        with tarfile.open(self.dest) as tar:
+            self.assertEqual(
+                ['fake-archive', 'fake-archive/PKG-INFO',
+                 'fake-archive/setup.cfg'],
+                sorted(tar.getnames()))
+            pkg_info = tar.extractfile('fake-archive/PKG-INFO').read()
+        self.assertIn(b'Name: fake-project\n', pkg_info)
+        self.assertIn(b'Version: 1.2.3\n', pkg_info)
+
+    def test_update_fetches_new_commits(self):
+        mirror = sources.GitMirror(self.cache, self.upstream)
+        first = mirror.update('master')
+        self._commit('README', 'readme')
+        second = mirror.update('master')
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.repo.rev_parse('master'), second)
+
+        mirror.archive(second, self.dest, 'fake-archive')
+        with tarfile.open(self.dest) as tar:
+            pkg_info = tar.extractfile('fake-archive/PKG-INFO').read()
+        self.assertIn(b'Version: 1.2.4.dev1\n', pkg_info)
+
+    def _version(self):
+        mirror = sources.GitMirror(self.cache, self.upstream)
+        mirror.archive(mirror.update('master'), self.dest, 'fake-archive')
+        with tarfile.open(self.dest) as tar:
+            pkg_info = tar.extractfile('fake-archive/PKG-INFO').read()
+        return pkg_info.decode().split('\nVersion: ')[1].strip()
+
+    def test_version_without_tag(self):
+        self.repo.tag('-d', '1.2.3')
+        self._commit('README', 'readme')
+        self.assertEqual('0.0.1.dev2', self._version())
+
+    def test_version_ignores_non_release_tags(self):
+        self._commit('README', 'readme')
+        self.repo.tag('xena-eol')
+        self.assertEqual('1.2.4.dev1', self._version())
+
+    def test_version_invalid_tag(self):
+        self._commit('README', 'readme')
+        self.repo.tag('2-broken')
+        self.assertEqual('0.0.1.dev2', self._version())
+
+    def test_update_known_commit(self):
+        mirror = sources.GitMirror(self.cache, self.upstream)
+        commit = mirror.update('master')
+        # no fetch is needed, so the upstream repository is not needed
+        shutil.rmtree(self.upstream)
+        self.assertEqual(commit, mirror.update(commit))
+        self.assertRaises(git.GitCommandError, mirror.update, 'master')
+
+    def test_update_unknown_reference(self):
+        mirror = sources.GitMirror(self.cache, self.upstream)
+        self.assertRaises(git.GitCommandError, mirror.update, 'missing')
@@ -0,0 +1,220 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+from unittest import mock
+
+import fixtures
+
+from kolla.image import squash
+from kolla.tests import base
+
+
+def make_tar(members):
+    """Archive (name, content) members, None content for directories."""
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in members:
+            info = tarfile.TarInfo(name)
+            if content is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif isinstance(content, tuple):
+                info.type = tarfile.LNKTYPE
+                info.linkname = content[0]
+                tar.addfile(info)
+            else:
+                info.size = len(content)
+                tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+def read_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return dict((member.name, tar.extractfile(member).read()
+                     if member.isreg() else member.linkname or None)
+                    for member in tar)
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class MergeLayersTest(base.TestCase):
+
+    def setUp(self):
+        super(MergeLayersTest, self).setUp()
+        self.tmp_dir = self.useFixture(fixtures.TempDir()).path
+
+    def _merge(self, *layers):
+        paths = list()
+        for i, members in enumerate(layers):
+            path = os.path.join(self.tmp_dir, '%d.tar' % i)
+            with open(path, 'wb') as f:
+                f.write(make_tar(members))
+            paths.append(path)
+        merged = io.BytesIO()
+        squash.merge_layers(paths, merged)
+        return read_tar(merged.getvalue())
+
+    def test_upper_layer_wins(self):
+        self.assertEqual(
+            {'etc': None, 'etc/a': b'new', 'etc/b': b'b', 'etc/c': b'c'},
+            self._merge([('etc', None), ('etc/a', b'old'), ('etc/b', b'b')],
+                        [('./etc', None), ('./etc/a', b'new'),
+                         ('./etc/c', b'c')]))
+
+    def test_whiteouts(self):
+        self.assertEqual(
+            {'etc': None, 'etc/.wh.a': b'', 'etc/.wh.parent': b'',
+             'etc/b': b'b'},
+            self._merge([('etc', None), ('etc/a', b'a'), ('etc/b', b'b'),
+                         ('etc/.wh.parent', b'')],
+                        [('etc', None), ('etc/.wh.a', b'')]))
+
+    def test_whiteout_of_recreated_file(self):
+        self.assertEqual(
+            {'a': b'new'},
+            self._merge([('.wh.a', b'')], [('a', b'new')]))
+
+    def test_whiteout_of_recreated_directory(self):
+        self.assertEqual(
+            {'d': None, 'd/new': b'new', 'd/.wh..wh..opq': b''},
+            self._merge([('.wh.d', b'')], [('d', None), ('d/new', b'new')]))
+
+    def test_opaque_directory(self):
+        self.assertEqual(
+            {'d': None, 'd/.wh..wh..opq': b'', 'd/new': b'new'},
+            self._merge([('d', None), ('d/old', b'old')],
+                        [('d', None), ('d/.wh..wh..opq', b''),
+                         ('d/new', b'new')]))
+
+    def test_directory_replaced_by_file(self):
+        self.assertEqual(
+            {'d': b'file'},
+            self._merge([('d', None), ('d/old', b'old')], [('d', b'file')]))
+
+    def test_hard_link_to_replaced_file(self):
+        self.assertEqual(
+            {'a': b'new', 'b': b'old', 'c': 'a'},
+            self._merge([('a', b'old'), ('b', ('a',))],
+                        [('a', b'new'), ('c', ('a',))]))
+
+
+class SquashImageTest(base.TestCase):
+
+    def setUp(self):
+        super(SquashImageTest, self).setUp()
+        self.parent_layer = make_tar([('etc', None), ('etc/os', b'os')])
+        self.layers = [make_tar([('etc/a', b'old'), ('etc/b', b'b' * 4096)]),
+                       make_tar([('etc/a', b'new'), ('etc/.wh.b', b'')])]
+        self.diff_ids = [digest(self.parent_layer)] + [
+            digest(layer) for layer in self.layers]
+        self.config = {
+            'created': '2020-01-01T00:00:00Z',
+            'config': {'Labels': {'a': 'b'}},
+            'rootfs': {'type': 'layers', 'diff_ids': self.diff_ids},
+            'history': [{'created_by': 'FROM'},
+                        {'created_by': 'LABEL', 'empty_layer': True},
+                        {'created_by': 'RUN 1'}, {'created_by': 'RUN 2'}]}
+        self.dc = mock.Mock()
+        self.dc.inspect_image.side_effect = lambda name: {
+            'image': {'Id': 'sha256:old',
+                      'RootFS': {'Layers': self.diff_ids}},
+            'parent': {'RootFS': {'Layers': self.diff_ids[:1]}},
+        }[name]
+        self.loaded = list()
+        self.dc.load_image.side_effect = (
+            lambda data: self.loaded.append(b''.join(data)))
+
+    def _save(self, oci=False):
+        members = list()
+        names = list()
+        for i, layer in enumerate([self.parent_layer] + self.layers):
+            if oci:
+                name = 'blobs/sha256/%s' % digest(layer).split(':')[1]
+            else:
+                members.append(('v1id%d/json' % i, b'{}'))
+                name = 'v1id%d/layer.tar' % i
+            members.append((name, layer))
+            names.append(name)
+        members.append(('config.json', json.dumps(self.config).encode()))
+        members.append(('manifest.json', json.dumps(
+            [{'Config': 'config.json', 'Layers': names}]).encode()))
+        data = make_tar(members)
+        return [data[i:i + 1000] for i in range(0, len(data), 1000)]
+
+    def _check_loaded(self):
+        loaded = read_tar(self.loaded[0])
+        manifest = json.loads(loaded.pop('manifest.json'))[0]
+        self.assertEqual(['image'], manifest['RepoTags'])
+        config = json.loads(loaded[manifest['Config']])
+        diff_ids = config['rootfs']['diff_ids']
+        self.assertEqual(2, len(diff_ids))
+        self.assertEqual(self.diff_ids[0], diff_ids[0])
+        self.assertEqual(['FROM', 'kolla-build squash'],
+                         [h['created_by'] for h in config['history']])
+        self.assertEqual({'a': 'b'}, config['config']['Labels'])
+        layer = loaded['%s/layer.tar' % diff_ids[1].split(':')[1]]
+        self.assertEqual(diff_ids[1], digest(layer))
+        self.assertEqual({'etc/a': b'new', 'etc/.wh.b': b''},
+                         read_tar(layer))
+        self.assertEqual(2, len(loaded))
+
+    def _spooled(self):
+        spooled = list()
+        spool = squash._spool
+
+        def record(fileobj, path):
+            spooled.append(spool(fileobj, path))
+            return spooled[-1]
+        self.useFixture(fixtures.MockPatchObject(squash, '_spool',
+                                                 side_effect=record))
+        return spooled
+
+    def test_squash_legacy_archive(self):
+        self.dc.get_image.side_effect = lambda *args, **kwargs: self._save()
+        spooled = self._spooled()
+        result = squash.squash_image(self.dc, 'image', 'parent',
+                                     cleanup=True)
+        self.assertEqual(2, result.layers)
+        self.assertEqual(sorted(self.diff_ids[1:]), sorted(spooled))
+        self.assertEqual(2, self.dc.get_image.call_count)
+        self.assertGreater(result.saved_bytes, 4096)
+        self._check_loaded()
+        self.dc.remove_image.assert_called_once_with('sha256:old')
+
+    def test_squash_oci_archive(self):
+        self.dc.get_image.return_value = self._save(oci=True)
+        spooled = self._spooled()
+        squash.squash_image(self.dc, 'image', 'parent')
+        self.assertEqual(sorted(self.diff_ids[1:]), sorted(spooled))
+        self.dc.get_image.assert_called_once_with('image',
+                                                  chunk_size=mock.ANY)
+        self._check_loaded()
+        self.dc.remove_image.assert_not_called()
+
+    def test_nothing_to_squash(self):
+        self.diff_ids = self.diff_ids[:2]
+        self.assertEqual((1, 0), squash.squash_image(self.dc, 'image',
+                                                     'parent'))
+        self.dc.get_image.assert_not_called()
+
+    def test_missing_layer(self):
+        self.dc.get_image.side_effect = lambda *args, **kwargs: self._save()
+        self.diff_ids.append(digest(b'missing'))
+        self.assertRaises(squash.SquashError, squash.squash_image, self.dc,
+                          'image', 'parent')
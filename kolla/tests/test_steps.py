@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+from kolla.image import steps
+from kolla.tests import base
+
+
+def _parse(lines):
+    parser = steps.BuildStepParser()
+    for line in lines:
+        parser.feed(line)
+    parser.close()
+    return parser.steps
+
+
+class BuildStepParserTest(base.TestCase):
+
+    @mock.patch('time.monotonic', side_effect=[1.0, 3.0, 3.5, 7.0])
+    def test_feed(self, mock_monotonic):
+        parsed = _parse(['Step 1/3 : FROM kolla/base:tag',
+                         ' ---> 0123456789ab',
+                         'Step 2/3 : RUN dnf -y install foo',
+                         ' ---> Using cache',
+                         ' ---> 123456789abc',
+                         'Step 3/3 : COPY start.sh /usr/local/bin/',
+                         ' ---> 23456789abcd',
+                         'Successfully built 23456789abcd'])
+
+        self.assertEqual(
+            [{'step': 1, 'instruction': 'FROM kolla/base:tag',
+              'cached': False, 'duration': 2.0},
+             {'step': 2, 'instruction': 'RUN dnf -y install foo',
+              'cached': True, 'duration': 0.5},
+             {'step': 3, 'instruction': 'COPY start.sh /usr/local/bin/',
+              'cached': False, 'duration': 3.5}],
+            [step.to_dict() for step in parsed])
+
+    def test_using_cache_before_step(self):
+        self.assertEqual([], _parse([' ---> Using cache']))
+
+
+class SummaryTest(base.TestCase):
+
+    def test_summarize(self):
+        parsed = _parse(['Step 1/3 : FROM base', 'Step 2/3 : RUN true',
+                         ' ---> Using cache', 'Step 3/3 : ADD . /'])
+        summary = steps.summarize(parsed)
+
+        self.assertEqual(3, summary['steps'])
+        self.assertEqual(1, summary['cached_steps'])
+        self.assertEqual(3, summary['cache_invalidated_by']['step'])
+        self.assertEqual('ADD . /',
+                         summary['cache_invalidated_by']['instruction'])
+
+    def test_summarize_fully_cached(self):
+        parsed = _parse(['Step 1/2 : FROM base', 'Step 2/2 : RUN true',
+                         ' ---> Using cache'])
+        self.assertIsNone(steps.summarize(parsed)['cache_invalidated_by'])
+
+    def test_invalidating_instructions(self):
+        labels = ['Step 1/3 : FROM base', 'Step 2/3 : LABEL build_date=now',
+                  'Step 3/3 : RUN true']
+        run = ['Step 1/2 : FROM base', 'Step 2/2 : RUN true']
+        cached = ['Step 1/2 : FROM base', 'Step 2/2 : RUN true',
+                  ' ---> Using cache']
+        images_steps = {'nova-api': _parse(labels),
+                        'glance-api': _parse(labels),
+                        'keystone': _parse(run),
+                        'cron': _parse(cached)}
+
+        self.assertEqual(
+            [{'instruction': 'LABEL build_date=now', 'count': 2,
+              'images': ['glance-api', 'nova-api']},
+             {'instruction': 'RUN true', 'count': 1,
+              'images': ['keystone']}],
+            steps.invalidating_instructions(images_steps))
@@ -0,0 +1,80 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import threading
+
+import fixtures
+
+from kolla.image import build
+from kolla.image import trace
+from kolla.tests import base
+
+
+class TraceTest(base.TestCase):
+
+    def setUp(self):
+        super(TraceTest, self).setUp()
+        self.addCleanup(trace.stop_trace)
+
+    def test_not_recording(self):
+        with trace.span('span', 'task'):
+            pass
+        self.assertIsNone(trace.flow_start('flow'))
+        self.assertIsNone(trace.stop_trace())
+
+    def test_image_phases(self):
+        recorder = trace.start_trace()
+        image = build.Image('base', 'kolla/base:tag', '/base')
+        with image.timed('build'):
+            pass
+        with image.timed('push'):
+            with image.timed('fetch'):
+                pass
+
+        self.assertIs(recorder, trace.stop_trace())
+        spans = [event for event in recorder.events if event['ph'] == 'X']
+        self.assertEqual(['build', 'fetch', 'push'],
+                         [span['name'] for span in spans])
+        self.assertEqual({'image': 'base'}, spans[0]['args'])
+        push, fetch = spans[2], spans[1]
+        self.assertLessEqual(push['ts'], fetch['ts'])
+        self.assertGreaterEqual(push['ts'] + push['dur'],
+                                fetch['ts'] + fetch['dur'])
+        self.assertEqual({'build', 'fetch', 'push'}, set(image.timings))
+
+    def test_tracks_per_thread(self):
+        recorder = trace.start_trace()
+
+        def work():
+            with trace.span('work', 'task'):
+                pass
+
+        threads = [threading.Thread(target=work, name='worker-%d' % i)
+                   for i in range(2)]
+        for thread in threads:
+            thread.start()
+            thread.join()
+        work()
+
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'trace.json')
+        recorder.save(path)
+        with open(path) as f:
+            events = json.load(f)['traceEvents']
+        names = dict((event['tid'], event['args']['name'])
+                     for event in events if event['ph'] == 'M')
+        self.assertEqual(3, len(names))
+        self.assertIn('worker-0', names.values())
+        self.assertEqual(3, len(set(event['tid'] for event in events
+                                    if event['ph'] == 'X')))